@@ -25,14 +25,11 @@ def _build_operating_system_version_filter(major, minor, name, operation):
     }
 
 
-def build_operating_system_filter(field_name, operating_system, field_filter):
-    # field name is unused but here because the generic filter builders need it and this has
-    # to have the same interface
-    os_filters = []
-
+def parse_operating_system_filter(operating_system):
+    # Yields the name of every filtered operating system with its (operation, major, minor) version comparisons
     for name in operating_system:
         if isinstance(operating_system[name], dict) and operating_system[name].get("version"):
-            os_filters_for_current_name = []
+            comparisons = []
             version_dict = operating_system[name]["version"]
 
             # Check that there is an operation at all. No default it wouldn't make sense
@@ -46,15 +43,26 @@ def build_operating_system_filter(field_name, operating_system, field_filter):
                     if minor_version_list != []:
                         minor_version = int(minor_version_list[0])
 
-                    os_filters_for_current_name.append(
-                        _build_operating_system_version_filter(major_version, minor_version, name, operation)
-                    )
+                    comparisons.append((operation, major_version, minor_version))
                 else:
                     raise ValidationException(
                         f"Specified operation '{operation}' is not on [operating_system][version] field"
                     )
-            os_filters.append({"AND": os_filters_for_current_name})
+            yield name, comparisons
         else:
             raise ValidationException(f"Incomplete path provided: {operating_system} ")
 
+
+def build_operating_system_filter(field_name, operating_system, field_filter):
+    # field name is unused but here because the generic filter builders need it and this has
+    # to have the same interface
+    os_filters = []
+
+    for name, comparisons in parse_operating_system_filter(operating_system):
+        os_filters_for_current_name = [
+            _build_operating_system_version_filter(major_version, minor_version, name, operation)
+            for operation, major_version, minor_version in comparisons
+        ]
+        os_filters.append({"AND": os_filters_for_current_name})
+
     return ({"OR": os_filters},)
@@ -0,0 +1,174 @@
+import operator
+from enum import Enum
+from functools import partial
+
+from sqlalchemy import and_
+from sqlalchemy import BigInteger
+from sqlalchemy import Integer
+from sqlalchemy import literal
+from sqlalchemy import or_
+from sqlalchemy import String
+from sqlalchemy.dialects.postgresql import JSONB
+
+from api.filtering.custom_filters import parse_operating_system_filter
+from api.filtering.filtering_common import check_field_in_spec
+from api.filtering.filtering_common import get_field_value
+from api.filtering.filtering_common import invalid_value_error
+from api.filtering.filtering_common import lookup_operations
+from api.filtering.filtering_common import NIL_STRING
+from api.filtering.filtering_common import NOT_NIL_STRING
+from api.filtering.filtering_common import OR_FIELDS
+from app import custom_filter_fields
+from app import system_profile_spec
+from app.exceptions import ValidationException
+from app.logging import get_logger
+from app.models import Host
+
+__all__ = ("build_system_profile_filter",)
+
+logger = get_logger(__name__)
+
+OPERATORS = {"eq": operator.eq, "lt": operator.lt, "lte": operator.le, "gt": operator.gt, "gte": operator.ge}
+
+# The containment predicates are served by a GIN index on the system profile without the installed packages, these
+# would make up most of its entries. The expression must be the same as the one of the index.
+UNINDEXED_FIELDS = ("installed_packages",)
+INDEXED_SYSTEM_PROFILE = Host.system_profile_facts.op("-", return_type=JSONB)(
+    literal(UNINDEXED_FIELDS[0], type_=String)
+)
+
+
+def _contains(field_name, value):
+    system_profile = Host.system_profile_facts if field_name in UNINDEXED_FIELDS else INDEXED_SYSTEM_PROFILE
+    # An array field contains the value among its items
+    if system_profile_spec()[field_name]["type"] == list:
+        value = [value]
+    return system_profile.contains({field_name: value})
+
+
+def _boolean_filter(field_name, field_value):
+    if not field_value.lower() in ("true", "false"):
+        invalid_value_error(field_name, field_value)
+
+    return _contains(field_name, field_value.lower() == "true")
+
+
+def _string_filter(field_name, field_value):
+    if not isinstance(field_value, str):
+        invalid_value_error(field_name, field_value)
+
+    return _contains(field_name, field_value)
+
+
+def _wildcard_string_filter(field_name, field_value):
+    if not isinstance(field_value, str):
+        invalid_value_error(field_name, field_value)
+
+    pattern = field_value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_").replace("*", "%")
+    return Host.system_profile_facts[field_name].astext.like(pattern)
+
+
+def _range_filter(field_name, field_input):
+    # A plain value is an equality, a dict holds the operations with their values
+    if isinstance(field_input, str):
+        if field_input in (NIL_STRING, NOT_NIL_STRING):
+            return _nullable_filter(field_name, field_input)
+        field_input = {"eq": field_input}
+    elif not isinstance(field_input, dict):
+        raise ValidationException(f"wrong type for {field_input} filter")
+
+    number = Host.system_profile_facts[field_name].astext.cast(BigInteger)
+    comparisons = []
+    for operation, value in field_input.items():
+        if operation not in ("eq", *lookup_operations("range")):
+            raise ValidationException(f"invalid operation for {field_name}")
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            invalid_value_error(field_name, value)
+        comparisons.append(_contains(field_name, value) if operation == "eq" else OPERATORS[operation](number, value))
+
+    return and_(*comparisons)
+
+
+def _operating_system_filter(field_name, operating_system):
+    major = Host.system_profile_facts[field_name]["major"].astext.cast(Integer)
+    minor = Host.system_profile_facts[field_name]["minor"].astext.cast(Integer)
+
+    os_filters = []
+    for name, comparisons in parse_operating_system_filter(operating_system):
+        version_filters = [
+            # lte and lt compare the major version with lt, gte and gt with gt
+            or_(
+                and_(major == major_version, OPERATORS[operation](minor, minor_version)),
+                OPERATORS[operation[0:2]](major, major_version),
+            )
+            for operation, major_version, minor_version in comparisons
+        ]
+        os_filters.append(and_(_contains(field_name, {"name": name}), *version_filters))
+
+    return or_(*os_filters)
+
+
+class BUILDER_FUNCTIONS(Enum):
+    wildcard = partial(_wildcard_string_filter)
+    string = partial(_string_filter)
+    boolean = partial(_boolean_filter)
+    # Customs under here, these get the whole field input
+    integer = partial(_range_filter)
+    operating_system = partial(_operating_system_filter)
+
+
+def _nullable_filter(field_name, field_value):
+    value = Host.system_profile_facts[field_name].astext
+    return value.is_(None) if field_value == NIL_STRING else value.isnot(None)
+
+
+def _nullable_wrapper(filter_function, field_name, field_value):
+    if field_value in (NIL_STRING, NOT_NIL_STRING):
+        return _nullable_filter(field_name, field_value)
+    else:
+        return filter_function(field_name, field_value)
+
+
+def _generic_filter_builder(builder_function, field_name, field_value):
+    if isinstance(field_value, list):
+        logger.debug("filter value is a list")
+        list_operator = or_ if field_name in OR_FIELDS else and_
+        return list_operator(*(_nullable_wrapper(builder_function, field_name, value) for value in field_value))
+    elif isinstance(field_value, str):
+        logger.debug("filter value is a string")
+        return _nullable_wrapper(builder_function, field_name, field_value)
+    else:
+        logger.debug("filter value is bad")
+        raise ValidationException(f"wrong type for {field_value} filter")
+
+
+def build_system_profile_filter(system_profile):
+    """
+    Compiles the filter[system_profile] input into SQL predicates on the hosts, the same input the xjoin filter in
+    api.filtering.filtering gets. Returns a tuple of predicates to be all matched.
+    """
+    system_profile_filter = tuple()
+
+    for field_name in system_profile:
+        check_field_in_spec(field_name)
+
+        field_input = system_profile[field_name]
+        field_filter = system_profile_spec()[field_name]["filter"]
+
+        logger.debug(f"generating filter: field: {field_name}, type: {field_filter}, field_input: {field_input}")
+
+        if field_filter not in BUILDER_FUNCTIONS.__members__:
+            raise ValidationException(f"filtering on {field_name} is not supported")
+
+        builder_function = BUILDER_FUNCTIONS[field_filter].value
+
+        if field_name in custom_filter_fields or field_filter == "integer":
+            system_profile_filter += (builder_function(field_name, field_input),)
+        else:
+            field_value = get_field_value(field_input, field_filter)
+
+            system_profile_filter += (_generic_filter_builder(builder_function, field_name, field_value),)
+
+    return system_profile_filter
@@ -2,8 +2,13 @@ from enum import Enum
 from functools import partial
 
 from api.filtering.custom_filters import build_operating_system_filter
+from api.filtering.filtering_common import check_field_in_spec
+from api.filtering.filtering_common import get_field_value
+from api.filtering.filtering_common import invalid_value_error
 from api.filtering.filtering_common import lookup_graphql_operations
-from api.filtering.filtering_common import lookup_operations
+from api.filtering.filtering_common import NIL_STRING
+from api.filtering.filtering_common import NOT_NIL_STRING
+from api.filtering.filtering_common import OR_FIELDS
 from app import custom_filter_fields
 from app import system_profile_spec
 from app.exceptions import ValidationException
@@ -11,32 +16,24 @@ from app.logging import get_logger
 
 logger = get_logger(__name__)
 
-NIL_STRING = "nil"
-NOT_NIL_STRING = "not_nil"
-OR_FIELDS = ("owner_id", "rhc_client_id", "host_type")
-
-
-def _invalid_value_error(field_name, field_value):
-    raise ValidationException(f"{field_value} is an invalid value for field {field_name}")
-
 
 def _boolean_filter(field_name, field_value):
     if not field_value.lower() in ("true", "false"):
-        _invalid_value_error(field_name, field_value)
+        invalid_value_error(field_name, field_value)
 
     return ({field_name: {"is": (field_value.lower() == "true")}},)
 
 
 def _string_filter(field_name, field_value):
     if not isinstance(field_value, str):
-        _invalid_value_error(field_name, field_value)
+        invalid_value_error(field_name, field_value)
 
     return ({field_name: {"eq": (field_value)}},)
 
 
 def _wildcard_string_filter(field_name, field_value):
     if not isinstance(field_value, str):
-        _invalid_value_error(field_name, field_value)
+        invalid_value_error(field_name, field_value)
 
     return ({field_name: {"matches": (field_value)}},)
 
@@ -50,25 +47,6 @@ class BUILDER_FUNCTIONS(Enum):
     operating_system = partial(build_operating_system_filter)
 
 
-def _check_field_in_spec(field_name):
-    if field_name not in system_profile_spec().keys():
-        raise ValidationException(f"invalid filter field: {field_name}")
-
-
-# if operation is specified, check the operation is allowed on the field
-# and find the actual value
-def _get_field_value(field_value, field_filter):
-    if isinstance(field_value, dict):
-        for key in field_value:
-            # check if the operation is valid for the field.
-            if key not in lookup_operations(field_filter):
-                raise ValidationException(f"invalid operation for {field_filter}")
-
-            field_value = field_value[key]
-
-    return field_value
-
-
 def _nullable_wrapper(filter_function, field_name, field_value, field_filter):
     graphql_operation = lookup_graphql_operations(field_filter)
 
@@ -115,7 +93,7 @@ def build_system_profile_filter(system_profile):
     system_profile_filter = tuple()
 
     for field_name in system_profile:
-        _check_field_in_spec(field_name)
+        check_field_in_spec(field_name)
 
         field_input = system_profile[field_name]
         field_filter = system_profile_spec()[field_name]["filter"]
@@ -127,7 +105,7 @@ def build_system_profile_filter(system_profile):
         if field_name in custom_filter_fields:
             system_profile_filter += builder_function(field_name, field_input, field_filter)
         else:
-            field_value = _get_field_value(field_input, field_filter)
+            field_value = get_field_value(field_input, field_filter)
 
             system_profile_filter += _generic_filter_builder(builder_function, field_name, field_value, field_filter)
 
@@ -1,5 +1,12 @@
 from enum import Enum
 
+from app import system_profile_spec
+from app.exceptions import ValidationException
+
+NIL_STRING = "nil"
+NOT_NIL_STRING = "not_nil"
+OR_FIELDS = ("owner_id", "rhc_client_id", "host_type")
+
 
 class OPERATION_SETS(Enum):
     eq = ["eq", "contains"]  # add contains for when it's a list
@@ -30,3 +37,26 @@ def lookup_operations(filter_type):
 
 def lookup_graphql_operations(filter_type):
     return GRAPHQL_OPERATIONS_LOOKUP[filter_type]
+
+
+def invalid_value_error(field_name, field_value):
+    raise ValidationException(f"{field_value} is an invalid value for field {field_name}")
+
+
+def check_field_in_spec(field_name):
+    if field_name not in system_profile_spec().keys():
+        raise ValidationException(f"invalid filter field: {field_name}")
+
+
+# if operation is specified, check the operation is allowed on the field
+# and find the actual value
+def get_field_value(field_value, field_filter):
+    if isinstance(field_value, dict):
+        for key in field_value:
+            # check if the operation is valid for the field.
+            if key not in lookup_operations(field_filter):
+                raise ValidationException(f"invalid operation for {field_filter}")
+
+            field_value = field_value[key]
+
+    return field_value
@@ -14,6 +14,8 @@ from api.host_query import build_paginated_host_list_response
 from api.host_query import staleness_timestamps
 from api.host_query_db import get_host_list as get_host_list_db
 from api.host_query_db import params_to_order_by
+from api.host_query_db import sparse_system_profile_hosts
+from api.host_query_db import sparse_system_profile_query
 from api.host_query_xjoin import get_host_list as get_host_list_xjoin
 from api.sparse_host_list_system_profile import get_sparse_system_profile
 from app import db
@@ -103,16 +105,20 @@ def get_host_list(
     registered_with=None,
     filter=None,
     fields=None,
+    cursor=None,
+    count_strategy=None,
 ):
     total = 0
     host_list = ()
+    next_cursor = None
+    count_strategy_used = None
 
     bulk_query_source = get_bulk_query_source()
 
     get_host_list = GET_HOST_LIST_FUNCTIONS[bulk_query_source]
 
     try:
-        host_list, total, additional_fields = get_host_list(
+        host_list, total, additional_fields, next_cursor, count_strategy_used = get_host_list(
             display_name,
             fqdn,
             hostname_or_id,
@@ -128,12 +134,16 @@ def get_host_list(
             registered_with,
             filter,
             fields,
+            cursor,
+            count_strategy,
         )
     except ValueError as e:
         log_get_host_list_failed(logger)
         flask.abort(400, str(e))
 
-    json_data = build_paginated_host_list_response(total, page, per_page, host_list, additional_fields)
+    json_data = build_paginated_host_list_response(
+        total, page, per_page, host_list, additional_fields, next_cursor, count_strategy_used
+    )
     return flask_json_response(json_data)
 
 
@@ -194,12 +204,12 @@ def get_host_by_id(host_id_list, page=1, per_page=100, order_by=None, order_how=
 @rbac(Permission.READ)
 @metrics.api_request_time.time()
 def get_host_system_profile_by_id(host_id_list, page=1, per_page=100, order_by=None, order_how=None, fields=None):
-    if fields:
-        if not get_bulk_query_source() == BulkQuerySource.xjoin:
-            flask.abort(503)
-
+    if fields and get_bulk_query_source() == BulkQuerySource.xjoin:
         total, response_list = get_sparse_system_profile(host_id_list, page, per_page, order_by, order_how, fields)
     else:
+        if fields and not fields.get("system_profile"):
+            flask.abort(400, status.HTTP_400_BAD_REQUEST)
+
         query = _get_host_list_by_id_list(host_id_list)
 
         try:
@@ -208,11 +218,14 @@ def get_host_system_profile_by_id(host_id_list, page=1, per_page=100, order_by=N
             flask.abort(400, str(e))
         else:
             query = query.order_by(*order_by)
+        if fields:
+            query = sparse_system_profile_query(query, fields["system_profile"])
         query_results = query.paginate(page, per_page, True)
 
         total = query_results.total
+        hosts = sparse_system_profile_hosts(query_results.items) if fields else query_results.items
 
-        response_list = [serialize_host_system_profile(host) for host in query_results.items]
+        response_list = [serialize_host_system_profile(host) for host in hosts]
 
     json_output = build_collection_response(response_list, page, per_page, total)
     return flask_json_response(json_output)
@@ -14,16 +14,23 @@ OrderHow = Enum("OrderHow", ("ASC", "DESC"))
 Order = namedtuple("Order", ("by", "how"))
 
 
-def build_paginated_host_list_response(total, page, per_page, host_list, additional_fields=tuple()):
+def build_paginated_host_list_response(
+    total, page, per_page, host_list, additional_fields=tuple(), next_cursor=None, count_strategy=None
+):
     timestamps = staleness_timestamps()
     json_host_list = [serialize_host(host, timestamps, DEFAULT_FIELDS + additional_fields) for host in host_list]
-    return {
+    response = {
         "total": total,
         "count": len(json_host_list),
         "page": page,
         "per_page": per_page,
         "results": json_host_list,
     }
+    if next_cursor:
+        response["next_cursor"] = next_cursor
+    if count_strategy:
+        response["count_strategy"] = count_strategy.name
+    return response
 
 
 def staleness_timestamps():
@@ -1,19 +1,32 @@
+import json
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
 from uuid import UUID
 
 import flask
+from dateutil.parser import isoparse
 from sqlalchemy import and_
+from sqlalchemy import column
+from sqlalchemy import func
 from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy.orm import defer
 
+from api.filtering.db_filters import build_system_profile_filter
 from app.auth import get_current_identity
+from app.exceptions import ValidationException
 from app.instrumentation import log_get_host_list_succeeded
 from app.logging import get_logger
 from app.models import Host
 from app.utils import Tag
+from lib.host_count import count_hosts
+from lib.host_count import CountStrategy
 from lib.host_repository import find_hosts_by_staleness
 from lib.host_repository import single_canonical_fact_host_query
 from lib.host_repository import update_query_for_owner_id
 
-__all__ = ("get_host_list", "params_to_order_by")
+__all__ = ("get_host_list", "params_to_order_by", "sparse_system_profile_hosts", "sparse_system_profile_query")
 
 NULL = None
 
@@ -36,9 +49,13 @@ def get_host_list(
     registered_with,
     filter,
     fields,
+    cursor=None,
+    count_strategy=None,
 ):
-    if filter:
-        flask.abort(503)
+    # Only the ordering by (modified_on, id) can be continued by a cursor.
+    keyset_ordering = order_by in (None, "updated")
+    if cursor and not keyset_ordering:
+        raise ValueError("Cursor pagination is supported only for the hosts ordered by updated.")
 
     if fqdn:
         query = _find_hosts_by_canonical_fact("fqdn", fqdn)
@@ -61,14 +78,114 @@ def get_host_list(
     if registered_with:
         query = find_hosts_with_insights_enabled(query)
 
-    order_by = params_to_order_by(order_by, order_how)
-    query = query.order_by(*order_by)
-    query_results = query.paginate(page, per_page, True)
+    for key in filter or {}:
+        if key == "system_profile":
+            query = query.filter(*build_system_profile_filter(filter["system_profile"]))
+        else:
+            raise ValidationException("filter key is invalid")
+
+    page_query = query.order_by(*params_to_order_by(order_by, order_how))
+    if cursor:
+        # The page starts right after the cursor, the index on (modified_on, id) is scanned from there.
+        page_query = page_query.filter(_after_cursor(cursor, order_how))
+    else:
+        page_query = page_query.offset((page - 1) * per_page)
+
     additional_fields = tuple()
+    system_profile_fields = (fields or {}).get("system_profile")
+    if system_profile_fields:
+        additional_fields = ("system_profile",)
+        page_query = sparse_system_profile_query(page_query, system_profile_fields)
+
+    # One more host tells whether there is a next page, the total may be only an estimate.
+    items = page_query.limit(per_page + 1).all()
+    if system_profile_fields:
+        items = sparse_system_profile_hosts(items)
+    if not items and page > 1 and not cursor:
+        flask.abort(404)
+    has_next = len(items) > per_page
+    items = items[:per_page]
+
+    identity = get_current_identity()
+    # The query is not a usable cache key, the staleness timestamps it is bound to change with every request.
+    count_filters = (
+        (getattr(identity, "system", None) or {}).get("cn"),
+        fqdn,
+        display_name,
+        hostname_or_id,
+        insights_id,
+        tuple(tags or ()),
+        tuple(staleness or ()),
+        registered_with,
+        json.dumps(filter, sort_keys=True) if filter else None,
+    )
+    count_strategy = CountStrategy[count_strategy] if count_strategy else CountStrategy.exact
+    total = count_hosts(query, identity.account_number, count_filters, count_strategy)
+    next_cursor = _encode_cursor(items[-1], order_how) if keyset_ordering and has_next else None
+
+    log_get_host_list_succeeded(logger, items)
+
+    return items, total, additional_fields, next_cursor, count_strategy
+
+
+def _cursor_direction(order_how):
+    # The hosts are ordered by the latest modification first by default.
+    return order_how or "DESC"
+
+
+def _encode_cursor(host, order_how):
+    # The cursor carries the ordering direction, a position is meaningless in the other one.
+    position = json.dumps([_cursor_direction(order_how), host.modified_on.isoformat(), str(host.id)])
+    return urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        direction, modified_on, host_id = json.loads(urlsafe_b64decode(cursor.encode("ascii")))
+        return direction, isoparse(modified_on), UUID(host_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor.")
+
+
+def _after_cursor(cursor, order_how):
+    direction, modified_on, host_id = _decode_cursor(cursor)
+    if direction != _cursor_direction(order_how):
+        raise ValueError("The cursor was issued for another order_how, use the same one for all the pages.")
+
+    if order_how == "ASC":
+        # The id is ordered descending regardless of the modified_on direction.
+        return or_(Host.modified_on > modified_on, and_(Host.modified_on == modified_on, Host.id < host_id))
+    return tuple_(Host.modified_on, Host.id) < tuple_(modified_on, host_id)
+
+
+def sparse_system_profile_query(query, system_profile_fields):
+    """
+    Selects only the requested top-level keys of the system profile along with every host, the whole
+    system_profile_facts is not loaded. The rows are turned back to hosts by sparse_system_profile_hosts.
+    """
+    key, value = column("key"), column("value")
+    system_profile = (
+        select([func.jsonb_object_agg(key, value)])
+        .select_from(func.jsonb_each(Host.system_profile_facts))
+        .where(key.in_(list(system_profile_fields)))
+        .as_scalar()
+    )
+    return query.options(defer(Host.system_profile_facts)).add_columns(system_profile)
+
+
+def sparse_system_profile_hosts(rows):
+    return [_SparseSystemProfileHost(host, system_profile) for host, system_profile in rows]
+
 
-    log_get_host_list_succeeded(logger, query_results.items)
+class _SparseSystemProfileHost:
+    # Reads like the host, but with only the selected system profile keys. The host itself may already be loaded
+    # in the session with its whole system profile, it is left untouched.
+    def __init__(self, host, system_profile_facts):
+        self._host = host
+        self.system_profile_facts = system_profile_facts or {}
 
-    return query_results.items, query_results.total, additional_fields
+    def __getattr__(self, name):
+        return getattr(self._host, name)
 
 
 def find_hosts_with_insights_enabled(query):
@@ -90,7 +90,12 @@ def get_host_list(
     registered_with,
     filter,
     fields,
+    cursor=None,
+    count_strategy=None,
 ):
+    if cursor:
+        raise ValueError("Cursor pagination is not supported by the xjoin query source.")
+
     limit, offset = pagination_params(page, per_page)
     xjoin_order_by, xjoin_order_how = _params_to_order(param_order_by, param_order_how)
 
@@ -131,7 +136,8 @@ def get_host_list(
     total = response["meta"]["total"]
     check_pagination(offset, total)
 
-    return map(deserialize_host, response["data"]), total, additional_fields
+    # The total is always part of the xjoin response, there is no count to choose a strategy for.
+    return map(deserialize_host, response["data"]), total, additional_fields, None, None
 
 
 def _params_to_order(param_order_by=None, param_order_how=None):
@@ -200,6 +200,7 @@ def create_app(runtime_environment):
         )
 
     payload_tracker.init_payload_tracker(app_config, producer=payload_tracker_producer)
+    register_shutdown(payload_tracker.flush_payload_tracker, "Flushing payload tracker")
 
     # HTTP request metrics
     if runtime_environment.metrics_endpoint_enabled:
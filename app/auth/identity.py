@@ -1,10 +1,15 @@
 import os
+import threading
 from base64 import b64decode
+from collections import OrderedDict
 from enum import Enum
 from json import loads
+from types import MappingProxyType
 
 from app.logging import get_logger
 from app.logging import threadctx
+from lib.metrics import identity_cache_hit
+from lib.metrics import identity_cache_miss
 
 
 __all__ = ["Identity", "from_auth_header", "from_bearer_token"]
@@ -12,12 +17,20 @@ __all__ = ["Identity", "from_auth_header", "from_bearer_token"]
 logger = get_logger(__name__)
 
 SHARED_SECRET_ENV_VAR = "INVENTORY_SHARED_SECRET"
+IDENTITY_CACHE_SIZE_ENV_VAR = "INVENTORY_IDENTITY_CACHE_SIZE"
 
 
 def from_auth_header(base64):
+    identity = _IDENTITY_CACHE.get(base64)
+    # A cached identity is not constructed again, so the account number of the current thread is set here.
+    threadctx.account_number = identity.account_number
+    return identity
+
+
+def _decode_auth_header(base64):
     json = b64decode(base64)
     identity_dict = loads(json)
-    return Identity(identity_dict["identity"])
+    return FrozenIdentity(identity_dict["identity"])
 
 
 def from_bearer_token(token):
@@ -125,6 +138,70 @@ class Identity:
         return self.account_number == other.account_number
 
 
+class FrozenIdentity(Identity):
+    """
+    An Identity that cannot be modified, so the same object can be shared by all the requests and messages carrying
+    the same identity header. The user and system details are read-only mappings.
+    """
+
+    def __init__(self, obj):
+        identity = Identity(obj)
+        self.__dict__.update(
+            {
+                name: MappingProxyType(value) if isinstance(value, dict) else value
+                for name, value in vars(identity).items()
+            }
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Cannot set {name}, the identity is frozen.")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Cannot delete {name}, the identity is frozen.")
+
+
+class IdentityCache:
+    """
+    A bounded LRU cache of the identities decoded from the Base64 identity headers, keyed by the raw header value.
+    Only valid identities are cached, invalid headers are decoded and rejected every time.
+    """
+
+    def __init__(self, size, decode=_decode_auth_header):
+        self._size = size
+        self._decode = decode
+        self._identities = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._identities)
+
+    def get(self, base64):
+        with self._lock:
+            identity = self._identities.get(base64)
+            if identity is not None:
+                self._identities.move_to_end(base64)
+
+        if identity is not None:
+            identity_cache_hit.inc()
+            return identity
+
+        identity_cache_miss.inc()
+        identity = self._decode(base64)
+        if self._size > 0:
+            with self._lock:
+                self._identities[base64] = identity
+                if len(self._identities) > self._size:
+                    self._identities.popitem(last=False)
+        return identity
+
+    def clear(self):
+        with self._lock:
+            self._identities.clear()
+
+
+_IDENTITY_CACHE = IdentityCache(int(os.getenv(IDENTITY_CACHE_SIZE_ENV_VAR, "1024")))
+
+
 # Messages from the system_profile topic don't need to provide a real Identity,
 # So this helper function creates a basic User-type identity from the host data.
 def create_mock_identity_from_host(host):
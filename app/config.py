@@ -49,8 +49,14 @@ class Config:
             os.environ.get("KAFKA_SYSTEM_PROFILE_TOPIC", "platform.inventory.system-profile")
         )
         self.kafka_consumer_topic = topic(os.environ.get("KAFKA_CONSUMER_TOPIC", "platform.inventory.host-ingress"))
+        consumer_topics = os.environ.get("KAFKA_CONSUMER_TOPICS")
+        self.kafka_consumer_topics = (
+            [topic(t.strip()) for t in consumer_topics.split(",")] if consumer_topics else [self.kafka_consumer_topic]
+        )
         self.event_topic = topic("platform.inventory.events")
         self.payload_tracker_kafka_topic = topic("platform.payload-status")
+        dead_letter_topic = os.environ.get("KAFKA_DEAD_LETTER_TOPIC")
+        self.dead_letter_topic = topic(dead_letter_topic) if dead_letter_topic else None
         if broker_cfg.sasl:
             self.kafka_ssl_cafile = self._kafka_ca(broker_cfg.cacert)
             self.kafka_sasl_username = broker_cfg.sasl.username
@@ -75,9 +81,14 @@ class Config:
         )
         self.system_profile_topic = os.environ.get("KAFKA_SYSTEM_PROFILE_TOPIC", "platform.inventory.system-profile")
         self.kafka_consumer_topic = os.environ.get("KAFKA_CONSUMER_TOPIC", "platform.inventory.host-ingress")
+        consumer_topics = os.environ.get("KAFKA_CONSUMER_TOPICS")
+        self.kafka_consumer_topics = (
+            [t.strip() for t in consumer_topics.split(",")] if consumer_topics else [self.kafka_consumer_topic]
+        )
         self.bootstrap_servers = os.environ.get("KAFKA_BOOTSTRAP_SERVERS", "localhost:29092")
         self.event_topic = os.environ.get("KAFKA_EVENT_TOPIC", "platform.inventory.events")
         self.payload_tracker_kafka_topic = os.environ.get("PAYLOAD_TRACKER_KAFKA_TOPIC", "platform.payload-status")
+        self.dead_letter_topic = os.environ.get("KAFKA_DEAD_LETTER_TOPIC")
         self._db_ssl_cert = os.getenv("INVENTORY_DB_SSL_CERT", "")
         self.kafka_ssl_cafile = os.environ.get("KAFKA_SSL_CAFILE")
         self.kafka_sasl_username = os.environ.get("KAFKA_SASL_USERNAME", "")
@@ -109,8 +120,56 @@ class Config:
         self.rbac_retries = os.environ.get("RBAC_RETRIES", 2)
         self.rbac_timeout = os.environ.get("RBAC_TIMEOUT", 10)
 
+        # The totals counted with the "cached" count strategy of the host list are kept for this many seconds.
+        self.host_count_cache_ttl = int(os.environ.get("INVENTORY_HOST_COUNT_CACHE_TTL", "30"))
+
         self.host_ingress_consumer_group = os.environ.get("KAFKA_HOST_INGRESS_GROUP", "inventory-mq")
         self.sp_validator_max_messages = int(os.environ.get("KAFKA_SP_VALIDATOR_MAX_MESSAGES", "10000"))
+        # In batch mode all messages from a single poll are written in one DB transaction and the consumer
+        # offsets are committed manually once the transaction is committed.
+        self.mq_batch_mode = os.environ.get("INVENTORY_MQ_BATCH_MODE", "false").lower() == "true"
+        # Consecutive messages of a batch for the same host are merged in memory, the host is written once and
+        # a single event with its final state is produced.
+        self.mq_batch_coalesce = os.environ.get("INVENTORY_MQ_BATCH_COALESCE", "false").lower() == "true"
+        # The existing hosts of a batch are looked up together, in a constant number of queries, the first time one
+        # of them is needed. A message whose host an earlier message of the batch may have changed is looked up again.
+        self.mq_batch_prefetch_hosts = os.environ.get("INVENTORY_MQ_BATCH_PREFETCH_HOSTS", "false").lower() == "true"
+        # With more than one worker the messages are processed in a pool of threads. Messages with the same dispatch
+        # key ("partition" or "host") are always handled by the same worker, in order.
+        self.mq_worker_count = int(os.environ.get("INVENTORY_MQ_WORKER_COUNT", "1"))
+        self.mq_worker_queue_size = int(os.environ.get("INVENTORY_MQ_WORKER_QUEUE_SIZE", "100"))
+        self.mq_worker_dispatch_key = os.environ.get("INVENTORY_MQ_WORKER_DISPATCH_KEY", "partition")
+        # With more than one consumer topic (KAFKA_CONSUMER_TOPICS), every topic is processed in its own lane of
+        # workers. The worker counts of the lanes are listed in the order of the topics, a lane without a count gets
+        # INVENTORY_MQ_WORKER_COUNT workers.
+        lane_worker_counts = os.environ.get("INVENTORY_MQ_LANE_WORKER_COUNTS")
+        lane_worker_counts = [int(count) for count in lane_worker_counts.split(",")] if lane_worker_counts else []
+        self.mq_lane_worker_counts = {
+            topic: lane_worker_counts[index] if index < len(lane_worker_counts) else self.mq_worker_count
+            for index, topic in enumerate(self.kafka_consumer_topics)
+        }
+        # A host re-reported with the same content by the same reporter only gets its staleness refreshed, without
+        # a full row rewrite. The updated event is left out too, unless the stale timestamp or reporter has changed.
+        self.skip_unchanged_host_updates = (
+            os.environ.get("INVENTORY_SKIP_UNCHANGED_HOST_UPDATES", "false").lower() == "true"
+        )
+        # Hosts with an elevated canonical fact are created or updated by a single INSERT ... ON CONFLICT statement.
+        # Enable it only after utils/create_host_upsert_indexes.py has built the unique indexes it relies on.
+        self.host_upsert = os.environ.get("INVENTORY_HOST_UPSERT", "false").lower() == "true"
+        # The deduplication searches the host_canonical_facts lookup table instead of the canonical facts of the hosts.
+        # Enable it only once the table is complete: after all the pods run a version maintaining it and
+        # utils/sync_host_canonical_facts.py caught up with the hosts written by the older ones.
+        self.host_canonical_facts_lookup = (
+            os.environ.get("INVENTORY_HOST_CANONICAL_FACTS_LOOKUP", "false").lower() == "true"
+        )
+        # The consumed partitions are paused while the event producer has more records waiting for a broker
+        # acknowledgement than the high watermark, and resumed once they drop to the low watermark. 0 disables it.
+        self.mq_backpressure_high_watermark = int(os.environ.get("INVENTORY_MQ_BACKPRESSURE_HIGH_WATERMARK", "0"))
+        self.mq_backpressure_low_watermark = int(
+            os.environ.get("INVENTORY_MQ_BACKPRESSURE_LOW_WATERMARK", str(self.mq_backpressure_high_watermark // 2))
+        )
+        # Messages taking longer than this many seconds to process are logged with their stage timings. 0 disables it.
+        self.mq_slow_message_threshold = float(os.environ.get("INVENTORY_MQ_SLOW_MESSAGE_THRESHOLD", "0"))
 
         self.prometheus_pushgateway = os.environ.get("PROMETHEUS_PUSHGATEWAY", "localhost:9091")
         self.kubernetes_namespace = os.environ.get("NAMESPACE")
@@ -135,6 +194,9 @@ class Config:
             "max_poll_interval_ms": int(os.environ.get("KAFKA_CONSUMER_MAX_POLL_INTERVAL_MS", "300000")),
             "session_timeout_ms": int(os.environ.get("KAFKA_CONSUMER_SESSION_TIMEOUT_MS", "10000")),
             "heartbeat_interval_ms": int(os.environ.get("KAFKA_CONSUMER_HEARTBEAT_INTERVAL_MS", "3000")),
+            "enable_auto_commit": not self.mq_batch_mode
+            and self.mq_worker_count == 1
+            and len(self.kafka_consumer_topics) == 1,
             **self.kafka_ssl_configs,
         }
 
@@ -165,11 +227,29 @@ class Config:
             **self.kafka_ssl_configs,
         }
 
+        # The aggregate delivery accounting counts the produced events instead of logging every one of them. A summary
+        # is logged every summary interval (seconds), events that could not be produced are still logged one by one.
+        self.event_producer_aggregate_delivery = (
+            os.environ.get("EVENT_PRODUCER_AGGREGATE_DELIVERY", "false").lower() == "true"
+        )
+        self.event_producer_summary_interval = float(os.environ.get("EVENT_PRODUCER_SUMMARY_INTERVAL", "60"))
+
         self.payload_tracker_kafka_producer = {"bootstrap_servers": self.bootstrap_servers, **self.kafka_ssl_configs}
 
         self.payload_tracker_service_name = os.environ.get("PAYLOAD_TRACKER_SERVICE_NAME", "inventory")
         payload_tracker_enabled = os.environ.get("PAYLOAD_TRACKER_ENABLED", "true")
         self.payload_tracker_enabled = payload_tracker_enabled.lower() == "true"
+        # Only the final status of every payload is sent with terminal status only.
+        self.payload_tracker_terminal_status_only = (
+            os.environ.get("PAYLOAD_TRACKER_TERMINAL_STATUS_ONLY", "false").lower() == "true"
+        )
+        # The async payload tracker serializes and sends the messages in a background thread. Only the given share of
+        # the payloads gets its success statuses sent and the oldest messages are dropped when the queue is full.
+        self.payload_tracker_async = os.environ.get("PAYLOAD_TRACKER_ASYNC", "false").lower() == "true"
+        self.payload_tracker_queue_size = int(os.environ.get("PAYLOAD_TRACKER_QUEUE_SIZE", "10000"))
+        self.payload_tracker_success_sample_rate = float(os.environ.get("PAYLOAD_TRACKER_SUCCESS_SAMPLE_RATE", "1"))
+        # Seconds the shutdown waits for the queued messages to be handed over to the producer.
+        self.payload_tracker_flush_timeout = float(os.environ.get("PAYLOAD_TRACKER_FLUSH_TIMEOUT", "10"))
 
         self.culling_stale_warning_offset_delta = timedelta(
             days=int(os.environ.get("CULLING_STALE_WARNING_OFFSET_DAYS", "7")),
@@ -259,6 +339,7 @@ class Config:
             self.logger.info("RBAC Endpoint: %s", self.rbac_endpoint)
             self.logger.info("RBAC Retry Times: %s", self.rbac_retries)
             self.logger.info("RBAC Timeout Seconds: %s", self.rbac_timeout)
+            self.logger.info("Host Count Cache TTL: %s", self.host_count_cache_ttl)
 
         if self._runtime_environment == RuntimeEnvironment.SERVICE or self._runtime_environment.event_producer_enabled:
             self.logger.info("Kafka Bootstrap Servers: %s", self.bootstrap_servers)
@@ -267,12 +348,29 @@ class Config:
                 self.logger.info("Kafka Host Ingress Topic: %s", self.host_ingress_topic)
                 self.logger.info("Kafka System Profile Topic: %s", self.system_profile_topic)
                 self.logger.info("Kafka Consumer Topic: %s", self.kafka_consumer_topic)
+                self.logger.info("Kafka Consumer Topics: %s", self.kafka_consumer_topics)
                 self.logger.info("Kafka Consumer Group: %s", self.host_ingress_consumer_group)
+                self.logger.info("MQ Batch Mode: %s", self.mq_batch_mode)
+                self.logger.info("MQ Batch Coalesce: %s", self.mq_batch_coalesce)
+                self.logger.info("MQ Batch Prefetch Hosts: %s", self.mq_batch_prefetch_hosts)
+                self.logger.info("MQ Worker Count: %s", self.mq_worker_count)
+                self.logger.info("MQ Worker Dispatch Key: %s", self.mq_worker_dispatch_key)
+                self.logger.info("MQ Lane Worker Counts: %s", self.mq_lane_worker_counts)
+                self.logger.info("Skip Unchanged Host Updates: %s", self.skip_unchanged_host_updates)
+                self.logger.info("Host Upsert: %s", self.host_upsert)
+                self.logger.info("Host Canonical Facts Lookup: %s", self.host_canonical_facts_lookup)
+                self.logger.info("MQ Backpressure High Watermark: %s", self.mq_backpressure_high_watermark)
+                self.logger.info("MQ Backpressure Low Watermark: %s", self.mq_backpressure_low_watermark)
+                self.logger.info("MQ Slow Message Threshold: %s", self.mq_slow_message_threshold)
                 self.logger.info("Kafka Events Topic: %s", self.event_topic)
+                self.logger.info("Kafka Dead Letter Topic: %s", self.dead_letter_topic)
 
             if self._runtime_environment.event_producer_enabled:
                 self.logger.info("Kafka Event Topic: %s", self.event_topic)
 
+            self.logger.info("Event Producer Aggregate Delivery: %s", self.event_producer_aggregate_delivery)
+            self.logger.info("Event Producer Summary Interval: %s", self.event_producer_summary_interval)
+
         if self._runtime_environment == RuntimeEnvironment.PENDO_JOB:
             self.logger.info("Pendo Sync Active: %s", self.pendo_sync_active)
             self.logger.info("Pendo Endpoint: %s", self.pendo_endpoint)
@@ -284,6 +382,11 @@ class Config:
             self.logger.info("Payload Tracker Kafka Topic: %s", self.payload_tracker_kafka_topic)
             self.logger.info("Payload Tracker Service Name: %s", self.payload_tracker_service_name)
             self.logger.info("Payload Tracker Enabled: %s", self.payload_tracker_enabled)
+            self.logger.info("Payload Tracker Terminal Status Only: %s", self.payload_tracker_terminal_status_only)
+            self.logger.info("Payload Tracker Async: %s", self.payload_tracker_async)
+            self.logger.info("Payload Tracker Queue Size: %s", self.payload_tracker_queue_size)
+            self.logger.info("Payload Tracker Success Sample Rate: %s", self.payload_tracker_success_sample_rate)
+            self.logger.info("Payload Tracker Flush Timeout: %s", self.payload_tracker_flush_timeout)
 
         if self._runtime_environment.metrics_pushgateway_enabled:
             self.logger.info("Metrics Pushgateway: %s", self.prometheus_pushgateway)
@@ -1,7 +1,10 @@
 import json
+from contextlib import contextmanager
+from time import perf_counter
 
 from flask import g
 
+from app.logging import threadctx
 from app.queue import metrics
 from app.queue.metrics import event_producer_failure
 from app.queue.metrics import event_producer_success
@@ -44,6 +47,35 @@ def message_not_produced(logger, topic, value, key, headers, error):
     event_producer_failure.labels(event_type=headers["event_type"], topic=topic).inc()
 
 
+def dead_letter_produced(logger, value, key, headers, record_metadata):
+    extra = {
+        "status": "PRODUCED",
+        "offset": record_metadata.offset,
+        "topic": record_metadata.topic,
+        "key": key,
+        "headers": headers,
+    }
+    logger.info(
+        "Dead letter produced offset=%d topic=%s key=%s headers=%s",
+        record_metadata.offset,
+        record_metadata.topic,
+        key,
+        headers,
+        extra=extra,
+    )
+    logger.debug("Dead letter value=%s", value, extra={**extra, "value": value})
+
+
+def dead_letter_not_produced(logger, topic, value, key, headers, error):
+    extra = {"status": "NOT PRODUCED", "topic": topic, "key": key, "headers": headers, "error": str(error)}
+    logger.error(
+        "Dead letter NOT PRODUCED topic=%s key=%s headers=%s error=%s", topic, key, headers, error, extra=extra
+    )
+    logger.debug("Dead letter value=%s", value, extra={**extra, "value": value})
+
+    metrics.ingress_message_dead_letter_failure.inc()
+
+
 def get_control_rule():
     if hasattr(g, "access_control_rule"):
         return g.access_control_rule
@@ -184,3 +216,46 @@ def log_db_access_failure(logger, message, host_data):
 def pendo_failure(logger, error_message=None):
     logger.error("Failed to send Pendo data: %s", error_message)
     pendo_fetching_failure.inc()
+
+
+# ingress message stages
+def start_stage_timings():
+    threadctx.stage_timings = {}
+    threadctx.nested_stage_time = 0.0
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Adds the time spent in a stage to the stage timings of the message being processed. Stages can be nested,
+    the time spent in a nested stage is not counted in the enclosing one.
+    """
+    stage_timings = getattr(threadctx, "stage_timings", None)
+    if stage_timings is None:
+        yield
+        return
+
+    enclosing_nested_stage_time = threadctx.nested_stage_time
+    threadctx.nested_stage_time = 0.0
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        stage_timings[stage] = stage_timings.get(stage, 0.0) + elapsed - threadctx.nested_stage_time
+        threadctx.nested_stage_time = enclosing_nested_stage_time + elapsed
+
+
+def observe_stage_timings(logger, reporter, duration, slow_message_threshold=None):
+    stage_timings = getattr(threadctx, "stage_timings", {})
+    reporter = reporter or "null"
+    for stage, seconds in stage_timings.items():
+        metrics.ingress_message_stage_time.labels(stage, reporter).observe(seconds)
+
+    if slow_message_threshold and duration >= slow_message_threshold:
+        logger.warning(
+            "Slow message processed in %.3f s: %s",
+            duration,
+            ", ".join(f"{stage}={seconds:.3f}" for stage, seconds in stage_timings.items()),
+            extra={"reporter": reporter, "duration": duration, "stage_timings": stage_timings},
+        )
@@ -1,16 +1,21 @@
+import hashlib
+import json
+import threading
 import uuid
 from collections import namedtuple
-from copy import deepcopy
+from collections import OrderedDict
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from enum import Enum
 from os.path import join
 
-from connexion.decorators.validation import coerce_type
+from connexion.decorators.validation import TYPE_MAP
 from flask_sqlalchemy import SQLAlchemy
 from jsonschema import RefResolver
-from jsonschema import validate as jsonschema_validate
 from jsonschema import ValidationError as JsonSchemaValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from marshmallow import EXCLUDE
 from marshmallow import fields
 from marshmallow import post_load
@@ -20,6 +25,7 @@ from marshmallow import validate as marshmallow_validate
 from marshmallow import validates
 from marshmallow import validates_schema
 from marshmallow import ValidationError as MarshmallowValidationError
+from sqlalchemy import false
 from sqlalchemy import Index
 from sqlalchemy import orm
 from sqlalchemy import text
@@ -28,6 +34,7 @@ from sqlalchemy.dialects.postgresql import UUID
 from yaml import safe_load
 
 from app.exceptions import InventoryException
+from app.instrumentation import stage_timer
 from app.logging import get_logger
 from app.validators import check_empty_keys
 from app.validators import verify_mac_address_format
@@ -45,6 +52,7 @@ TAG_VALUE_VALIDATION = marshmallow_validate.Length(max=255)
 
 SPECIFICATION_DIR = "./swagger/"
 SYSTEM_PROFILE_SPECIFICATION_FILE = "system_profile.spec.yaml"
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 class ProviderType(str, Enum):
@@ -70,6 +78,112 @@ def _time_now():
     return datetime.now(timezone.utc)
 
 
+def canonical_fact_pairs(canonical_facts):
+    """
+    The (name, value) pairs stored in the canonical facts lookup table. A list fact has a pair for every item, so
+    a JSONB containment of the canonical facts is a subset relation of their pairs.
+    """
+    return {
+        (name, item)
+        for name, value in canonical_facts.items()
+        for item in (value if isinstance(value, list) else (value,))
+    }
+
+
+def _content_hash(content_digest, modified_on):
+    # Tying the hash to the modification time invalidates it whenever the host is changed by anything else. The time is
+    # hashed as microseconds since the epoch, whatever time zone it is rendered in.
+    modified_on_us = (modified_on - _EPOCH) // timedelta(microseconds=1)
+    return hashlib.sha256(f"{content_digest}:{modified_on_us}".encode()).hexdigest()
+
+
+_NOT_BUILT = object()
+
+
+class _FilterPlan:
+    """
+    Allowed keys of an object, or the plan of the items of an array, precomputed from a schema. Leaves of the schema,
+    where nothing is filtered, have no plan.
+    """
+
+    __slots__ = ("properties", "items")
+
+    def __init__(self):
+        self.properties = None
+        self.items = None
+
+    def filter(self, payload):
+        if self.properties is not None:
+            if type(payload) is not dict:
+                return
+            for key in payload.keys() - self.properties.keys():
+                del payload[key]
+            for key, value in payload.items():
+                plan = self.properties[key]
+                if plan is not None:
+                    plan.filter(value)
+        elif self.items is not None:
+            if type(payload) is not list:
+                return
+            for value in payload:
+                self.items.filter(value)
+
+    def filtered(self, payload):
+        # Builds new containers only where keys can be removed, the rest of the payload is shared.
+        if self.properties is not None:
+            if type(payload) is not dict:
+                return payload
+            properties = self.properties
+            return {
+                key: value if properties[key] is None else properties[key].filtered(value)
+                for key, value in payload.items()
+                if key in properties
+            }
+        elif self.items is not None:
+            if type(payload) is not list:
+                return payload
+            return [self.items.filtered(value) for value in payload]
+        return payload
+
+
+class _CoercionPlan(namedtuple("_CoercionPlan", ("type_func", "properties"))):
+    """
+    Type conversion of a value, or of the properties of an object, precomputed from a schema. Only the properties that
+    can be converted are part of the plan.
+    """
+
+    def coerce(self, payload):
+        if type(payload) is not dict:
+            try:
+                return self.type_func(payload)
+            except (ValueError, TypeError):
+                return payload
+
+        for key, plan in self.properties.items():
+            if key in payload:
+                payload[key] = plan.coerce(payload[key])
+        return payload
+
+    def coerced(self, payload):
+        # Copies an object only when one of its properties is converted, the rest of the payload is shared.
+        if type(payload) is not dict:
+            try:
+                return self.type_func(payload)
+            except (ValueError, TypeError):
+                return payload
+
+        result = payload
+        for key, plan in self.properties.items():
+            if key in payload:
+                value = payload[key]
+                coerced = plan.coerced(value)
+                if coerced is not value:
+                    if result is payload:
+                        result = dict(payload)
+                    result[key] = coerced
+        return result
+
+
 class SystemProfileNormalizer:
     class Schema(namedtuple("Schema", ("type", "properties", "items"))):
         Types = Enum("SchemaTypes", ("array", "object"))
@@ -86,8 +200,6 @@ class SystemProfileNormalizer:
         def schema_type(self):
             return self.Types.__members__.get(self.type)
 
-    SOME_ARBITRARY_STRING = "property"
-
     def __init__(self, system_profile_schema=None):
         if system_profile_schema:
             system_profile_spec = system_profile_schema
@@ -98,40 +210,133 @@ class SystemProfileNormalizer:
 
         self.schema = {**system_profile_spec, "$ref": "#/$defs/SystemProfile"}
         self._resolver = RefResolver.from_schema(system_profile_spec)
+        self._filter_plan = _NOT_BUILT
+        self._coercion_plan = _NOT_BUILT
 
-    def filter_keys(self, payload, schema_dict=None):
-        if schema_dict is None:
-            schema_dict = self._system_profile_definition()
+        # The meta-schema check and the validator construction are done only once per specification.
+        validator_class = validator_for(self.schema)
+        validator_class.check_schema(self.schema)
+        self._validator = validator_class(self.schema, resolver=RefResolver.from_schema(self.schema))
 
-        schema_obj = self.Schema.from_dict(schema_dict, self._resolver)
-        if schema_obj.schema_type == self.Schema.Types.object:
-            self._object_filter(schema_obj, payload)
-        elif schema_obj.schema_type == self.Schema.Types.array:
-            self._array_filter(schema_obj, payload)
+    def validate(self, payload):
+        error = best_match(self._validator.iter_errors(payload))
+        if error is not None:
+            raise error
+
+    def filter_keys(self, payload, schema_dict=None):
+        plan = self._get_filter_plan(schema_dict)
+        if plan is not None:
+            plan.filter(payload)
+
+    def filtered_keys(self, payload, schema_dict=None):
+        """
+        Same as filter_keys, but leaves the payload untouched and returns the filtered copy. Only the objects and
+        arrays whose keys can be removed are copied.
+        """
+        plan = self._get_filter_plan(schema_dict)
+        return payload if plan is None else plan.filtered(payload)
 
     def coerce_types(self, payload, schema_dict=None):
-        if schema_dict is None:
-            schema_dict = self._system_profile_definition()
-        coerce_type(schema_dict, payload, self.SOME_ARBITRARY_STRING)
+        plan = self._get_coercion_plan(schema_dict)
+        if plan is not None and type(payload) is dict:
+            plan.coerce(payload)
+
+    def coerced_types(self, payload, schema_dict=None):
+        """
+        Same as coerce_types, but leaves the payload untouched and returns the coerced copy. Only the objects with
+        converted values are copied.
+        """
+        plan = self._get_coercion_plan(schema_dict)
+        if plan is None or type(payload) is not dict:
+            return payload
+        return plan.coerced(payload)
+
+    def _get_filter_plan(self, schema_dict):
+        if schema_dict is not None:
+            return self._build_filter_plan(schema_dict, {})
+
+        # The plan is built on the first use and then reused for every payload.
+        if self._filter_plan is _NOT_BUILT:
+            self._filter_plan = self._build_filter_plan(self._system_profile_definition(), {})
+        return self._filter_plan
+
+    def _get_coercion_plan(self, schema_dict):
+        if schema_dict is not None:
+            return self._build_root_coercion_plan(schema_dict)
+
+        if self._coercion_plan is _NOT_BUILT:
+            self._coercion_plan = self._build_root_coercion_plan(self._system_profile_definition())
+        return self._coercion_plan
 
     def _system_profile_definition(self):
         return self.schema["$defs"]["SystemProfile"]
 
-    def _object_filter(self, schema, payload):
-        if not schema.properties or type(payload) is not dict:
-            return
-
-        for key in payload.keys() - schema.properties.keys():
-            del payload[key]
-        for key in payload:
-            self.filter_keys(payload[key], schema.properties[key])
-
-    def _array_filter(self, schema, payload):
-        if not schema.items or type(payload) is not list:
-            return
-
-        for value in payload:
-            self.filter_keys(value, schema.items)
+    def _build_filter_plan(self, schema_dict, plans):
+        schema_obj = self.Schema.from_dict(schema_dict, self._resolver)
+        if schema_obj.schema_type == self.Schema.Types.object and schema_obj.properties:
+            nested = schema_obj.properties
+        elif schema_obj.schema_type == self.Schema.Types.array and schema_obj.items:
+            nested = schema_obj.items
+        else:
+            return None
+
+        # Recursive definitions share the plan that is already being built.
+        key = (schema_obj.type, id(nested))
+        if key not in plans:
+            plan = plans[key] = _FilterPlan()
+            if schema_obj.schema_type == self.Schema.Types.object:
+                plan.properties = {name: self._build_filter_plan(value, plans) for name, value in nested.items()}
+            else:
+                plan.items = self._build_filter_plan(nested, plans)
+        return plans[key]
+
+    @classmethod
+    def _build_root_coercion_plan(cls, schema_dict):
+        # Like connexion's coerce_type, only the properties of an object are converted in place.
+        if schema_dict.get("type") != "object" or not schema_dict.get("properties"):
+            return None
+        return cls._build_coercion_plan(schema_dict)
+
+    @classmethod
+    def _build_coercion_plan(cls, schema_dict):
+        # References are not followed, as in connexion's coerce_type.
+        type_func = TYPE_MAP.get(schema_dict.get("type"))
+        properties = {}
+        for name, value in (schema_dict.get("properties") or {}).items():
+            plan = cls._build_coercion_plan(value)
+            if plan is not None:
+                properties[name] = plan
+
+        if type_func is None and not properties:
+            return None
+        return _CoercionPlan(type_func, properties)
+
+
+# validate_sp_for_branch passes newly loaded specifications on every call, so only the recently used ones are kept.
+SYSTEM_PROFILE_NORMALIZERS_SIZE = 8
+_system_profile_normalizers = OrderedDict()
+_system_profile_normalizers_lock = threading.Lock()
+
+
+def _system_profile_normalizer(system_profile_schema):
+    """
+    Returns a normalizer for a custom system profile specification, built only once per specification object while
+    it is among the SYSTEM_PROFILE_NORMALIZERS_SIZE most recently used ones.
+    """
+    key = id(system_profile_schema)
+    with _system_profile_normalizers_lock:
+        if key in _system_profile_normalizers:
+            _system_profile_normalizers.move_to_end(key)
+            return _system_profile_normalizers[key][1]
+
+    normalizer = SystemProfileNormalizer(system_profile_schema=system_profile_schema)
+    with _system_profile_normalizers_lock:
+        # Keeping a reference to the specification prevents its id from being reused by another object while cached.
+        _system_profile_normalizers[key] = (system_profile_schema, normalizer)
+        _system_profile_normalizers.move_to_end(key)
+        while len(_system_profile_normalizers) > SYSTEM_PROFILE_NORMALIZERS_SIZE:
+            _system_profile_normalizers.popitem(last=False)
+    return normalizer
 
 
 class LimitedHost(db.Model):
@@ -143,6 +348,12 @@ class LimitedHost(db.Model):
         Index("idxgincanonicalfacts", "canonical_facts"),
         Index("idxaccount", "account"),
         Index("hosts_subscription_manager_id_index", text("(canonical_facts ->> 'subscription_manager_id')")),
+        Index(
+            "hosts_system_profile_facts_gin",
+            text("(system_profile_facts - 'installed_packages') jsonb_path_ops"),
+            postgresql_using="gin",
+        ),
+        Index("hosts_account_owner_id_index", "account", text("(system_profile_facts ->> 'owner_id')")),
     )
 
     def __init__(
@@ -186,10 +397,33 @@ class LimitedHost(db.Model):
     system_profile_facts = db.Column(JSONB)
 
 
+class HostCanonicalFact(db.Model):
+    """
+    A lookup table of the canonical facts of the hosts, used by the deduplication instead of the JSONB indexes
+    on the hosts table. It is kept in sync with Host.canonical_facts and its rows are removed with the host.
+    """
+
+    __tablename__ = "host_canonical_facts"
+    __table_args__ = (
+        Index("host_canonical_facts_account_fact_host_id_idx", "account", "fact_name", "fact_value", "host_id"),
+    )
+
+    host_id = db.Column(
+        UUID(as_uuid=True), db.ForeignKey("hosts.id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True
+    )
+    fact_name = db.Column(db.String(255), primary_key=True)
+    fact_value = db.Column(db.String, primary_key=True)
+    account = db.Column(db.String(10))
+
+
 class Host(LimitedHost):
     stale_timestamp = db.Column(db.DateTime(timezone=True))
     reporter = db.Column(db.String(255))
     per_reporter_staleness = db.Column(JSONB)
+    # Set when the host no longer holds its elevated canonical facts, the host upsert unique indexes on them skip it.
+    # A culled host gives them up to a newly registered one, it is never found again and only waits for the reaper.
+    elevated_facts_released = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
+    canonical_fact_index = orm.relationship(HostCanonicalFact, cascade="all, delete-orphan", passive_deletes=True)
 
     def __init__(
         self,
@@ -220,6 +454,7 @@ class Host(LimitedHost):
         self.stale_timestamp = stale_timestamp
         self.reporter = reporter
         self._update_per_reporter_staleness(stale_timestamp, reporter)
+        self._update_canonical_fact_index()
 
     def save(self):
         self._cleanup_tags()
@@ -270,9 +505,22 @@ class Host(LimitedHost):
             self.canonical_facts,
             canonical_facts,
         )
+        original_canonical_facts = dict(self.canonical_facts)
         self.canonical_facts.update(canonical_facts)
         logger.debug("Host (id=%s) has updated canonical_facts (%s)", self.id, self.canonical_facts)
         orm.attributes.flag_modified(self, "canonical_facts")
+        # Re-reported hosts mostly keep their canonical facts, the lookup table rows are loaded only on a change.
+        if self.canonical_facts != original_canonical_facts:
+            self._update_canonical_fact_index()
+
+    def _update_canonical_fact_index(self):
+        pairs = canonical_fact_pairs(self.canonical_facts)
+        kept_rows = [row for row in self.canonical_fact_index if (row.fact_name, row.fact_value) in pairs]
+        kept_pairs = {(row.fact_name, row.fact_value) for row in kept_rows}
+        self.canonical_fact_index = kept_rows + [
+            HostCanonicalFact(account=self.account, fact_name=name, fact_value=value)
+            for name, value in sorted(pairs - kept_pairs)
+        ]
 
     def update_facts(self, facts_dict):
         if facts_dict:
@@ -304,6 +552,36 @@ class Host(LimitedHost):
     def _update_modified_date(self):
         self.modified_on = datetime.now(timezone.utc)
 
+    def reported_content_digest(self):
+        content = {
+            "account": self.account,
+            "canonical_facts": self.canonical_facts,
+            "display_name": self.display_name,
+            "ansible_host": self.ansible_host,
+            "facts": self.facts,
+            "tags": self.tags,
+            "system_profile_facts": self.system_profile_facts,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_reported_content_unchanged(self, reporter, content_digest):
+        reporter_staleness = (self.per_reporter_staleness or {}).get(reporter) or {}
+        content_hash = reporter_staleness.get("content_hash")
+        return content_hash is not None and content_hash == _content_hash(content_digest, self.modified_on)
+
+    def update_reported_content_hash(self, reporter, content_digest):
+        self._update_modified_date()
+        self.per_reporter_staleness[reporter]["content_hash"] = _content_hash(content_digest, self.modified_on)
+        orm.attributes.flag_modified(self, "per_reporter_staleness")
+
+    def refresh_staleness(self, stale_timestamp, reporter):
+        self._update_stale_timestamp(stale_timestamp, reporter)
+        self._update_per_reporter_staleness(stale_timestamp, reporter)
+        # Keeps the modification time, the reported content is the same. A modification not flushed yet, by an earlier
+        # update coalesced with this one, is kept too, the content hash is tied to its time.
+        if not orm.attributes.get_history(self, "modified_on").has_changes():
+            self.modified_on = Host.__table__.c.modified_on
+
     def replace_facts_in_namespace(self, namespace, facts_dict):
         self.facts[namespace] = facts_dict
         orm.attributes.flag_modified(self, "facts")
@@ -481,7 +759,7 @@ class LimitedHostSchema(CanonicalFactsSchema):
         if not hasattr(cls, "system_profile_normalizer"):
             cls.system_profile_normalizer = SystemProfileNormalizer()
         if system_profile_schema:
-            self.system_profile_normalizer = SystemProfileNormalizer(system_profile_schema=system_profile_schema)
+            self.system_profile_normalizer = _system_profile_normalizer(system_profile_schema)
 
     @validates("tags")
     def validate_tags(self, tags):
@@ -527,9 +805,9 @@ class LimitedHostSchema(CanonicalFactsSchema):
         if "system_profile" not in data:
             return data
 
-        system_profile = deepcopy(data["system_profile"])
-        normalize(system_profile)
-        return {**data, "system_profile": system_profile}
+        # The input is not modified, the normalized system profile shares the unchanged parts with it.
+        with stage_timer("normalization"):
+            return {**data, "system_profile": normalize(data["system_profile"])}
 
     @staticmethod
     def build_model(data, canonical_facts, facts, tags):
@@ -545,16 +823,17 @@ class LimitedHostSchema(CanonicalFactsSchema):
 
     @pre_load
     def coerce_system_profile_types(self, data, **kwargs):
-        return self._normalize_system_profile(self.system_profile_normalizer.coerce_types, data)
+        return self._normalize_system_profile(self.system_profile_normalizer.coerced_types, data)
 
     @post_load
     def filter_system_profile_keys(self, data, **kwargs):
-        return self._normalize_system_profile(self.system_profile_normalizer.filter_keys, data)
+        return self._normalize_system_profile(self.system_profile_normalizer.filtered_keys, data)
 
     @validates("system_profile")
     def system_profile_is_valid(self, system_profile):
         try:
-            jsonschema_validate(system_profile, self.system_profile_normalizer.schema)
+            with stage_timer("validation"):
+                self.system_profile_normalizer.validate(system_profile)
         except JsonSchemaValidationError as error:
             raise MarshmallowValidationError(f"System profile does not conform to schema.\n{error}") from error
 
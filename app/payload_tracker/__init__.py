@@ -1,6 +1,11 @@
 import abc
 import json
+import threading
+import zlib
+from collections import deque
+from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 
 from kafka import KafkaProducer
 
@@ -11,12 +16,20 @@ logger = get_logger(__name__)
 
 _CFG = None
 _PRODUCER = None
+_COALESCER = None
+_SENDER = None
 _UNKNOWN_REQUEST_ID = "-1"
+_TERMINAL_STATUSES = ("success", "error")
+_SUCCESS_STATUSES = ("success", "processing_success")
+_MAX_PENDING_REQUESTS = 10000
+_FLUSH_TIMEOUT = 10
 
 
 def init_payload_tracker(config, producer=None):
     global _CFG
     global _PRODUCER
+    global _COALESCER
+    global _SENDER
 
     _CFG = config
 
@@ -27,12 +40,45 @@ def init_payload_tracker(config, producer=None):
         logger.info("Starting KafkaProducer() for PayloadTracker")
         _PRODUCER = KafkaProducer(**config.payload_tracker_kafka_producer)
 
+    flush_payload_tracker()
+    if _SENDER:
+        _SENDER.close()
+
+    if config.payload_tracker_async:
+        _SENDER = PayloadTrackerSender(
+            _PRODUCER,
+            config.payload_tracker_queue_size,
+            config.payload_tracker_success_sample_rate,
+            config.payload_tracker_flush_timeout,
+        )
+        _SENDER.start()
+        send_message = _SENDER.add
+    else:
+        _SENDER = None
+        send_message = partial(_produce_message, _PRODUCER)
+
+    if config.payload_tracker_terminal_status_only:
+        _COALESCER = PayloadTrackerCoalescer(send_message)
+    else:
+        _COALESCER = None
+
+
+def flush_payload_tracker():
+    if _SENDER:
+        _SENDER.flush()
+
 
 def get_payload_tracker(account=None, request_id=None):
 
     if _CFG.payload_tracker_enabled is False or request_id is None or request_id == _UNKNOWN_REQUEST_ID:
         return NullPayloadTracker()
 
+    queue = _COALESCER or _SENDER
+    if queue:
+        return QueuedPayloadTracker(
+            queue, _CFG.payload_tracker_kafka_topic, _CFG.payload_tracker_service_name, account, request_id
+        )
+
     payload_tracker = KafkaPayloadTracker(
         _PRODUCER, _CFG.payload_tracker_kafka_topic, _CFG.payload_tracker_service_name, account, request_id
     )
@@ -40,6 +86,27 @@ def get_payload_tracker(account=None, request_id=None):
     return payload_tracker
 
 
+def _serialize_message(message):
+    try:
+        return json.dumps(message, sort_keys=True).encode("utf-8")
+    except Exception:
+        logger.exception("Error while constructing payload tracker message")
+        metrics.payload_tracker_message_construction_failure.inc()
+        return None
+
+
+def _produce_message(producer, topic, message):
+    value = _serialize_message(message)
+    if not value:
+        return
+
+    try:
+        producer.send(topic, value)
+    except Exception:
+        logger.exception("Error sending payload tracker message")
+        metrics.payload_tracker_message_send_failure.inc()
+
+
 class PayloadTracker(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def payload_received(self, status_message=None):
@@ -170,9 +237,7 @@ class KafkaPayloadTracker(PayloadTracker):
             if status_message:
                 message["status_msg"] = status_message
 
-            json_message = json.dumps(message, sort_keys=True)
-
-            return json_message
+            return message
         except Exception:
             logger.exception("Error while constructing payload tracker message")
             metrics.payload_tracker_message_construction_failure.inc()
@@ -182,11 +247,126 @@ class KafkaPayloadTracker(PayloadTracker):
         if not message:
             return
 
-        try:
-            self._producer.send(self._topic, message.encode("utf-8"))
-        except Exception:
-            logger.exception("Error sending payload tracker message")
-            metrics.payload_tracker_message_send_failure.inc()
+        _produce_message(self._producer, self._topic, message)
+
+
+class QueuedPayloadTracker(KafkaPayloadTracker):
+    """
+    Hands the status messages over to a PayloadTrackerCoalescer or a PayloadTrackerSender instead of sending them
+    right away.
+    """
+
+    def _send_message(self, message):
+        if message:
+            self._producer.add(self._topic, message)
+
+
+class PayloadTrackerCoalescer:
+    """
+    Hands only the final status (success or error) of every request over to send_message, the other statuses are
+    dropped. The final status carries the inventory ID set while processing the request; the IDs of at most
+    max_pending_requests requests waiting for their final status are kept, the oldest are dropped.
+    """
+
+    def __init__(self, send_message, max_pending_requests=_MAX_PENDING_REQUESTS):
+        self._send_message = send_message
+        self._max_pending_requests = max_pending_requests
+        self._lock = threading.Lock()
+        self._inventory_ids = OrderedDict()
+
+    def add(self, topic, message):
+        with self._lock:
+            terminal = self._coalesce(message)
+        if terminal:
+            self._send_message(topic, message)
+
+    def _coalesce(self, message):
+        # Keeps the inventory ID of a request until its final status, which is the only one to be sent.
+        request_id = message["request_id"]
+        if message["status"] not in _TERMINAL_STATUSES:
+            if "inventory_id" in message:
+                self._inventory_ids[request_id] = message["inventory_id"]
+                self._inventory_ids.move_to_end(request_id)
+                # A request that never gets its final status must not be kept forever.
+                if len(self._inventory_ids) > self._max_pending_requests:
+                    self._inventory_ids.popitem(last=False)
+            return False
+
+        inventory_id = self._inventory_ids.pop(request_id, None)
+        if inventory_id and "inventory_id" not in message:
+            message["inventory_id"] = inventory_id
+        return True
+
+
+class PayloadTrackerSender(threading.Thread):
+    """
+    Serializes and sends the payload tracker status messages in a background thread, so the request and the
+    consumer threads only put them in a queue. When the queue is full, the oldest message is dropped. Only
+    success_sample_rate of the requests get their success statuses sent; the choice is made per request, so
+    either all or none of its success statuses are sent. Flushing and closing wait for flush_timeout seconds at most.
+    """
+
+    def __init__(self, producer, queue_size, success_sample_rate=1.0, flush_timeout=_FLUSH_TIMEOUT):
+        super().__init__(name="payload-tracker-sender", daemon=True)
+        self._producer = producer
+        self._queue_size = queue_size
+        self._success_sample_rate = success_sample_rate
+        self._flush_timeout = flush_timeout
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._sending = False
+        self._closed = False
+
+    def add(self, topic, message):
+        if message["status"] in _SUCCESS_STATUSES and not self._sampled(message["request_id"]):
+            metrics.payload_tracker_message_drop.labels("sampling").inc()
+            return
+
+        with self._condition:
+            if len(self._queue) >= self._queue_size:
+                self._queue.popleft()
+                metrics.payload_tracker_message_drop.labels("overflow").inc()
+            self._queue.append((topic, message))
+            metrics.payload_tracker_queue_depth.set(len(self._queue))
+            self._condition.notify_all()
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._sending = False
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                topic, message = self._queue.popleft()
+                self._sending = True
+                metrics.payload_tracker_queue_depth.set(len(self._queue))
+
+            _produce_message(self._producer, topic, message)
+
+    def flush(self, timeout=None):
+        # Waits until all the queued messages are handed over to the producer.
+        with self._condition:
+            flushed = self._condition.wait_for(lambda: not self._queue and not self._sending, self._timeout(timeout))
+            if not flushed:
+                logger.warning("Payload tracker flush timed out with %d messages not sent", len(self._queue))
+            return flushed
+
+    def close(self, timeout=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.join(self._timeout(timeout))
+        if self.is_alive():
+            logger.warning("Payload tracker sender did not stop in time, the queued messages are not sent")
+
+    def _timeout(self, timeout):
+        return self._flush_timeout if timeout is None else timeout
+
+    def _sampled(self, request_id):
+        if self._success_sample_rate >= 1:
+            return True
+        return zlib.crc32(request_id.encode("utf-8")) / 0xFFFFFFFF < self._success_sample_rate
 
 
 class NullProducer:
@@ -1,4 +1,5 @@
 from prometheus_client import Counter
+from prometheus_client import Gauge
 
 # from prometheus_client import Summary
 
@@ -8,3 +9,9 @@ payload_tracker_message_send_failure = Counter(
 payload_tracker_message_construction_failure = Counter(
     "inventory_payload_tracker_message_construction_failure_count", "Count of failures to send to the payload tracker"
 )
+payload_tracker_queue_depth = Gauge(
+    "inventory_payload_tracker_queue_depth", "Number of messages waiting to be sent by the payload tracker sender"
+)
+payload_tracker_message_drop = Counter(
+    "inventory_payload_tracker_message_drops", "Count of payload tracker messages not sent on purpose", ["reason"]
+)
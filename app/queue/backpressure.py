@@ -0,0 +1,58 @@
+import time
+
+from app.logging import get_logger
+from app.queue import metrics
+
+__all__ = ("Backpressure",)
+
+logger = get_logger(__name__)
+
+
+class Backpressure:
+    """
+    Pauses the consumed partitions while the event producer has more records in flight than the high watermark and
+    resumes them once the producer catches up to the low watermark. The consumer keeps being polled while paused, so
+    it stays in the consumer group, it only gets no new messages.
+    """
+
+    def __init__(self, consumer, event_producer, high_watermark, low_watermark):
+        self._consumer = consumer
+        self._event_producer = event_producer
+        self._high_watermark = high_watermark
+        self._low_watermark = min(low_watermark, high_watermark)
+        self._paused_at = None
+
+    @classmethod
+    def from_config(cls, consumer, event_producer, config):
+        if not config.mq_backpressure_high_watermark:
+            return None
+        return cls(
+            consumer, event_producer, config.mq_backpressure_high_watermark, config.mq_backpressure_low_watermark
+        )
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    def check(self):
+        in_flight = self._event_producer.in_flight
+        if self.paused:
+            if in_flight <= self._low_watermark:
+                self._resume(in_flight)
+            else:
+                # Partitions assigned by a rebalance in the meantime are not paused yet.
+                self._consumer.pause(*self._consumer.assignment())
+        elif in_flight >= self._high_watermark:
+            self._pause(in_flight)
+
+    def _pause(self, in_flight):
+        logger.info("Pausing the consumer, %s events in flight", in_flight)
+        self._consumer.pause(*self._consumer.assignment())
+        self._paused_at = time.perf_counter()
+
+    def _resume(self, in_flight):
+        pause_time = time.perf_counter() - self._paused_at
+        logger.info("Resuming the consumer after %.3f s, %s events in flight", pause_time, in_flight)
+        self._consumer.resume(*self._consumer.paused())
+        self._paused_at = None
+        metrics.mq_consumer_pause_time.observe(pause_time)
@@ -1,18 +1,119 @@
+import json
+import threading
+import time
+from collections import Counter
+
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
+from sqlalchemy.exc import StatementError
 
+from app.exceptions import InventoryException
+from app.instrumentation import dead_letter_not_produced
+from app.instrumentation import dead_letter_produced
 from app.instrumentation import message_not_produced
 from app.instrumentation import message_produced
 from app.logging import get_logger
+from app.queue import metrics
 
 logger = get_logger(__name__)
 
 
+class DeliveryAccounting:
+    """
+    Counts the delivered events per topic and event type and logs a summary once per interval instead of a log record
+    for every single event.
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._produced = Counter()
+        self._not_produced = Counter()
+        self._success_metrics = {}
+        self._since = time.monotonic()
+
+    def produced(self, topic, event_type):
+        with self._lock:
+            self._produced[(topic, event_type)] += 1
+            if (topic, event_type) not in self._success_metrics:
+                self._success_metrics[(topic, event_type)] = metrics.event_producer_success.labels(
+                    event_type=event_type, topic=topic
+                )
+            success_metric = self._success_metrics[(topic, event_type)]
+        success_metric.inc()
+        self._log_summary_if_due()
+
+    def not_produced(self, topic, event_type):
+        # The failure metric is incremented by message_not_produced.
+        with self._lock:
+            self._not_produced[(topic, event_type)] += 1
+        self._log_summary_if_due()
+
+    def _log_summary_if_due(self):
+        if time.monotonic() - self._since >= self._interval:
+            self.log_summary()
+
+    def log_summary(self):
+        with self._lock:
+            produced, self._produced = self._produced, Counter()
+            not_produced, self._not_produced = self._not_produced, Counter()
+            now = time.monotonic()
+            seconds, self._since = now - self._since, now
+
+        if produced or not_produced:
+            logger.info(
+                "Produced %d events, %d events not produced in the last %.0f s",
+                sum(produced.values()),
+                sum(not_produced.values()),
+                seconds,
+                extra={"produced": self._by_topic(produced), "not_produced": self._by_topic(not_produced)},
+            )
+
+    @staticmethod
+    def _by_topic(counts):
+        by_topic = {}
+        for (topic, event_type), count in counts.items():
+            by_topic.setdefault(topic, {})[event_type] = count
+        return by_topic
+
+
 class EventProducer:
     def __init__(self, config):
         logger.info("Starting EventProducer()")
         self._kafka_producer = KafkaProducer(bootstrap_servers=config.bootstrap_servers, **config.kafka_producer)
         self.egress_topic = config.event_topic
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._delivery_accounting = (
+            DeliveryAccounting(config.event_producer_summary_interval)
+            if config.event_producer_aggregate_delivery
+            else None
+        )
+
+    @property
+    def in_flight(self):
+        """
+        Number of events sent to the Kafka producer buffer that have not been acknowledged or failed yet.
+        """
+        return self._in_flight
+
+    def _add_in_flight(self, count):
+        with self._in_flight_lock:
+            self._in_flight += count
+        metrics.event_producer_in_flight.inc(count)
+
+    def _delivered(self, *args):
+        # The delivery callbacks run in the Kafka producer I/O thread.
+        self._add_in_flight(-1)
+
+    def _produced(self, event_type, record_metadata):
+        self._add_in_flight(-1)
+        self._delivery_accounting.produced(record_metadata.topic, event_type)
+
+    def _not_produced(self, event, key, headers, error):
+        self._add_in_flight(-1)
+        self._delivery_accounting.not_produced(self.egress_topic, headers["event_type"])
+        message_not_produced(logger, self.egress_topic, event, key, headers, error)
 
     def write_event(self, event, key, headers, *, wait=False):
         logger.debug("Topic: %s, key: %s, event: %s, headers: %s", self.egress_topic, key, event, headers)
@@ -21,14 +122,21 @@ class EventProducer:
         v = event.encode("utf-8")
         h = [(hk, (hv or "").encode("utf-8")) for hk, hv in headers.items()]
 
+        self._add_in_flight(1)
         try:
             send_future = self._kafka_producer.send(self.egress_topic, key=k, value=v, headers=h)
         except KafkaError as error:
+            self._add_in_flight(-1)
             message_not_produced(logger, self.egress_topic, event, key, headers, error)
             raise error
         else:
-            send_future.add_callback(message_produced, logger, event, key, headers)
-            send_future.add_errback(message_not_produced, logger, self.egress_topic, event, key, headers)
+            if self._delivery_accounting:
+                send_future.add_callback(self._produced, headers["event_type"])
+                send_future.add_errback(self._not_produced, event, key, headers)
+            else:
+                send_future.add_both(self._delivered)
+                send_future.add_callback(message_produced, logger, event, key, headers)
+                send_future.add_errback(message_not_produced, logger, self.egress_topic, event, key, headers)
 
             if wait:
                 send_future.get()
@@ -36,3 +144,85 @@ class EventProducer:
     def close(self):
         self._kafka_producer.flush()
         self._kafka_producer.close()
+        if self._delivery_accounting:
+            self._delivery_accounting.log_summary()
+
+
+class EventBuffer:
+    """
+    Stands in for the EventProducer while a message batch is being processed. The events are held back
+    until the batch transaction is committed and then handed over to the real producer.
+    """
+
+    def __init__(self):
+        self._events = []
+
+    def __len__(self):
+        return len(self._events)
+
+    def write_event(self, event, key, headers, *, wait=False):
+        self._events.append((event, key, headers, wait))
+
+    def discard(self, mark):
+        del self._events[mark:]
+
+    def coalesce(self, mark):
+        # Only the last event written since the mark is kept, it carries the final state of the host.
+        del self._events[mark:-1]
+
+    def flush(self, event_producer):
+        for event, key, headers, wait in self._events:
+            event_producer.write_event(event, key, headers, wait=wait)
+        self._events.clear()
+
+
+def _error_message(error):
+    # The database errors render the statement with its parameters, that is the whole host. Only the message of the
+    # underlying driver error is kept.
+    if isinstance(error, StatementError) and error.orig is not None:
+        error = error.orig
+    if isinstance(error, InventoryException):
+        return str(error.detail)
+    return str(error)
+
+
+class DeadLetterProducer:
+    """
+    Writes the ingress messages that could not be processed to the dead letter topic, exactly as they were received.
+    The exception and the time spent in the processing stages are stored in the headers, so the messages can be
+    inspected and re-driven later by utils/replay_dead_letters.py.
+    """
+
+    def __init__(self, config):
+        logger.info("Starting DeadLetterProducer()")
+        self._kafka_producer = KafkaProducer(bootstrap_servers=config.bootstrap_servers, **config.kafka_producer)
+        self.topic = config.dead_letter_topic
+
+    def write_dead_letter(self, message, error, stage_timings):
+        exception = f"{type(error).__module__}.{type(error).__qualname__}"
+        headers = {
+            "exception": exception,
+            "error": _error_message(error),
+            "source_topic": message.topic,
+            "source_partition": str(message.partition),
+            "source_offset": str(message.offset),
+            "stage_timings": json.dumps(stage_timings),
+        }
+        logger.debug("Topic: %s, key: %s, headers: %s", self.topic, message.key, headers)
+
+        v = message.value.encode("utf-8")
+        h = [(hk, hv.encode("utf-8")) for hk, hv in headers.items()]
+
+        try:
+            send_future = self._kafka_producer.send(self.topic, key=message.key, value=v, headers=h)
+        except KafkaError as error:
+            # Losing the dead letter must not stop the consumer, the failure has been logged already.
+            dead_letter_not_produced(logger, self.topic, message.value, message.key, headers, error)
+        else:
+            metrics.ingress_message_dead_letter.labels(exception).inc()
+            send_future.add_callback(dead_letter_produced, logger, message.value, message.key, headers)
+            send_future.add_errback(dead_letter_not_produced, logger, self.topic, message.value, message.key, headers)
+
+    def close(self):
+        self._kafka_producer.flush()
+        self._kafka_producer.close()
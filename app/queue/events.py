@@ -5,7 +5,10 @@ from datetime import timezone
 from enum import Enum
 
 from marshmallow import fields
+from marshmallow import missing
 from marshmallow import Schema
+from marshmallow.decorators import POST_DUMP
+from marshmallow.decorators import PRE_DUMP
 
 from app.logging import threadctx
 from app.models import TagsSchema
@@ -115,11 +118,88 @@ EVENT_TYPE_MAP = {
 }
 
 
+# Fields serialized by their own _serialize method, which depends neither on the attribute name nor on the object.
+_PLAIN_FIELD_TYPES = (fields.String, fields.UUID, fields.DateTime, fields.Number, fields.Boolean)
+
+
+class EventSerializer:
+    """
+    Dumps events to exactly the same JSON as schema().dumps(event). The schema fields are resolved only once into a
+    plan of (attribute, data key, value serializer), so no schema is instantiated and no field is looked up per event.
+    """
+
+    def __init__(self, schema):
+        schema = schema()
+        self._plan = self._build_plan(schema)
+        self._render = schema.opts.render_module.dumps
+
+    def dumps(self, event):
+        return self._render(self._dump(self._plan, event))
+
+    @classmethod
+    def _build_plan(cls, schema):
+        for tag in (PRE_DUMP, POST_DUMP):
+            if schema._hooks[(tag, False)] or schema._hooks[(tag, True)]:
+                raise ValueError(f"{type(schema).__name__} has dump processors.")
+
+        return tuple(
+            (field.attribute or name, field.data_key or name, cls._value_serializer(field))
+            for name, field in schema.dump_fields.items()
+        )
+
+    @classmethod
+    def _value_serializer(cls, field):
+        if isinstance(field, fields.Nested):
+            plan = cls._build_plan(field.schema)
+            if field.many or field.schema.many:
+                return lambda value: None if value is None else [cls._dump(plan, item) for item in value]
+            return lambda value: None if value is None else cls._dump(plan, value)
+
+        if isinstance(field, fields.List):
+            serialize_item = cls._value_serializer(field.inner)
+            return lambda value: None if value is None else [serialize_item(item) for item in value]
+
+        if isinstance(field, _PLAIN_FIELD_TYPES) or (
+            isinstance(field, fields.Dict) and field.key_field is None and field.value_field is None
+        ):
+            return lambda value: field._serialize(value, None, None)
+
+        raise ValueError(f"{type(field).__name__} fields are not supported.")
+
+    @staticmethod
+    def _dump(plan, obj):
+        result = {}
+        is_dict = isinstance(obj, dict)
+        for attribute, data_key, serialize in plan:
+            # Same lookup as marshmallow: a key or else an attribute.
+            if is_dict and attribute in obj:
+                value = obj[attribute]
+            else:
+                value = getattr(obj, attribute, missing)
+            if value is not missing:
+                result[data_key] = serialize(value)
+        return result
+
+
+def _build_event_serializers():
+    serializers = {}
+    for schema in (HostCreateUpdateEvent, HostDeleteEvent):
+        try:
+            serializers[schema] = EventSerializer(schema).dumps
+        except ValueError:
+            logger.exception("Unable to precompile the %s serializer, falling back to marshmallow", schema.__name__)
+            serializers[schema] = lambda event, schema=schema: schema().dumps(event)
+    return serializers
+
+
+_EVENT_SERIALIZERS = _build_event_serializers()
+
+
 def build_event(event_type, host, **kwargs):
     with event_serialization_time.labels(event_type.name).time():
         build = EVENT_TYPE_MAP[event_type]
         schema, event = build(event_type, host, **kwargs)
-        result = schema().dumps(event)
+        result = _EVENT_SERIALIZERS[schema](event)
         return result
 
 
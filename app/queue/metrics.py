@@ -1,4 +1,6 @@
 from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import Info
 from prometheus_client import Summary
 
@@ -52,3 +54,45 @@ db_communication_error = Counter(
     "Total number of connection errors between inventory-mq and the DB",
     ["id", "reporter"],
 )
+ingress_message_batch_size = Summary(
+    "inventory_ingress_message_batch_size", "Number of messages handled in a single batch transaction"
+)
+ingress_message_batch_redrive = Counter(
+    "inventory_ingress_message_batch_redrives", "Total amount of messages re-driven outside of a batch transaction"
+)
+ingress_message_coalesced = Counter(
+    "inventory_ingress_message_coalesced",
+    "Total amount of messages merged into the write of a preceding message for the same host",
+)
+ingress_message_batch_commit_failure = Counter(
+    "inventory_ingress_message_batch_commit_failures", "Total amount of failures committing a message batch"
+)
+mq_worker_queue_depth = Gauge(
+    "inventory_mq_worker_queue_depth", "Number of messages waiting in the queue of a MQ worker", ["worker"]
+)
+mq_worker_busy_time = Counter(
+    "inventory_mq_worker_busy_seconds", "Total time a MQ worker spent processing messages", ["worker"]
+)
+mq_lane_pauses = Counter(
+    "inventory_mq_lane_pauses", "Total amount of times a topic was paused because its lane was saturated", ["topic"]
+)
+ingress_message_dead_letter = Counter(
+    "inventory_ingress_message_dead_letters",
+    "Total amount of failed ingress messages written to the dead letter topic",
+    ["exception"],
+)
+ingress_message_dead_letter_failure = Counter(
+    "inventory_ingress_message_dead_letter_failures",
+    "Total amount of failures writing failed ingress messages to the dead letter topic",
+)
+event_producer_in_flight = Gauge(
+    "inventory_event_producer_in_flight", "Number of produced events waiting for a broker acknowledgement"
+)
+mq_consumer_pause_time = Summary(
+    "inventory_mq_consumer_pause_seconds", "Time the consumed partitions spent paused by the producer backpressure"
+)
+ingress_message_stage_time = Histogram(
+    "inventory_ingress_message_stage_seconds",
+    "Time spent in a single stage of processing an ingress message",
+    ["stage", "reporter"],
+)
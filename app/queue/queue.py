@@ -1,17 +1,21 @@
-import base64
 import json
+import re
 import sys
+from contextlib import ExitStack
 from copy import deepcopy
+from time import perf_counter
 from uuid import UUID
 
 from marshmallow import fields
 from marshmallow import Schema
 from marshmallow import ValidationError
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import SQLAlchemyError
 
 from app import inventory_config
 from app import UNKNOWN_REQUEST_ID_VALUE
 from app.auth.identity import create_mock_identity_from_host
+from app.auth.identity import from_auth_header
 from app.auth.identity import Identity
 from app.auth.identity import IdentityType
 from app.culling import Timestamps
@@ -23,19 +27,32 @@ from app.instrumentation import log_add_update_host_succeeded
 from app.instrumentation import log_db_access_failure
 from app.instrumentation import log_update_system_profile_failure
 from app.instrumentation import log_update_system_profile_success
+from app.instrumentation import observe_stage_timings
+from app.instrumentation import stage_timer
+from app.instrumentation import start_stage_timings
 from app.logging import get_logger
 from app.logging import threadctx
+from app.models import db
 from app.models import LimitedHostSchema
 from app.payload_tracker import get_payload_tracker
 from app.payload_tracker import PayloadTrackerContext
 from app.payload_tracker import PayloadTrackerProcessingContext
 from app.queue import metrics
+from app.queue.backpressure import Backpressure
+from app.queue.event_producer import EventBuffer
 from app.queue.events import build_event
 from app.queue.events import message_headers
 from app.queue.events import operation_results_to_event_type
+from app.queue.worker_pool import WorkerPool
 from app.serialization import DEFAULT_FIELDS
 from app.serialization import deserialize_host
 from lib import host_repository
+from lib.db import batch_session_guard
+from lib.db import coalesced_session_guard
+from lib.db import CoalescedWrites
+from lib.db import CoalescingConflict
+from lib.db import prefetched_hosts_guard
+from lib.host_repository import AddHostResult
 
 
 logger = get_logger(__name__)
@@ -51,12 +68,13 @@ class OperationSchema(Schema):
     data = fields.Dict(required=True)
 
 
-# input is a base64 encoded utf-8 string. b64decode returns bytes, which
-# again needs decoding using ascii to get human readable dictionary
-def _decode_id(encoded_id):
-    id = base64.b64decode(encoded_id)
-    decoded_id = json.loads(id)
-    return decoded_id.get("identity")
+_OPERATION_FIELD_TYPES = {
+    "operation": (str, "Not a valid string."),
+    "platform_metadata": (dict, "Not a valid mapping type."),
+    "data": (dict, "Not a valid mapping type."),
+}
+_OPERATION_REQUIRED_FIELDS = ("operation", "data")
+_SURROGATE_ESCAPE = re.compile(r"\\u[dD][89a-fA-F]")
 
 
 # receives an uuid string w/o dashes and outputs an uuid string with dashes
@@ -67,12 +85,14 @@ def _formatted_uuid(uuid_string):
 def _get_identity(host, metadata):
     # rhsm reporter does not provide identity.  Set identity type to system for access the host in future.
     if metadata and "b64_identity" in metadata:
-        identity = _decode_id(metadata["b64_identity"])
+        # The decoded identities are cached, the same few identities repeat in most of the messages.
+        identity = from_auth_header(metadata["b64_identity"])
     else:
         if host.get("reporter") == "rhsm-conduit":
             identity = deepcopy(SYSTEM_IDENTITY)
             identity["account_number"] = host.get("account")
             identity["system"]["cn"] = _formatted_uuid(host.get("subscription_manager_id"))
+            identity = Identity(identity)
         elif metadata:
             raise ValueError(
                 "When identity is not provided, reporter MUST be rhsm-conduit with a subscription_manager_id.\n"
@@ -81,10 +101,9 @@ def _get_identity(host, metadata):
         else:
             raise ValidationException("platform_metadata is mandatory")
 
-    if host.get("account") != identity["account_number"]:
+    if host.get("account") != identity.account_number:
         raise ValidationException("The account number in identity does not match the number in the host.")
 
-    identity = Identity(identity)
     return identity
 
 
@@ -123,12 +142,47 @@ def _validate_json_object_for_utf8(json_object):
         pass
 
 
+# A surrogate code point can get into a decoded message either as a raw character, which fails to encode, or as
+# a \uXXXX escape. Only messages containing such an escape need the whole parsed object to be checked.
+def _validate_json_message_for_utf8(message, parsed_message):
+    if type(message) is str:
+        message.encode()
+        if not _SURROGATE_ESCAPE.search(message):
+            return
+
+    _validate_json_object_for_utf8(parsed_message)
+
+
+# Validates the operation envelope the same way as OperationSchema, without walking the loaded data again.
+def _load_operation(parsed_message):
+    if type(parsed_message) is not dict:
+        raise ValidationError({"_schema": ["Invalid input type."]}, data=parsed_message, valid_data={})
+
+    errors = {key: ["Unknown field."] for key in parsed_message.keys() - _OPERATION_FIELD_TYPES.keys()}
+    parsed_operation = {}
+    for field, (field_type, field_type_error) in _OPERATION_FIELD_TYPES.items():
+        if field not in parsed_message:
+            if field in _OPERATION_REQUIRED_FIELDS:
+                errors[field] = ["Missing data for required field."]
+            continue
+
+        value = parsed_message[field]
+        if value is None:
+            errors[field] = ["Field may not be null."]
+        elif not isinstance(value, field_type):
+            errors[field] = [field_type_error]
+        else:
+            parsed_operation[field] = value
+
+    if errors:
+        raise ValidationError(errors, data=parsed_message, valid_data=parsed_operation)
+
+    return parsed_operation
+
+
 @metrics.ingress_message_parsing_time.time()
 def parse_operation_message(message):
     try:
-        # Due to RHCLOUD-3610 we're receiving messages with invalid unicode code points (invalid surrogate pairs)
-        # Python pretty much ignores that but it is not possible to store such strings in the database (db INSERTS
-        # blow up)
         parsed_message = json.loads(message)
     except json.decoder.JSONDecodeError:
         # The "extra" dict cannot have a key named "msg" or "message"
@@ -138,14 +192,17 @@ def parse_operation_message(message):
         raise
 
     try:
-        _validate_json_object_for_utf8(parsed_message)
+        # Due to RHCLOUD-3610 we're receiving messages with invalid unicode code points (invalid surrogate pairs)
+        # Python pretty much ignores that but it is not possible to store such strings in the database (db INSERTS
+        # blow up)
+        _validate_json_message_for_utf8(message, parsed_message)
     except UnicodeEncodeError:
         logger.exception("Invalid Unicode sequence in message from message queue", extra={"incoming_message": message})
         metrics.ingress_message_parsing_failure.labels("invalid").inc()
         raise
 
     try:
-        parsed_operation = OperationSchema().load(parsed_message)
+        parsed_operation = _load_operation(parsed_message)
     except ValidationError as e:
         logger.error(
             "Input validation error while parsing operation message:%s", e, extra={"operation": parsed_message}
@@ -171,13 +228,15 @@ def update_system_profile(host_data, platform_metadata):
     ) as payload_tracker_processing_ctx:
 
         try:
-            input_host = deserialize_host(host_data, schema=LimitedHostSchema)
+            with stage_timer("deserialize"):
+                input_host = deserialize_host(host_data, schema=LimitedHostSchema)
             input_host.id = host_data.get("id")
             staleness_timestamps = Timestamps.from_config(inventory_config())
             identity = create_mock_identity_from_host(input_host)
-            output_host, host_id, insights_id, update_result = host_repository.update_system_profile(
-                input_host, identity, staleness_timestamps, EGRESS_HOST_FIELDS
-            )
+            with stage_timer("database"):
+                output_host, host_id, insights_id, update_result = host_repository.update_system_profile(
+                    input_host, identity, staleness_timestamps, EGRESS_HOST_FIELDS
+                )
             log_update_system_profile_success(logger, output_host)
             payload_tracker_processing_ctx.inventory_id = output_host["id"]
             return output_host, host_id, insights_id, update_result
@@ -190,6 +249,9 @@ def update_system_profile(host_data, platform_metadata):
         except OperationalError as oe:
             log_db_access_failure(logger, f"Could not access DB {str(oe)}", host_data)
             raise oe
+        except CoalescingConflict:
+            # Not a failure, the message is handled once more on its own.
+            raise
         except Exception:
             logger.exception("Error while updating host system profile", extra={"host": host_data})
             metrics.update_system_profile_failure.labels("Exception").inc()
@@ -204,17 +266,24 @@ def add_host(host_data, platform_metadata):
     ) as payload_tracker_processing_ctx:
 
         try:
-            identity = _get_identity(host_data, platform_metadata)
+            with stage_timer("identity"):
+                identity = _get_identity(host_data, platform_metadata)
             # basic-auth does not need owner_id
             if identity.identity_type == IdentityType.SYSTEM:
                 host_data = _set_owner(host_data, identity)
 
-            input_host = deserialize_host(host_data)
+            with stage_timer("deserialize"):
+                input_host = deserialize_host(host_data)
             staleness_timestamps = Timestamps.from_config(inventory_config())
             log_add_host_attempt(logger, input_host)
-            output_host, host_id, insights_id, add_result = host_repository.add_host(
-                input_host, identity, staleness_timestamps, fields=EGRESS_HOST_FIELDS
-            )
+            with stage_timer("database"):
+                output_host, host_id, insights_id, add_result = host_repository.add_host(
+                    input_host,
+                    identity,
+                    staleness_timestamps,
+                    fields=EGRESS_HOST_FIELDS,
+                    skip_unchanged=inventory_config().skip_unchanged_host_updates,
+                )
             log_add_update_host_succeeded(logger, add_result, host_data, output_host)
             payload_tracker_processing_ctx.inventory_id = output_host["id"]
             return output_host, host_id, insights_id, add_result
@@ -235,7 +304,19 @@ def add_host(host_data, platform_metadata):
 
 @metrics.ingress_message_handler_time.time()
 def handle_message(message, event_producer, message_operation=add_host):
-    validated_operation_msg = parse_operation_message(message)
+    start_stage_timings()
+    start = perf_counter()
+    reporter = None
+    try:
+        with stage_timer("parse"):
+            validated_operation_msg = parse_operation_message(message)
+        reporter = validated_operation_msg["data"].get("reporter")
+        _handle_operation(validated_operation_msg, event_producer, message_operation)
+    finally:
+        observe_stage_timings(logger, reporter, perf_counter() - start, inventory_config().mq_slow_message_threshold)
+
+
+def _handle_operation(validated_operation_msg, event_producer, message_operation):
     platform_metadata = validated_operation_msg.get("platform_metadata", {})
 
     request_id = platform_metadata.get("request_id", UNKNOWN_REQUEST_ID_VALUE)
@@ -250,11 +331,18 @@ def handle_message(message, event_producer, message_operation=add_host):
             host = validated_operation_msg["data"]
 
             output_host, host_id, insights_id, operation_result = message_operation(host, platform_metadata)
-            event_type = operation_results_to_event_type(operation_result)
-            event = build_event(event_type, output_host, platform_metadata=platform_metadata)
-
-            headers = message_headers(operation_result, insights_id)
-            event_producer.write_event(event, str(host_id), headers)
+            if operation_result == AddHostResult.unchanged:
+                # Only the staleness has been refreshed, there is nothing new to tell the downstream consumers.
+                logger.debug("Host %s is unchanged, no event produced", host_id)
+                return
+
+            with stage_timer("build_event"):
+                event_type = operation_results_to_event_type(operation_result)
+                event = build_event(event_type, output_host, platform_metadata=platform_metadata)
+                headers = message_headers(operation_result, insights_id)
+
+            with stage_timer("produce"):
+                event_producer.write_event(event, str(host_id), headers)
         except ValidationException as ve:
             logger.error(
                 "Validation error while adding or updating host: %s",
@@ -267,26 +355,331 @@ def handle_message(message, event_producer, message_operation=add_host):
             raise
 
 
-def event_loop(consumer, flask_app, event_producer, handler, interrupt):
-    with flask_app.app_context():
-        while not interrupt():
-            msgs = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
-            for topic_partition, messages in msgs.items():
-                for message in messages:
+def _exit_on_db_access_failure(oe):
+    """ sqlalchemy.exc.OperationalError: This error occurs when an
+        authentication failure occurs or the DB is not accessible.
+        Exit the process to restart the pod
+    """
+    logger.error(f"Could not access DB {str(oe)}")
+    sys.exit(3)
+
+
+def _dead_letter(dead_letter_producer, message, error):
+    if not dead_letter_producer:
+        return
+    try:
+        dead_letter_producer.write_dead_letter(message, error, threadctx.stage_timings)
+    except Exception:
+        # Losing the dead letter must not stop the consumer.
+        logger.exception("Unable to write the message to the dead letter topic")
+
+
+def _process_message(message, event_producer, handler, dead_letter_producer=None):
+    logger.debug("Message received")
+    start_stage_timings()
+    try:
+        handler(message.value, event_producer)
+        metrics.ingress_message_handler_success.inc()
+    except OperationalError as oe:
+        _exit_on_db_access_failure(oe)
+    except Exception as error:
+        metrics.ingress_message_handler_failure.inc()
+        logger.exception("Unable to process message")
+        _dead_letter(dead_letter_producer, message, error)
+
+
+def _process_message_batch(messages, event_producer, handler, dead_letter_producer=None):
+    """
+    Handles all the messages in a single DB transaction. Every message runs in its own savepoint, so a failing
+    message is rolled back without affecting the rest of the batch. Messages that failed on the database side are
+    re-driven one by one after the batch is committed, the others are counted as failures right away. Events are
+    held back and produced only after the batch transaction is committed. The existing hosts of the batch can be
+    prefetched, see PrefetchedHosts.
+    """
+    metrics.ingress_message_batch_size.observe(len(messages))
+
+    if inventory_config().mq_batch_coalesce:
+        runs = _same_host_runs(messages)
+    else:
+        runs = [[message] for message in messages]
+
+    event_buffer = EventBuffer()
+    processed = []
+    redrive = []
+
+    try:
+        with batch_session_guard(db.session), ExitStack() as stack:
+            if inventory_config().mq_batch_prefetch_hosts:
+                prefetched_hosts = host_repository.PrefetchedHosts(_hosts_data(messages))
+                stack.enter_context(prefetched_hosts_guard(db.session, prefetched_hosts))
+
+            for run in runs:
+                if len(run) > 1 and _process_coalesced_messages(run, event_buffer, handler):
+                    processed.extend(run)
+                    continue
+
+                for message in run:
                     logger.debug("Message received")
+                    start_stage_timings()
+                    buffer_mark = len(event_buffer)
                     try:
-                        handler(message.value, event_producer)
-                        metrics.ingress_message_handler_success.inc()
-                    except OperationalError as oe:
-                        """ sqlalchemy.exc.OperationalError: This error occurs when an
-                            authentication failure occurs or the DB is not accessible.
-                            Exit the process to restart the pod
-                        """
-                        logger.error(f"Could not access DB {str(oe)}")
-                        sys.exit(3)
-                    except Exception:
+                        with db.session.begin_nested():
+                            handler(message.value, event_buffer)
+                        processed.append(message)
+                    except OperationalError:
+                        raise
+                    except SQLAlchemyError:
+                        event_buffer.discard(buffer_mark)
+                        logger.warning("Database error while processing message in a batch, it will be re-driven")
+                        redrive.append(message)
+                    except Exception as error:
+                        event_buffer.discard(buffer_mark)
                         metrics.ingress_message_handler_failure.inc()
                         logger.exception("Unable to process message")
+                        _dead_letter(dead_letter_producer, message, error)
+    except OperationalError as oe:
+        _exit_on_db_access_failure(oe)
+    except Exception:
+        metrics.ingress_message_batch_commit_failure.inc()
+        logger.exception("Unable to commit message batch, re-driving its messages one by one")
+        event_buffer.discard(0)
+        redrive = processed + redrive
+        processed = []
+
+    event_buffer.flush(event_producer)
+    metrics.ingress_message_handler_success.inc(len(processed))
+
+    for message in redrive:
+        metrics.ingress_message_batch_redrive.inc()
+        _process_message(message, event_producer, handler, dead_letter_producer)
+
+
+def _hosts_data(messages):
+    # Messages that can't be parsed fail on their own when they are handled.
+    for message in messages:
+        try:
+            host_data = json.loads(message.value)["data"]
+        except Exception:
+            continue
+        if isinstance(host_data, dict):
+            yield host_data
+
+
+def _same_host_run_key(message):
+    """
+    Identifies the host of a message by the account and the elevated canonical fact of the highest priority, the fact
+    find_existing_host resolves the host by. Unlike the dispatch key, the value is compared exactly, the messages of
+    a run are merged into one host in memory and must not be told apart by the deduplication. Messages without an
+    elevated canonical fact have no key.
+    """
+    try:
+        host = json.loads(message.value)["data"]
+    except Exception:
+        return None
+
+    for field in host_repository.ELEVATED_CANONICAL_FACT_FIELDS:
+        value = host.get(field)
+        if value and isinstance(value, str):
+            return host.get("account"), field, value
+    return None
+
+
+def _same_host_runs(messages):
+    """
+    Splits the messages into runs of consecutive messages for the same host, as identified by the same host run key.
+    Messages without the key are not known to be for the same host.
+    """
+    runs = []
+    previous_key = None
+    for message in messages:
+        key = _same_host_run_key(message)
+        if runs and key is not None and key == previous_key:
+            runs[-1].append(message)
+        else:
+            runs.append([message])
+        previous_key = key
+    return runs
+
+
+def _process_coalesced_messages(messages, event_buffer, handler):
+    """
+    Handles a run of messages for the same host in a single savepoint. The host is resolved by the first message,
+    the following ones are merged into it in memory by the same Host methods, and the merged host is written once.
+    Only the last event is kept, it carries the final state of the host. Every message is still handled, and
+    reported to the payload tracker, with its own request_id.
+
+    Returns False if any of the messages failed. The run is then rolled back and handled message by message, the
+    payload tracker gets the statuses of its messages once more.
+    """
+    buffer_mark = len(event_buffer)
+    coalesced_writes = CoalescedWrites()
+    try:
+        with db.session.begin_nested(), coalesced_session_guard(db.session, coalesced_writes):
+            for index, message in enumerate(messages):
+                logger.debug("Message received")
+                start_stage_timings()
+                coalesced_writes.last = index == len(messages) - 1
+                handler(message.value, event_buffer)
+    except OperationalError:
+        raise
+    except Exception:
+        event_buffer.discard(buffer_mark)
+        logger.warning("Unable to coalesce %d messages for the same host, handling them one by one", len(messages))
+        return False
+
+    event_buffer.coalesce(buffer_mark)
+    metrics.ingress_message_coalesced.inc(len(messages) - 1)
+    return True
+
+
+def _partition_dispatch_key(topic_partition, message):
+    return topic_partition
+
+
+def _host_dispatch_key(topic_partition, message):
+    """
+    Routes the messages by the account and the host ID or the highest priority elevated canonical fact. Messages
+    without any of those are routed by the account only, so the ordering is kept for hosts that are deduplicated
+    by their other canonical facts too.
+    """
+    try:
+        host = json.loads(message.value)["data"]
+        account = host.get("account")
+    except Exception:
+        # Invalid messages are going to be rejected by the handler, the order does not matter.
+        return topic_partition
+
+    for field in ("id",) + host_repository.ELEVATED_CANONICAL_FACT_FIELDS:
+        value = host.get(field)
+        if value and isinstance(value, str):
+            return account, field, value.casefold()
+    return account
+
+
+DISPATCH_KEYS = {"partition": _partition_dispatch_key, "host": _host_dispatch_key}
+
+
+def _worker_pool_process(event_producer, handler, config, dead_letter_producer):
+    if config.mq_batch_mode:
+
+        def process(messages):
+            _process_message_batch(messages, event_producer, handler, dead_letter_producer)
+
+        return process, config.kafka_consumer["max_poll_records"]
+
+    def process(messages):
+        for message in messages:
+            _process_message(message, event_producer, handler, dead_letter_producer)
+
+    return process, 1
+
+
+def _worker_pool_event_loop(consumer, flask_app, event_producer, handler, interrupt, config, dead_letter_producer):
+    process, max_batch_size = _worker_pool_process(event_producer, handler, config, dead_letter_producer)
+    dispatch_key = DISPATCH_KEYS[config.mq_worker_dispatch_key]
+    backpressure = Backpressure.from_config(consumer, event_producer, config)
+    with WorkerPool(flask_app, process, config.mq_worker_count, config.mq_worker_queue_size, max_batch_size) as pool:
+        while not interrupt():
+            if backpressure:
+                backpressure.check()
+            msgs = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
+            for topic_partition, messages in msgs.items():
+                for message in messages:
+                    logger.debug("Message dispatched")
+                    pool.dispatch(topic_partition, message, dispatch_key(topic_partition, message))
+            pool.check()
+            pool.commit(consumer)
+
+    pool.check()
+    pool.commit(consumer)
+
+
+def _throttle_lanes(consumer, lanes):
+    """
+    Pauses the partitions of the topics whose lanes are saturated and resumes them once the lanes catch up. The
+    other topics keep being consumed.
+    """
+    paused = consumer.paused()
+    for topic, lane in lanes.items():
+        partitions = [topic_partition for topic_partition in consumer.assignment() if topic_partition.topic == topic]
+        if lane.saturated:
+            if not all(topic_partition in paused for topic_partition in partitions):
+                logger.debug("Pausing the saturated lane of %s", topic)
+                metrics.mq_lane_pauses.labels(topic).inc()
+            consumer.pause(*partitions)
+        else:
+            consumer.resume(*[topic_partition for topic_partition in partitions if topic_partition in paused])
+
+
+def multi_topic_event_loop(consumer, flask_app, event_producer, topic_handlers, interrupt, dead_letter_producer=None):
+    """
+    Consumes several topics in a single process. Every topic has its own lane, a worker pool with the number of
+    workers configured for the topic, so the messages of one topic are never queued behind those of another. The
+    topic_handlers map every consumed topic to its message handler.
+    """
+    with flask_app.app_context():
+        config = inventory_config()
+        dispatch_key = DISPATCH_KEYS[config.mq_worker_dispatch_key]
+        backpressure = Backpressure.from_config(consumer, event_producer, config)
+
+        with ExitStack() as stack:
+            lanes = {}
+            for topic, handler in topic_handlers.items():
+                process, max_batch_size = _worker_pool_process(event_producer, handler, config, dead_letter_producer)
+                lanes[topic] = stack.enter_context(
+                    WorkerPool(
+                        flask_app,
+                        process,
+                        config.mq_lane_worker_counts.get(topic, config.mq_worker_count),
+                        config.mq_worker_queue_size,
+                        max_batch_size,
+                        name=topic,
+                    )
+                )
+
+            while not interrupt():
+                if backpressure:
+                    backpressure.check()
+                if not (backpressure and backpressure.paused):
+                    _throttle_lanes(consumer, lanes)
+                msgs = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
+                for topic_partition, messages in msgs.items():
+                    lane = lanes[topic_partition.topic]
+                    for message in messages:
+                        logger.debug("Message dispatched")
+                        lane.dispatch(topic_partition, message, dispatch_key(topic_partition, message))
+                for lane in lanes.values():
+                    lane.check()
+                    lane.commit(consumer)
+
+        for lane in lanes.values():
+            lane.check()
+            lane.commit(consumer)
+
+
+def event_loop(consumer, flask_app, event_producer, handler, interrupt, dead_letter_producer=None):
+    with flask_app.app_context():
+        config = inventory_config()
+        if config.mq_worker_count > 1:
+            return _worker_pool_event_loop(
+                consumer, flask_app, event_producer, handler, interrupt, config, dead_letter_producer
+            )
+
+        batch_mode = config.mq_batch_mode
+        backpressure = Backpressure.from_config(consumer, event_producer, config)
+        while not interrupt():
+            if backpressure:
+                backpressure.check()
+            msgs = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
+            if batch_mode:
+                messages = [message for partition_messages in msgs.values() for message in partition_messages]
+                if messages:
+                    _process_message_batch(messages, event_producer, handler, dead_letter_producer)
+                    consumer.commit()
+            else:
+                for topic_partition, messages in msgs.items():
+                    for message in messages:
+                        _process_message(message, event_producer, handler, dead_letter_producer)
 
 
 def initialize_thread_local_storage(request_id):
@@ -0,0 +1,177 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from kafka.structs import OffsetAndMetadata
+
+from app.logging import get_logger
+from app.queue import metrics
+
+__all__ = ("OffsetTracker", "WorkerPool")
+
+logger = get_logger(__name__)
+
+_STOP = object()
+
+
+class OffsetTracker:
+    """
+    Keeps track of the messages dispatched to the workers. The offset that can be committed for a partition is the
+    lowest offset still being processed, or the one following the last dispatched message if all of them are done.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(set)
+        self._next = {}
+        self._committed = {}
+
+    def dispatched(self, topic_partition, offset):
+        with self._lock:
+            self._pending[topic_partition].add(offset)
+            self._next[topic_partition] = offset + 1
+
+    def done(self, topic_partition, offset):
+        with self._lock:
+            self._pending[topic_partition].discard(offset)
+
+    def committable(self, assignment=None):
+        with self._lock:
+            offsets = {}
+            for topic_partition, next_offset in self._next.items():
+                if assignment is not None and topic_partition not in assignment:
+                    continue
+                pending = self._pending[topic_partition]
+                offset = min(pending) if pending else next_offset
+                if self._committed.get(topic_partition) != offset:
+                    offsets[topic_partition] = offset
+            return offsets
+
+    def committed(self, offsets):
+        with self._lock:
+            self._committed.update(offsets)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(offsets) for offsets in self._pending.values())
+
+
+class _Worker(threading.Thread):
+    def __init__(self, label, flask_app, process, queue_size, max_batch_size, on_done):
+        super().__init__(name=f"mq-worker-{label}", daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.label = label
+        self._flask_app = flask_app
+        self._process = process
+        self._max_batch_size = max_batch_size
+        self._on_done = on_done
+
+    def run(self):
+        with self._flask_app.app_context():
+            while True:
+                items = self._next_items()
+                stop = _STOP in items
+                items = [item for item in items if item is not _STOP]
+                metrics.mq_worker_queue_depth.labels(self.label).set(self.queue.qsize())
+
+                if items:
+                    self._process_items(items)
+                if stop or self.error is not None:
+                    return
+
+    def _next_items(self):
+        items = [self.queue.get()]
+        while len(items) < self._max_batch_size and items[-1] is not _STOP:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _process_items(self, items):
+        start = time.perf_counter()
+        try:
+            self._process([message for _, message in items])
+        except (SystemExit, Exception) as error:
+            # sys.exit or an error only ends the current thread, the pool re-raises it in the main thread. The offsets
+            # of the items are not committed, so they are consumed again after a restart.
+            self.error = error
+        else:
+            for topic_partition, message in items:
+                self._on_done(topic_partition, message.offset)
+        finally:
+            metrics.mq_worker_busy_time.labels(self.label).inc(time.perf_counter() - start)
+
+
+class WorkerPool:
+    """
+    Processes consumed messages in a fixed number of worker threads. Every message is routed to a worker by its
+    dispatch key, so messages sharing a key are processed in order, by a single worker. The workers of a named pool
+    are labeled by the name too.
+    """
+
+    def __init__(self, flask_app, process, worker_count, queue_size, max_batch_size=1, name=None):
+        self.offset_tracker = OffsetTracker()
+        self._queue_size = queue_size
+        self._workers = [
+            _Worker(
+                f"{name}-{index}" if name else str(index),
+                flask_app,
+                process,
+                queue_size,
+                max_batch_size,
+                self.offset_tracker.done,
+            )
+            for index in range(worker_count)
+        ]
+
+    def __enter__(self):
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+    @property
+    def saturated(self):
+        # More messages are pending than the worker queues can hold, a dispatch would likely block.
+        return self.offset_tracker.pending() >= len(self._workers) * self._queue_size
+
+    def dispatch(self, topic_partition, message, key):
+        worker = self._workers[hash(key) % len(self._workers)]
+        self.offset_tracker.dispatched(topic_partition, message.offset)
+        # Blocks when the worker falls behind, which also holds back the polling.
+        while True:
+            try:
+                worker.queue.put((topic_partition, message), timeout=1)
+                break
+            except queue.Full:
+                self.check()
+        metrics.mq_worker_queue_depth.labels(worker.label).set(worker.queue.qsize())
+
+    def check(self):
+        """
+        Re-raises the SystemExit or the error that stopped a worker.
+        """
+        for worker in self._workers:
+            if worker.error is not None:
+                raise worker.error
+
+    def commit(self, consumer):
+        offsets = self.offset_tracker.committable(consumer.assignment())
+        if not offsets:
+            return
+
+        try:
+            consumer.commit({tp: OffsetAndMetadata(offset, None) for tp, offset in offsets.items()})
+        except Exception:
+            logger.exception("Unable to commit consumer offsets")
+        else:
+            self.offset_tracker.committed(offsets)
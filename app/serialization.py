@@ -5,6 +5,7 @@ from marshmallow import ValidationError
 
 from app.exceptions import InputFormatException
 from app.exceptions import ValidationException
+from app.instrumentation import stage_timer
 from app.models import CanonicalFactsSchema
 from app.models import Host as Host
 from app.models import HostSchema
@@ -81,6 +82,7 @@ def deserialize_host_xjoin(data):
     return host
 
 
+@stage_timer("serialize")
 def serialize_host(host, staleness_timestamps, fields=DEFAULT_FIELDS):
     if host.stale_timestamp:
         stale_timestamp = staleness_timestamps.stale_timestamp(host.stale_timestamp)
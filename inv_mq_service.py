@@ -6,10 +6,12 @@ from prometheus_client import start_http_server
 from app import create_app
 from app.environment import RuntimeEnvironment
 from app.logging import get_logger
+from app.queue.event_producer import DeadLetterProducer
 from app.queue.event_producer import EventProducer
 from app.queue.queue import add_host
 from app.queue.queue import event_loop
 from app.queue.queue import handle_message
+from app.queue.queue import multi_topic_event_loop
 from app.queue.queue import update_system_profile
 from lib.handlers import register_shutdown
 from lib.handlers import ShutdownHandler
@@ -25,7 +27,7 @@ def main():
     topic_to_handler = {config.host_ingress_topic: add_host, config.system_profile_topic: update_system_profile}
 
     consumer = KafkaConsumer(
-        config.kafka_consumer_topic,
+        *config.kafka_consumer_topics,
         group_id=config.host_ingress_consumer_group,
         bootstrap_servers=config.bootstrap_servers,
         api_version=(0, 10, 1),
@@ -38,12 +40,30 @@ def main():
     event_producer = EventProducer(config)
     register_shutdown(event_producer.close, "Closing producer")
 
+    dead_letter_producer = None
+    if config.dead_letter_topic:
+        dead_letter_producer = DeadLetterProducer(config)
+        register_shutdown(dead_letter_producer.close, "Closing dead letter producer")
+
     shutdown_handler = ShutdownHandler()
     shutdown_handler.register()
 
-    message_handler = partial(handle_message, message_operation=topic_to_handler[config.kafka_consumer_topic])
+    if len(config.kafka_consumer_topics) > 1:
+        # A single consumer for all the topics, every topic is processed in its own lane of workers.
+        topic_handlers = {
+            topic: partial(handle_message, message_operation=topic_to_handler[topic])
+            for topic in config.kafka_consumer_topics
+        }
+        multi_topic_event_loop(
+            consumer, application, event_producer, topic_handlers, shutdown_handler.shut_down, dead_letter_producer
+        )
+        return
+
+    message_handler = partial(handle_message, message_operation=topic_to_handler[config.kafka_consumer_topics[0]])
 
-    event_loop(consumer, application, event_producer, message_handler, shutdown_handler.shut_down)
+    event_loop(
+        consumer, application, event_producer, message_handler, shutdown_handler.shut_down, dead_letter_producer
+    )
 
 
 if __name__ == "__main__":
@@ -1,8 +1,63 @@
 from contextlib import contextmanager
 
+from app.instrumentation import stage_timer
+
+_BATCH_SESSION_KEY = "batch"
+_COALESCED_WRITES_KEY = "coalesced_writes"
+_PREFETCHED_HOSTS_KEY = "prefetched_hosts"
+
+
+class CoalescingConflict(Exception):
+    """
+    Raised by a unit of work of a coalesced run that does not target the host resolved by the first one. Its writes
+    can't be merged into that host, the run is handled unit by unit instead.
+    """
+
+
+class CoalescedWrites:
+    """
+    The state shared by consecutive units of work on the same host within a batch. The host resolved by the first
+    of them is handed over to the following ones, which only update it in memory. The last one pushes the merged
+    changes to the database.
+    """
+
+    def __init__(self):
+        self.host = None
+        self.created = False
+        self.last = False
+
+    @property
+    def deferred(self):
+        return not self.last
+
 
 @contextmanager
 def session_guard(session):
+    if in_batch(session):
+        # The enclosing batch_session_guard owns the transaction, only push the changes to the database.
+        yield session
+        if not flush_deferred(session):
+            session.flush()
+        return
+
+    try:
+        yield session
+        with stage_timer("commit"):
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@contextmanager
+def batch_session_guard(session):
+    """
+    Runs several units of work, each of them guarded by session_guard, in a single transaction
+    that is committed once at the end.
+    """
+    session.info[_BATCH_SESSION_KEY] = True
     try:
         yield session
         session.commit()
@@ -10,4 +65,49 @@ def session_guard(session):
         session.rollback()
         raise
     finally:
+        del session.info[_BATCH_SESSION_KEY]
         session.close()
+
+
+def in_batch(session):
+    return session.info.get(_BATCH_SESSION_KEY, False)
+
+
+@contextmanager
+def coalesced_session_guard(session, coalesced_writes):
+    """
+    Runs several units of work on the same host, each of them guarded by session_guard, with their writes coalesced.
+    Must be nested in a batch_session_guard. The session is not flushed by the queries in between, the changes are
+    only kept in memory until the last unit of work.
+    """
+    session.info[_COALESCED_WRITES_KEY] = coalesced_writes
+    try:
+        with session.no_autoflush:
+            yield session
+    finally:
+        del session.info[_COALESCED_WRITES_KEY]
+
+
+def get_coalesced_writes(session):
+    return session.info.get(_COALESCED_WRITES_KEY)
+
+
+def flush_deferred(session):
+    coalesced_writes = get_coalesced_writes(session)
+    return coalesced_writes is not None and coalesced_writes.deferred
+
+
+@contextmanager
+def prefetched_hosts_guard(session, prefetched_hosts):
+    """
+    Hands the hosts looked up for a whole batch over to its units of work. Must be nested in a batch_session_guard.
+    """
+    session.info[_PREFETCHED_HOSTS_KEY] = prefetched_hosts
+    try:
+        yield session
+    finally:
+        del session.info[_PREFETCHED_HOSTS_KEY]
+
+
+def get_prefetched_hosts(session):
+    return session.info.get(_PREFETCHED_HOSTS_KEY)
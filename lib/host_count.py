@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from itertools import chain
+
+from sqlalchemy import event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.sql.expression import Executable
+
+from app import inventory_config
+from app.models import db
+from app.models import LimitedHost
+from lib.metrics import host_count_cache_hit
+from lib.metrics import host_count_cache_miss
+
+__all__ = ("CountStrategy", "count_hosts", "invalidate_host_counts")
+
+CountStrategy = Enum("CountStrategy", ("exact", "estimated", "cached"))
+
+
+class _Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, "postgresql")
+def _compile_explain(element, compiler, **kwargs):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kwargs)}"
+
+
+class HostCountCache:
+    """
+    Keeps the totals of the host queries for a short time, per account and query, for up to size accounts. The
+    totals of an account are dropped on writes to its hosts made by this process, the writes made by the other
+    processes only age out with the TTL.
+    """
+
+    def __init__(self, size, clock=time.monotonic):
+        self._size = size
+        self._clock = clock
+        self._accounts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, account, key):
+        with self._lock:
+            totals = self._accounts.get(account, {})
+            expires_at, total = totals.get(key, (None, None))
+            if expires_at is not None and expires_at <= self._clock():
+                del totals[key]
+                total = None
+            if total is not None:
+                self._accounts.move_to_end(account)
+
+        if total is None:
+            host_count_cache_miss.inc()
+        else:
+            host_count_cache_hit.inc()
+        return total
+
+    def set(self, account, key, total, ttl):
+        if self._size <= 0:
+            return
+
+        with self._lock:
+            totals = self._accounts.setdefault(account, {})
+            now = self._clock()
+            for expired_key in [key for key, (expires_at, _) in totals.items() if expires_at <= now]:
+                del totals[expired_key]
+            totals[key] = (now + ttl, total)
+            self._accounts.move_to_end(account)
+            if len(self._accounts) > self._size:
+                self._accounts.popitem(last=False)
+
+    def invalidate(self, account):
+        with self._lock:
+            self._accounts.pop(account, None)
+
+    def clear(self):
+        with self._lock:
+            self._accounts.clear()
+
+
+_HOST_COUNT_CACHE = HostCountCache(1024)
+
+
+def count_hosts(query, account, filters, strategy=CountStrategy.exact):
+    """
+    Returns the total of the hosts matched by the query of the given account, counted the way the strategy says:
+    exact is a COUNT over the whole filtered set, estimated the number of rows the query planner expects and
+    cached an exact total kept for INVENTORY_HOST_COUNT_CACHE_TTL seconds. The filters are the normalized
+    parameters the query has been built from, the same filters of an account must build the same query.
+    """
+    query = query.order_by(None)
+    if strategy == CountStrategy.estimated:
+        return _estimated_count(query)
+    if strategy == CountStrategy.cached:
+        return _cached_count(query, account, filters)
+    return query.count()
+
+
+def _estimated_count(query):
+    (plan,) = db.session.execute(_Explain(query.statement)).scalar()
+    return int(plan["Plan"]["Plan Rows"])
+
+
+def _cached_count(query, account, filters):
+    total = _HOST_COUNT_CACHE.get(account, filters)
+    if total is None:
+        total = query.count()
+        _HOST_COUNT_CACHE.set(account, filters, total, inventory_config().host_count_cache_ttl)
+    return total
+
+
+def invalidate_host_counts(account):
+    _HOST_COUNT_CACHE.invalidate(account)
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed_host_counts(session, flush_context):
+    accounts = {
+        instance.account
+        for instance in chain(session.new, session.dirty, session.deleted)
+        if isinstance(instance, LimitedHost)
+    }
+    for account in accounts:
+        invalidate_host_counts(account)
@@ -4,6 +4,7 @@ from app.models import Host
 from app.queue.events import build_event
 from app.queue.events import EventType
 from app.queue.events import message_headers
+from lib.host_count import invalidate_host_counts
 from lib.metrics import delete_host_count
 from lib.metrics import delete_host_processing_time
 
@@ -20,6 +21,7 @@ def delete_hosts(select_query, event_producer, chunk_size, interrupt=lambda: Fal
             host_deleted = _deleted_by_this_query(host)
             if host_deleted:
                 delete_host_count.inc()
+                invalidate_host_counts(host.account)
 
                 event = build_event(EventType.delete, host)
                 insights_id = host.canonical_facts.get("insights_id")
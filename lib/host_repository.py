@@ -1,20 +1,46 @@
+import json
+from datetime import datetime
+from datetime import timezone
 from enum import Enum
 from uuid import UUID
+from uuid import uuid4
 
 from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import cast
+from sqlalchemy import func
+from sqlalchemy import Integer
 from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import text
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 
 from app import inventory_config
 from app.auth.identity import AuthType
 from app.auth.identity import IdentityType
 from app.culling import staleness_to_conditions
 from app.exceptions import InventoryException
+from app.exceptions import ValidationException
+from app.instrumentation import stage_timer
 from app.logging import get_logger
+from app.models import canonical_fact_pairs
 from app.models import db
 from app.models import Host
+from app.models import HostCanonicalFact
 from app.serialization import DEFAULT_FIELDS
+from app.serialization import deserialize_canonical_facts
 from app.serialization import serialize_host
 from lib import metrics
+from lib.db import CoalescingConflict
+from lib.db import flush_deferred
+from lib.db import get_coalesced_writes
+from lib.db import get_prefetched_hosts
 from lib.db import session_guard
 
 
@@ -24,15 +50,18 @@ __all__ = (
     "multiple_canonical_facts_host_query",
     "create_new_host",
     "find_existing_host",
+    "find_existing_hosts",
     "find_host_by_multiple_canonical_facts",
     "find_hosts_by_staleness",
     "find_non_culled_hosts",
+    "PrefetchedHosts",
     "stale_timestamp_filter",
     "update_existing_host",
     "update_query_for_owner_id",
+    "upsert_host",
 )
 
-AddHostResult = Enum("AddHostResult", ("created", "updated"))
+AddHostResult = Enum("AddHostResult", ("created", "updated", "unchanged"))
 
 # These are the "elevated" canonical facts that are
 # given priority in the host deduplication process.
@@ -46,22 +75,82 @@ NULL = None
 logger = get_logger(__name__)
 
 
-def add_host(input_host, identity, staleness_offset, update_system_profile=True, fields=DEFAULT_FIELDS):
+def add_host(
+    input_host, identity, staleness_offset, update_system_profile=True, fields=DEFAULT_FIELDS, skip_unchanged=False
+):
     """
     Add or update a host
 
     Required parameters:
      - at least one of the canonical facts fields is required
      - account number
+
+    With skip_unchanged, a host re-reported with the same content by the same reporter only gets its staleness
+    refreshed. The result is AddHostResult.unchanged, or AddHostResult.updated if its stale timestamp or reporter has
+    changed.
     """
 
     with session_guard(db.session):
-        existing_host = find_existing_host(identity, input_host.canonical_facts)
+        coalesced_writes = get_coalesced_writes(db.session)
+        if coalesced_writes and coalesced_writes.host:
+            # An earlier operation of the batch has resolved the host already, the input is merged into it.
+            return _batch_result(
+                coalesced_writes,
+                update_existing_host(
+                    coalesced_writes.host, input_host, staleness_offset, update_system_profile, fields, skip_unchanged
+                ),
+            )
+
+        if inventory_config().host_upsert and not skip_unchanged and _elevated_canonical_fact(input_host):
+            try:
+                with db.session.begin_nested():
+                    return _batch_result(
+                        coalesced_writes, upsert_host(input_host, staleness_offset, update_system_profile, fields)
+                    )
+            except IntegrityError:
+                # Another elevated canonical fact belongs to a different host, the regular deduplication decides.
+                logger.debug("Host upsert conflicts with another host, falling back to deduplication")
+
+        existing_host = _prefetched_or_existing_host(identity, input_host.canonical_facts)
 
         if existing_host:
-            return update_existing_host(existing_host, input_host, staleness_offset, update_system_profile, fields)
+            result = update_existing_host(
+                existing_host, input_host, staleness_offset, update_system_profile, fields, skip_unchanged
+            )
         else:
-            return create_new_host(input_host, staleness_offset, fields)
+            if inventory_config().host_upsert:
+                _release_culled_elevated_facts(input_host.account, input_host.canonical_facts)
+            result = create_new_host(input_host, staleness_offset, fields, skip_unchanged)
+        return _batch_result(coalesced_writes, result)
+
+
+def _batch_result(coalesced_writes, result):
+    """
+    Lets the following operations of the batch build on the host written by this one.
+    """
+    prefetched_hosts = get_prefetched_hosts(db.session)
+    if prefetched_hosts:
+        # The host is in the session already, it is taken from its identity map.
+        prefetched_hosts.written(Host.query.get(result[1]))
+    return _coalesce(coalesced_writes, result)
+
+
+def _coalesce(coalesced_writes, result):
+    """
+    Hands the host of the first coalesced operation over to the following ones. A host created by the coalesced
+    operations is reported as created by all of them, the downstream consumers have not seen it yet.
+    """
+    if not coalesced_writes:
+        return result
+
+    output_host, host_id, insights_id, add_result = result
+    if coalesced_writes.host is None:
+        # The host is in the session already, it is taken from its identity map.
+        coalesced_writes.host = Host.query.get(host_id)
+        coalesced_writes.created = add_result == AddHostResult.created
+    elif coalesced_writes.created and add_result == AddHostResult.updated:
+        add_result = AddHostResult.created
+    return output_host, host_id, insights_id, add_result
 
 
 @metrics.host_dedup_processing_time.time()
@@ -75,6 +164,278 @@ def find_existing_host(identity, canonical_facts):
     return existing_host
 
 
+def _prefetched_or_existing_host(identity, canonical_facts):
+    prefetched_hosts = get_prefetched_hosts(db.session)
+    if prefetched_hosts:
+        prefetched, existing_host = prefetched_hosts.get(identity.account_number, canonical_facts)
+        if prefetched:
+            return existing_host
+    return find_existing_host(identity, canonical_facts)
+
+
+def find_existing_hosts(identities_and_canonical_facts):
+    """
+    Bulk variant of find_existing_host. Takes a sequence of (identity, canonical_facts) pairs and returns a list
+    of the matching hosts (or None) in the same order.
+    """
+    return _find_existing_hosts(
+        [(identity.account_number, canonical_facts) for identity, canonical_facts in identities_and_canonical_facts]
+    )
+
+
+@metrics.host_bulk_dedup_processing_time.time()
+def _find_existing_hosts(accounts_and_canonical_facts):
+    """
+    Resolves the (account, canonical_facts) lookups in a constant number of queries: the elevated canonical facts,
+    following the priority order, and the multiple canonical facts fallback for the lookups left unresolved. Without
+    the lookup table, there is a query for every elevated canonical fact.
+    """
+    logger.debug("find_existing_hosts(%d hosts)", len(accounts_and_canonical_facts))
+    existing_hosts = [None] * len(accounts_and_canonical_facts)
+    lookup_table = inventory_config().host_canonical_facts_lookup
+
+    if lookup_table:
+        lookups = {
+            index: (account, _elevated_fact_pairs(canonical_facts))
+            for index, (account, canonical_facts) in enumerate(accounts_and_canonical_facts)
+        }
+        for index, host in _bulk_elevated_canonical_facts_host_query(lookups):
+            existing_hosts[index] = host
+    else:
+        for elevated_cf_name in ELEVATED_CANONICAL_FACT_FIELDS:
+            lookups = {
+                index: (account, canonical_facts[elevated_cf_name])
+                for index, (account, canonical_facts) in enumerate(accounts_and_canonical_facts)
+                if existing_hosts[index] is None and canonical_facts.get(elevated_cf_name)
+            }
+            for index, host in _bulk_single_canonical_fact_host_query(elevated_cf_name, lookups):
+                existing_hosts[index] = host
+
+    unresolved = [
+        (index, account, canonical_facts)
+        for index, (account, canonical_facts) in enumerate(accounts_and_canonical_facts)
+        if existing_hosts[index] is None
+    ]
+    if lookup_table:
+        lookups = {
+            index: (account, canonical_fact_pairs(canonical_facts)) for index, account, canonical_facts in unresolved
+        }
+        matches = _bulk_multiple_canonical_facts_host_query(lookups)
+    else:
+        lookups = {index: (account, json.dumps(canonical_facts)) for index, account, canonical_facts in unresolved}
+        matches = _bulk_canonical_facts_containment_host_query(lookups)
+    for index, host in matches:
+        existing_hosts[index] = host
+
+    return existing_hosts
+
+
+class PrefetchedHosts:
+    """
+    The existing hosts of a batch of host messages, looked up together by the bulk deduplication the first time one
+    of them is needed. A lookup does not see the writes of the earlier messages of the batch. It is used only while
+    the batch has not written the host it found, nor a host the deduplication could find for it now. Otherwise
+    find_existing_host runs instead.
+    """
+
+    def __init__(self, hosts_data):
+        # Iterated only by the first lookup, a batch without one does not parse its hosts.
+        self._hosts_data = hosts_data
+        self._hosts = None
+        self._written_hosts = {}
+
+    @staticmethod
+    def _key(account, canonical_facts):
+        return account, frozenset(canonical_fact_pairs(canonical_facts))
+
+    def _prefetch(self):
+        lookups = {}
+        for host_data in self._hosts_data:
+            try:
+                canonical_facts = deserialize_canonical_facts(host_data)
+            except ValidationException:
+                # The message fails on its own, there is nothing to look up.
+                continue
+            if canonical_facts:
+                account = host_data.get("account")
+                lookups[self._key(account, canonical_facts)] = (account, canonical_facts)
+
+        hosts = _find_existing_hosts(list(lookups.values()))
+        self._hosts = dict(zip(lookups.keys(), hosts))
+
+    def get(self, account, canonical_facts):
+        """
+        Returns whether the lookup is prefetched and still valid, and the host it found, if any.
+        """
+        if self._hosts is None:
+            self._prefetch()
+
+        key = self._key(account, canonical_facts)
+        if key not in self._hosts:
+            return False, None
+
+        host = self._hosts[key]
+        if host is not None and host.id in self._written_hosts:
+            return False, None
+        if any(_could_match(written_host, account, canonical_facts) for written_host in self._written_hosts.values()):
+            return False, None
+        return True, host
+
+    def written(self, host):
+        self._written_hosts[host.id] = host
+
+
+def _could_match(host, account, canonical_facts):
+    """
+    Whether the deduplication could find the host for the canonical facts: by an elevated canonical fact, or by the
+    canonical facts containment.
+    """
+    if host.account != account:
+        return False
+    if any(host.canonical_facts.get(name) == value for name, value in _elevated_fact_pairs(canonical_facts)):
+        return True
+
+    host_fact_pairs = canonical_fact_pairs(host.canonical_facts)
+    fact_pairs = canonical_fact_pairs(canonical_facts)
+    return host_fact_pairs <= fact_pairs or host_fact_pairs >= fact_pairs
+
+
+def _elevated_fact_pairs(canonical_facts):
+    return [(name, canonical_facts[name]) for name in ELEVATED_CANONICAL_FACT_FIELDS if canonical_facts.get(name)]
+
+
+def _elevated_fact_priority(fact_name):
+    return case([(fact_name == name, priority) for priority, name in enumerate(ELEVATED_CANONICAL_FACT_FIELDS)])
+
+
+def _unnest(**columns):
+    return select(
+        [func.unnest(cast(values, ARRAY(value_type))).label(name) for name, (value_type, values) in columns.items()]
+    )
+
+
+def _bulk_host_query(matches, *order_by):
+    query = (
+        db.session.query(matches.c.index, Host)
+        .join(Host, Host.id == matches.c.host_id)
+        .distinct(matches.c.index)
+        .order_by(matches.c.index, *order_by)
+    )
+    return _deduplication_candidates(query)
+
+
+def _jsonb_lookup_matches(lookups, match_condition):
+    """
+    Unnests the searched values, {index: (account, value)}, into a lookup table and matches the canonical facts of
+    the hosts of the same account to its rows.
+    """
+    indexes = list(lookups.keys())
+    lookup = _unnest(
+        index=(Integer, indexes),
+        account=(String, [lookups[index][0] for index in indexes]),
+        value=(String, [lookups[index][1] for index in indexes]),
+    ).alias("lookup")
+    return (
+        select([lookup.c.index, Host.id.label("host_id")])
+        .select_from(lookup.join(Host.__table__, (Host.account == lookup.c.account) & match_condition(lookup.c.value)))
+        .alias("matches")
+    )
+
+
+def _bulk_single_canonical_fact_host_query(canonical_fact, lookups):
+    if not lookups:
+        return ()
+
+    matches = _jsonb_lookup_matches(lookups, lambda value: Host.canonical_facts[canonical_fact].astext == value)
+    return _bulk_host_query(matches).all()
+
+
+def _bulk_canonical_facts_containment_host_query(lookups):
+    if not lookups:
+        return ()
+
+    def _contains_or_contained_by_jsonb(value):
+        canonical_facts = cast(value, JSONB)
+        return Host.canonical_facts.comparator.contains(
+            canonical_facts
+        ) | Host.canonical_facts.comparator.contained_by(canonical_facts)
+
+    return _bulk_host_query(_jsonb_lookup_matches(lookups, _contains_or_contained_by_jsonb)).all()
+
+
+def _canonical_facts_lookup_table(lookups):
+    """
+    Unnests the searched facts, {index: (account, fact pairs)}, into a lookup table with a row for every fact. The
+    rows carry the number of the facts searched for the host too.
+    """
+    rows = [
+        (index, account, fact_name, fact_value, len(fact_pairs))
+        for index, (account, fact_pairs) in lookups.items()
+        for fact_name, fact_value in fact_pairs
+    ]
+    if not rows:
+        return None
+
+    indexes, accounts, fact_names, fact_values, fact_counts = zip(*rows)
+    return _unnest(
+        index=(Integer, list(indexes)),
+        account=(String, list(accounts)),
+        fact_name=(String, list(fact_names)),
+        fact_value=(String, list(fact_values)),
+        fact_count=(Integer, list(fact_counts)),
+    ).alias("lookup")
+
+
+def _lookup_join(lookup):
+    return lookup.join(
+        HostCanonicalFact,
+        (HostCanonicalFact.account == lookup.c.account)
+        & (HostCanonicalFact.fact_name == lookup.c.fact_name)
+        & (HostCanonicalFact.fact_value == lookup.c.fact_value),
+    )
+
+
+def _bulk_elevated_canonical_facts_host_query(lookups):
+    lookup = _canonical_facts_lookup_table(lookups)
+    if lookup is None:
+        return ()
+
+    matches = (
+        select(
+            [lookup.c.index, HostCanonicalFact.host_id, _elevated_fact_priority(lookup.c.fact_name).label("priority")]
+        )
+        .select_from(_lookup_join(lookup))
+        .alias("matches")
+    )
+    return _bulk_host_query(matches, matches.c.priority).all()
+
+
+def _bulk_multiple_canonical_facts_host_query(lookups):
+    lookup = _canonical_facts_lookup_table(lookups)
+    if lookup is None:
+        return ()
+
+    matches = (
+        select([lookup.c.index, HostCanonicalFact.host_id])
+        .select_from(_lookup_join(lookup))
+        .group_by(lookup.c.index, lookup.c.fact_count, HostCanonicalFact.host_id)
+        .having(_contains_or_contained_by(lookup.c.fact_count))
+        .alias("matches")
+    )
+    return _bulk_host_query(matches).all()
+
+
+def _contains_or_contained_by(fact_count):
+    """
+    The HAVING condition of the matched canonical fact rows grouped by host. All the searched facts matched, the host
+    canonical facts contain them, or all the facts of the host matched, they are contained by the searched ones.
+    This is the JSONB @> or <@ operator over the canonical fact index.
+    """
+    host_facts = aliased(HostCanonicalFact)
+    host_fact_count = select([func.count()]).where(host_facts.host_id == HostCanonicalFact.host_id).as_scalar()
+    return (func.count() == fact_count) | (func.count() == host_fact_count)
+
+
 def find_existing_host_by_id(identity, host_id):
     query = Host.query.filter((Host.account == identity.account_number) & (Host.id == UUID(host_id)))
     query = update_query_for_owner_id(identity, query)
@@ -83,14 +444,33 @@ def find_existing_host_by_id(identity, host_id):
 
 @metrics.find_host_using_elevated_ids.time()
 def _find_host_by_elevated_ids(identity, canonical_facts):
-    for elevated_cf_name in ELEVATED_CANONICAL_FACT_FIELDS:
-        cf_value = canonical_facts.get(elevated_cf_name)
-        if cf_value:
-            existing_host = find_host_by_single_canonical_fact(identity, elevated_cf_name, cf_value)
-            if existing_host:
-                return existing_host
+    """
+    Returns the host matching the elevated canonical fact of the highest priority, all of them looked up at once
+    """
+    elevated_facts = _elevated_fact_pairs(canonical_facts)
+    if not elevated_facts:
+        return None
+
+    if inventory_config().host_canonical_facts_lookup:
+        query = (
+            Host.query.join(Host.canonical_fact_index)
+            .filter(
+                (HostCanonicalFact.account == identity.account_number)
+                & tuple_(HostCanonicalFact.fact_name, HostCanonicalFact.fact_value).in_(elevated_facts)
+            )
+            .order_by(_elevated_fact_priority(HostCanonicalFact.fact_name))
+        )
+    else:
+        matches = [Host.canonical_facts[name].astext == value for name, value in elevated_facts]
+        query = Host.query.filter((Host.account == identity.account_number) & or_(*matches)).order_by(
+            case([(match, priority) for priority, match in enumerate(matches)])
+        )
+    host = _deduplication_candidates(query).first()
 
-    return None
+    if host:
+        logger.debug("Found existing host using elevated canonical_fact match: %s", host)
+
+    return host
 
 
 def single_canonical_fact_host_query(identity, canonical_fact, value, restrict_to_owner_id=True):
@@ -115,27 +495,34 @@ def multiple_canonical_facts_host_query(identity, canonical_facts, restrict_to_o
     return find_non_culled_hosts(query)
 
 
-def find_host_by_single_canonical_fact(identity, canonical_fact, value):
-    """
-    Returns first match for a host containing given canonical facts
-    """
-    logger.debug("find_host_by_single_canonical_fact(%s, %s, %s)", identity, canonical_fact, value)
-
-    host = single_canonical_fact_host_query(identity, canonical_fact, value, restrict_to_owner_id=False).first()
-
-    if host:
-        logger.debug("Found existing host using canonical_fact match: %s", host)
-
-    return host
-
-
 def find_host_by_multiple_canonical_facts(identity, canonical_facts):
     """
     Returns first match for a host containing given canonical facts
     """
     logger.debug("find_host_by_multiple_canonical_facts(%s)", canonical_facts)
 
-    host = multiple_canonical_facts_host_query(identity, canonical_facts, restrict_to_owner_id=False).first()
+    if inventory_config().host_canonical_facts_lookup:
+        fact_pairs = canonical_fact_pairs(canonical_facts)
+        matches = (
+            db.session.query(HostCanonicalFact.host_id)
+            .filter(
+                (HostCanonicalFact.account == identity.account_number)
+                & tuple_(HostCanonicalFact.fact_name, HostCanonicalFact.fact_value).in_(fact_pairs)
+            )
+            .group_by(HostCanonicalFact.host_id)
+            .having(_contains_or_contained_by(len(fact_pairs)))
+            .subquery()
+        )
+        query = Host.query.join(matches, Host.id == matches.c.host_id)
+    else:
+        query = Host.query.filter(
+            (Host.account == identity.account_number)
+            & (
+                Host.canonical_facts.comparator.contains(canonical_facts)
+                | Host.canonical_facts.comparator.contained_by(canonical_facts)
+            )
+        )
+    host = _deduplication_candidates(query).first()
 
     if host:
         logger.debug("Found existing host using canonical_fact match: %s", host)
@@ -145,24 +532,100 @@ def find_host_by_multiple_canonical_facts(identity, canonical_facts):
 
 def find_hosts_by_staleness(staleness, query):
     logger.debug("find_hosts_by_staleness(%s)", staleness)
+    return query.filter(_staleness_condition(staleness))
+
+
+def _staleness_condition(staleness):
     config = inventory_config()
     staleness_conditions = tuple(staleness_to_conditions(config, staleness, stale_timestamp_filter))
     if "unknown" in staleness:
         staleness_conditions += (Host.stale_timestamp == NULL,)
-
-    return query.filter(or_(*staleness_conditions))
+    return or_(*staleness_conditions)
 
 
 def find_non_culled_hosts(query):
     return find_hosts_by_staleness(ALL_STALENESS_STATES, query)
 
 
+def _deduplication_candidates(query):
+    # A released host lost its elevated canonical facts to another host, it is not deduplicated against anymore.
+    return find_non_culled_hosts(query).filter(Host.elevated_facts_released.is_(False))
+
+
+def _release_culled_elevated_facts(account, canonical_facts):
+    """
+    A culled host stays in the table until the reaper deletes it, but it is never found again. With the host upsert,
+    it gives its elevated canonical facts up, so that the host registered with them does not conflict with it in the
+    unique indexes.
+    """
+    elevated_facts = _elevated_fact_pairs(canonical_facts)
+    if not elevated_facts:
+        return
+
+    hosts = Host.__table__
+    db.session.execute(
+        hosts.update()
+        .where(
+            (hosts.c.account == account)
+            & or_(*(hosts.c.canonical_facts[name].astext == value for name, value in elevated_facts))
+            & hosts.c.elevated_facts_released.is_(False)
+            & ~_staleness_condition(ALL_STALENESS_STATES)
+        )
+        .values(elevated_facts_released=True)
+    )
+
+
+def _keep_elevated_facts_unique(existing_host, input_host):
+    """
+    With the host upsert, an elevated canonical fact belongs to a single host of the account. An update does not
+    take it from another host that is not culled, the existing host keeps its own value instead.
+    """
+    _release_culled_elevated_facts(input_host.account, input_host.canonical_facts)
+
+    new_facts = [
+        (name, value)
+        for name, value in _elevated_fact_pairs(input_host.canonical_facts)
+        if existing_host.canonical_facts.get(name) != value
+    ]
+    if not new_facts:
+        return
+
+    held_facts = [Host.canonical_facts[name].astext == value for name, value in new_facts]
+    holders = Host.query.filter(
+        (Host.account == input_host.account)
+        & (Host.id != existing_host.id)
+        & or_(*held_facts)
+        & Host.elevated_facts_released.is_(False)
+    )
+    canonical_facts = dict(input_host.canonical_facts)
+    for holder in holders:
+        for name, value in new_facts:
+            if holder.canonical_facts.get(name) == value:
+                logger.warning("Not updating %s of host %s, host %s holds it", name, existing_host.id, holder.id)
+                if name in existing_host.canonical_facts:
+                    canonical_facts[name] = existing_host.canonical_facts[name]
+                else:
+                    canonical_facts.pop(name, None)
+    input_host.canonical_facts = canonical_facts
+
+
+@stage_timer("flush")
+def _flush(deferrable=True):
+    # Coalesced operations on the same host are pushed to the database by the last one.
+    if deferrable and flush_deferred(db.session):
+        return
+    db.session.flush()
+
+
 @metrics.new_host_commit_processing_time.time()
-def create_new_host(input_host, staleness_offset, fields):
+def create_new_host(input_host, staleness_offset, fields, skip_unchanged=False):
     logger.debug("Creating a new host")
 
+    if skip_unchanged:
+        input_host.update_reported_content_hash(input_host.reporter, input_host.reported_content_digest())
     input_host.save()
-    db.session.commit()
+    # The generated id and timestamps are needed right away.
+    _flush(deferrable=False)
 
     metrics.create_host_count.inc()
     logger.debug("Created host:%s", input_host)
@@ -173,12 +636,25 @@ def create_new_host(input_host, staleness_offset, fields):
 
 
 @metrics.update_host_commit_processing_time.time()
-def update_existing_host(existing_host, input_host, staleness_offset, update_system_profile, fields):
+def update_existing_host(
+    existing_host, input_host, staleness_offset, update_system_profile, fields, skip_unchanged=False
+):
     logger.debug("Updating an existing host")
     logger.debug(f"existing host = {existing_host}")
 
+    # The content hash covers the system profile, a partial update can't be compared to it.
+    skip_unchanged = skip_unchanged and update_system_profile
+    if skip_unchanged:
+        content_digest = input_host.reported_content_digest()
+        if existing_host.is_reported_content_unchanged(input_host.reporter, content_digest):
+            return _refresh_existing_host_staleness(existing_host, input_host, staleness_offset, fields)
+
+    if inventory_config().host_upsert:
+        _keep_elevated_facts_unique(existing_host, input_host)
     existing_host.update(input_host, update_system_profile)
-    db.session.commit()
+    if skip_unchanged:
+        existing_host.update_reported_content_hash(input_host.reporter, content_digest)
+    _flush()
 
     metrics.update_host_count.inc()
     logger.debug("Updated host:%s", existing_host)
@@ -188,6 +664,159 @@ def update_existing_host(existing_host, input_host, staleness_offset, update_sys
     return output_host, existing_host.id, insights_id, AddHostResult.updated
 
 
+def _refresh_existing_host_staleness(existing_host, input_host, staleness_offset, fields):
+    logger.debug("Refreshing the staleness of an unchanged host")
+
+    # The events carry the staleness and the reporter of the host, a change of them is still an update downstream.
+    staleness_changed = (existing_host.stale_timestamp, existing_host.reporter) != (
+        input_host.stale_timestamp,
+        input_host.reporter,
+    )
+    existing_host.refresh_staleness(input_host.stale_timestamp, input_host.reporter)
+    # The modification time is an SQL expression until flushed.
+    _flush(deferrable=False)
+
+    metrics.unchanged_host_count.inc()
+    logger.debug("Refreshed staleness of host:%s", existing_host)
+
+    output_host = serialize_host(existing_host, staleness_offset, fields)
+    insights_id = existing_host.canonical_facts.get("insights_id")
+    add_result = AddHostResult.updated if staleness_changed else AddHostResult.unchanged
+    return output_host, existing_host.id, insights_id, add_result
+
+
+def _elevated_canonical_fact(input_host):
+    for elevated_cf_name in ELEVATED_CANONICAL_FACT_FIELDS:
+        if input_host.canonical_facts.get(elevated_cf_name):
+            return elevated_cf_name
+    return None
+
+
+def _jsonb_merge(column, value):
+    return func.coalesce(column, cast({}, JSONB)).op("||")(value)
+
+
+@metrics.upsert_host_commit_processing_time.time()
+def upsert_host(input_host, staleness_offset, update_system_profile, fields):
+    """
+    Creates or updates a host in a single INSERT ... ON CONFLICT statement. The conflict is detected by the unique
+    index on the account and the highest priority elevated canonical fact of the input host. The update merges the
+    input into the existing row the same way Host.update does.
+    """
+    elevated_cf_name = _elevated_canonical_fact(input_host)
+    logger.debug("Upserting a host by %s", elevated_cf_name)
+
+    hosts = Host.__table__
+    now = datetime.now(timezone.utc)
+    host_id = uuid4()
+    reporter_staleness = {
+        "stale_timestamp": input_host.stale_timestamp.isoformat(),
+        "last_check_in": now.isoformat(),
+        "check_in_succeeded": True,
+    }
+    tags = input_host.tags or {}
+    deleted_tag_namespaces = [namespace for namespace, ns_tags in tags.items() if not ns_tags]
+
+    statement = insert(hosts).values(
+        id=host_id,
+        account=input_host.account,
+        display_name=input_host.display_name or input_host.canonical_facts.get("fqdn") or str(host_id),
+        ansible_host=input_host.ansible_host,
+        created_on=now,
+        modified_on=now,
+        facts=input_host.facts or {},
+        tags={namespace: ns_tags for namespace, ns_tags in tags.items() if ns_tags},
+        canonical_facts=input_host.canonical_facts,
+        system_profile_facts=input_host.system_profile_facts or {},
+        stale_timestamp=input_host.stale_timestamp,
+        reporter=input_host.reporter,
+        per_reporter_staleness={input_host.reporter: reporter_staleness},
+    )
+    excluded = statement.excluded
+    canonical_facts = hosts.c.canonical_facts.op("||")(excluded.canonical_facts)
+    host_id_string = cast(hosts.c.id, String)
+    updated_values = {
+        "canonical_facts": canonical_facts,
+        "display_name": input_host.display_name
+        or case(
+            [
+                (
+                    func.coalesce(hosts.c.display_name, "").in_(["", host_id_string]),
+                    func.coalesce(canonical_facts.op("->>")("fqdn"), host_id_string),
+                )
+            ],
+            else_=hosts.c.display_name,
+        ),
+        "ansible_host": hosts.c.ansible_host if input_host.ansible_host is None else excluded.ansible_host,
+        "facts": _jsonb_merge(hosts.c.facts, excluded.facts) if input_host.facts else hosts.c.facts,
+        "tags": hosts.c.tags.op("-")(cast(deleted_tag_namespaces, ARRAY(String))).op("||")(excluded.tags),
+        "system_profile_facts": _jsonb_merge(hosts.c.system_profile_facts, excluded.system_profile_facts)
+        if update_system_profile
+        else hosts.c.system_profile_facts,
+        "stale_timestamp": excluded.stale_timestamp,
+        "reporter": excluded.reporter,
+        "per_reporter_staleness": func.jsonb_set(
+            func.coalesce(hosts.c.per_reporter_staleness, cast({}, JSONB)),
+            cast([input_host.reporter], ARRAY(String)),
+            _jsonb_merge(
+                hosts.c.per_reporter_staleness.op("->")(input_host.reporter), cast(reporter_staleness, JSONB)
+            ),
+        ),
+        "modified_on": now,
+    }
+    statement = statement.on_conflict_do_update(
+        index_elements=[hosts.c.account, text(f"(canonical_facts ->> '{elevated_cf_name}')")],
+        index_where=text("NOT elevated_facts_released"),
+        set_=updated_values,
+        # A culled host is not brought back, nothing is returned then.
+        where=_staleness_condition(ALL_STALENESS_STATES),
+    ).returning(*hosts.c)
+
+    host = _execute_upsert(statement)
+    if host is None:
+        # The culled host gives its elevated canonical facts up and the input is inserted as a new host.
+        _release_culled_elevated_facts(input_host.account, input_host.canonical_facts)
+        host = _execute_upsert(statement)
+
+    # A conflicting row keeps its creation time, only a new row has both timestamps set to now.
+    if host.created_on == now:
+        metrics.create_host_count.inc()
+        add_result = AddHostResult.created
+    else:
+        metrics.update_host_count.inc()
+        add_result = AddHostResult.updated
+    _upsert_canonical_fact_index(host, add_result)
+    logger.debug("Upserted host:%s", host)
+
+    output_host = serialize_host(host, staleness_offset, fields)
+    insights_id = host.canonical_facts.get("insights_id")
+    return output_host, host.id, insights_id, add_result
+
+
+def _execute_upsert(statement):
+    # The returned row is loaded into the session like a queried host.
+    hosts = db.session.query(Host).populate_existing().instances(db.session.execute(statement))
+    return next(iter(hosts), None)
+
+
+def _upsert_canonical_fact_index(host, add_result):
+    # The upsert bypasses the ORM, the lookup table rows are written by SQL statements too.
+    table = HostCanonicalFact.__table__
+    fact_pairs = canonical_fact_pairs(host.canonical_facts)
+    if add_result == AddHostResult.updated:
+        db.session.execute(
+            table.delete().where(
+                (table.c.host_id == host.id) & ~tuple_(table.c.fact_name, table.c.fact_value).in_(fact_pairs)
+            )
+        )
+    rows = [
+        {"host_id": host.id, "account": host.account, "fact_name": fact_name, "fact_value": fact_value}
+        for fact_name, fact_value in sorted(fact_pairs)
+    ]
+    db.session.execute(insert(table).values(rows).on_conflict_do_nothing())
+    db.session.expire(host, ["canonical_fact_index"])
+
+
 def stale_timestamp_filter(gt=None, lte=None):
     filter_ = ()
     if gt:
@@ -214,24 +843,29 @@ def update_system_profile(input_host, identity, staleness_offset, fields):
         )
 
     with session_guard(db.session):
+        # Every operation resolves its own host, with the owner restriction of its identity.
         if input_host.id:
             existing_host = find_existing_host_by_id(identity, input_host.id)
         else:
             existing_host = find_existing_host(identity, input_host.canonical_facts)
 
+        coalesced_writes = get_coalesced_writes(db.session)
+        if coalesced_writes and coalesced_writes.host and existing_host and existing_host is not coalesced_writes.host:
+            raise CoalescingConflict(f"Host {existing_host.id} is not the coalesced host {coalesced_writes.host.id}")
+
         if existing_host:
             logger.debug("Updating system profile on an existing host")
             logger.debug(f"existing host = {existing_host}")
 
             existing_host.update_system_profile(input_host.system_profile_facts)
-            db.session.commit()
+            _flush()
 
             metrics.update_host_count.inc()
             logger.debug("Updated system profile for host:%s", existing_host)
 
             output_host = serialize_host(existing_host, staleness_offset, fields)
             insights_id = existing_host.canonical_facts.get("insights_id")
-            return output_host, existing_host.id, insights_id, AddHostResult.updated
+            return _coalesce(coalesced_writes, (output_host, existing_host.id, insights_id, AddHostResult.updated))
         else:
             raise InventoryException(
                 title="Invalid request", detail="Could not find an existing host with the provided facts."
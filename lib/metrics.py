@@ -4,6 +4,9 @@ from prometheus_client import Summary
 host_dedup_processing_time = Summary(
     "inventory_dedup_processing_seconds", "Time spent looking for existing host (dedup logic)"
 )
+host_bulk_dedup_processing_time = Summary(
+    "inventory_bulk_dedup_processing_seconds", "Time spent looking for existing hosts of a batch (bulk dedup logic)"
+)
 find_host_using_elevated_ids = Summary(
     "inventory_find_host_using_elevated_ids_processing_seconds",
     "Time spent looking for existing host using the elevated ids",
@@ -14,8 +17,14 @@ new_host_commit_processing_time = Summary(
 update_host_commit_processing_time = Summary(
     "inventory_update_host_commit_seconds", "Time spent committing a update host to the database"
 )
+upsert_host_commit_processing_time = Summary(
+    "inventory_upsert_host_commit_seconds", "Time spent upserting a host to the database"
+)
 create_host_count = Counter("inventory_create_host_count", "The total amount of hosts created")
 update_host_count = Counter("inventory_update_host_count", "The total amount of hosts updated")
+unchanged_host_count = Counter(
+    "inventory_unchanged_host_count", "The total amount of re-reported unchanged hosts whose update was skipped"
+)
 delete_host_count = Counter("inventory_delete_host_count", "The total amount of hosts deleted")
 delete_host_processing_time = Summary(
     "inventory_delete_host_commit_seconds", "Time spent deleting hosts from the database"
@@ -29,3 +38,15 @@ synchronize_fail_count = Counter("inventory_synchronize_fail_count", "The total
 pendo_fetching_failure = Counter(
     "inventory_pendo_syncher_failures", "Total amount of failures while sending Pendo data"
 )
+identity_cache_hit = Counter(
+    "inventory_identity_cache_hits", "The total amount of identity headers found in the decoded identity cache"
+)
+identity_cache_miss = Counter(
+    "inventory_identity_cache_misses", "The total amount of identity headers decoded because they were not cached"
+)
+host_count_cache_hit = Counter(
+    "inventory_host_count_cache_hits", "The total amount of host list totals found in the host count cache"
+)
+host_count_cache_miss = Counter(
+    "inventory_host_count_cache_misses", "The total amount of host list totals counted because they were not cached"
+)
@@ -0,0 +1,28 @@
+"""Add the elevated facts released column
+
+Revision ID: 9a8c2f1e4b7d
+Revises: 3d06b0a8828f
+Create Date: 2026-10-18 10:12:41.527190
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "9a8c2f1e4b7d"
+down_revision = "3d06b0a8828f"
+branch_labels = None
+depends_on = None
+
+
+# The unique indexes on the elevated canonical facts are not created here. They are needed only by the host upsert
+# and utils/create_host_upsert_indexes.py builds them, after resolving the duplicate hosts.
+def upgrade():
+    op.add_column(
+        "hosts", sa.Column("elevated_facts_released", sa.Boolean(), nullable=False, server_default=sa.false())
+    )
+
+
+def downgrade():
+    op.drop_column("hosts", "elevated_facts_released")
@@ -0,0 +1,88 @@
+"""Add the host canonical facts lookup table
+
+Revision ID: c3e5a1f7d2b9
+Revises: 9a8c2f1e4b7d
+Create Date: 2026-10-18 18:22:05.913472
+
+"""
+import os
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+
+from migrations.helpers import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "c3e5a1f7d2b9"
+down_revision = "9a8c2f1e4b7d"
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = int(os.getenv("CANONICAL_FACTS_BACKFILL_CHUNK_SIZE", "1000"))
+
+# Copies the canonical facts of a chunk of hosts ordered by id, a row for every item of a list fact. Returns the
+# last host id of the chunk, the next chunk starts after it.
+BACKFILL_CHUNK = sa.text(
+    """
+    WITH chunk AS (
+        SELECT id, account, canonical_facts FROM hosts WHERE id > :last_id ORDER BY id LIMIT :chunk_size
+    ), facts AS (
+        SELECT chunk.id, chunk.account, fact.key, fact.value
+        FROM chunk, jsonb_each(chunk.canonical_facts) AS fact
+    ), inserted AS (
+        INSERT INTO host_canonical_facts (host_id, account, fact_name, fact_value)
+        SELECT id, account, key, value #>> '{}' FROM facts WHERE jsonb_typeof(value) = 'string'
+        UNION
+        SELECT id, account, key, jsonb_array_elements_text(value) FROM facts WHERE jsonb_typeof(value) = 'array'
+        ON CONFLICT DO NOTHING
+    )
+    SELECT id FROM chunk ORDER BY id DESC LIMIT 1
+    """
+)
+
+
+def _backfill(logger_):
+    # Every chunk is committed on its own, the backfill does not hold a single transaction over the whole table. An
+    # upgrade run again after a failed backfill keeps the table and skips the rows inserted already.
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        last_id = "00000000-0000-0000-0000-000000000000"
+        hosts = 0
+        while True:
+            last_id = connection.execute(BACKFILL_CHUNK, last_id=last_id, chunk_size=CHUNK_SIZE).scalar()
+            if last_id is None:
+                break
+            hosts += CHUNK_SIZE
+            logger_.info("Backfilled the canonical facts of up to %d hosts", hosts)
+
+
+def upgrade():
+    if "host_canonical_facts" not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            "host_canonical_facts",
+            sa.Column(
+                "host_id",
+                UUID(as_uuid=True),
+                sa.ForeignKey("hosts.id", ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True,
+            ),
+            sa.Column("fact_name", sa.String(255), primary_key=True),
+            sa.Column("fact_value", sa.String, primary_key=True),
+            sa.Column("account", sa.String(10), nullable=False),
+        )
+    # The hosts written by the pods still running the previous version are not in the table. The deduplication does
+    # not use it until utils/sync_host_canonical_facts.py has caught up with them, see host_canonical_facts_lookup.
+    _backfill(logger(__name__))
+    # The deduplication looks the facts up by account, name and value. The host id makes it an index-only scan.
+    op.create_index(
+        "host_canonical_facts_account_fact_host_id_idx",
+        "host_canonical_facts",
+        ["account", "fact_name", "fact_value", "host_id"],
+    )
+
+
+def downgrade():
+    op.drop_index("host_canonical_facts_account_fact_host_id_idx", table_name="host_canonical_facts")
+    op.drop_table("host_canonical_facts")
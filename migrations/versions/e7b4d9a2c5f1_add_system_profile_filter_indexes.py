@@ -0,0 +1,36 @@
+"""Add indexes for filtering the hosts by their system profile
+
+Revision ID: e7b4d9a2c5f1
+Revises: c3e5a1f7d2b9
+Create Date: 2026-10-18 21:04:37.218645
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e7b4d9a2c5f1"
+down_revision = "c3e5a1f7d2b9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Serves the containment (@>) filters. The installed packages are left out, they would make up most of the
+    # index entries.
+    op.create_index(
+        "hosts_system_profile_facts_gin",
+        "hosts",
+        [sa.text("(system_profile_facts - 'installed_packages') jsonb_path_ops")],
+        postgresql_using="gin",
+    )
+    # The hosts of a system identity are limited to the ones it owns.
+    op.create_index(
+        "hosts_account_owner_id_index", "hosts", ["account", sa.text("(system_profile_facts ->> 'owner_id')")]
+    )
+
+
+def downgrade():
+    op.drop_index("hosts_account_owner_id_index", table_name="hosts")
+    op.drop_index("hosts_system_profile_facts_gin", table_name="hosts")
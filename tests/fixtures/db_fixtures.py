@@ -13,6 +13,8 @@ from tests.helpers.db_utils import minimal_db_host
 from tests.helpers.test_utils import now
 from tests.helpers.test_utils import set_environment
 from tests.helpers.test_utils import SYSTEM_IDENTITY
+from utils.create_host_upsert_indexes import create_unique_indexes
+from utils.create_host_upsert_indexes import drop_unique_indexes
 
 
 @pytest.fixture(scope="session")
@@ -106,6 +108,19 @@ def db_create_host_in_unknown_state(db_create_host):
     return db_create_host(host=host)
 
 
+@pytest.fixture(scope="function")
+def host_upsert(inventory_config):
+    create_unique_indexes(db.session.connection(), concurrently=False)
+    db.session.commit()
+    inventory_config.host_upsert = True
+
+    yield
+
+    db.session.rollback()
+    drop_unique_indexes(db.session.connection(), concurrently=False)
+    db.session.commit()
+
+
 @pytest.fixture(scope="function")
 def models_datetime_mock(mocker):
     mock = mocker.patch("app.models.datetime", **{"now.return_value": now()})
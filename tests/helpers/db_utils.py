@@ -27,7 +27,8 @@ def clean_tables():
     def _clean_tables():
         logger.warning("cleaning database tables")
         try:
-            db.session.expire_all()
+            # Discards the changes a test did not commit, pending rows would be flushed by the deletes.
+            db.session.rollback()
             for table in reversed(db.metadata.sorted_tables):
                 db.session.execute(table.delete())
             db.session.commit()
@@ -54,6 +54,10 @@ class MockFuture:
     def add_errback(self, *args, **kwargs):
         self._add(self.errbacks, args, kwargs)
 
+    def add_both(self, *args, **kwargs):
+        self.add_callback(*args, **kwargs)
+        self.add_errback(*args, **kwargs)
+
     def success(self):
         self._fire(self.callbacks)
 
@@ -1,11 +1,15 @@
 import copy
 import uuid
+from base64 import urlsafe_b64encode
 from itertools import chain
 
 import pytest
 
 from app.auth.identity import Identity
+from app.models import db
+from app.models import Host
 from app.utils import HostWrapper
+from lib.host_count import invalidate_host_counts
 from lib.host_repository import find_hosts_by_staleness
 from lib.host_repository import single_canonical_fact_host_query
 from tests.helpers.api_utils import api_base_pagination_test
@@ -814,6 +818,150 @@ def test_hosts_ordered_by_display_name_are_also_ordered_by_id_desc(
     )
 
 
+@pytest.mark.parametrize("order_how", (None, "ASC", "DESC"))
+def test_query_hosts_with_cursor(db_create_multiple_hosts, api_get, order_how):
+    created_hosts = db_create_multiple_hosts(how_many=7)
+    # Hosts with the same modification time are ordered by their id.
+    modified_on = now()
+    for host in created_hosts[2:5]:
+        update_host_in_db(host.id, modified_on=modified_on)
+
+    query_parameters = {"per_page": 2, **build_order_query_parameters(order_by="updated", order_how=order_how)}
+    response_status, response_data = api_get(HOST_URL, query_parameters={**query_parameters, "per_page": 100})
+    assert response_status == 200
+    expected_ids = [host["id"] for host in response_data["results"]]
+    assert "next_cursor" not in response_data
+
+    pages = []
+    cursor_parameters = {}
+    while True:
+        response_status, response_data = api_get(HOST_URL, query_parameters={**query_parameters, **cursor_parameters})
+        assert response_status == 200
+        assert response_data["total"] == 7
+        pages.append([host["id"] for host in response_data["results"]])
+        if "next_cursor" not in response_data:
+            break
+        cursor_parameters = {"cursor": response_data["next_cursor"]}
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    assert list(chain.from_iterable(pages)) == expected_ids
+
+
+def test_query_hosts_next_cursor_of_offset_page(db_create_multiple_hosts, api_get):
+    db_create_multiple_hosts(how_many=5)
+    _, response_data = api_get(HOST_URL)
+    all_ids = [host["id"] for host in response_data["results"]]
+
+    response_status, response_data = api_get(HOST_URL, query_parameters={"per_page": 2, "page": 2})
+    assert response_status == 200
+    response_status, response_data = api_get(
+        HOST_URL, query_parameters={"per_page": 2, "cursor": response_data["next_cursor"]}
+    )
+    assert response_status == 200
+    assert [host["id"] for host in response_data["results"]] == all_ids[4:]
+
+
+def test_query_hosts_with_invalid_cursor(db_create_multiple_hosts, api_get, subtests):
+    db_create_multiple_hosts(how_many=2)
+
+    invalid_cursors = (
+        "invalid",
+        urlsafe_b64encode(b"[]").decode("ascii"),
+        urlsafe_b64encode(b'["DESC", "not a date", "not an id"]').decode("ascii"),
+        # A position without the ordering direction
+        urlsafe_b64encode(f'["{now().isoformat()}", "{generate_uuid()}"]'.encode("utf-8")).decode("ascii"),
+    )
+    for cursor in invalid_cursors:
+        with subtests.test(cursor=cursor):
+            response_status, response_data = api_get(HOST_URL, query_parameters={"cursor": cursor})
+            assert_response_status(response_status, expected_status=400)
+
+
+def test_query_hosts_with_cursor_by_display_name(db_create_multiple_hosts, api_get):
+    db_create_multiple_hosts(how_many=3)
+    response_status, response_data = api_get(HOST_URL, query_parameters={"per_page": 1})
+    next_cursor = response_data["next_cursor"]
+
+    response_status, response_data = api_get(
+        HOST_URL, query_parameters={"order_by": "display_name", "cursor": next_cursor}
+    )
+    assert_response_status(response_status, expected_status=400)
+
+
+@pytest.mark.parametrize(("first_order_how", "next_order_how"), ((None, "ASC"), ("DESC", "ASC"), ("ASC", "DESC")))
+def test_query_hosts_with_cursor_of_other_order_how(
+    db_create_multiple_hosts, api_get, first_order_how, next_order_how
+):
+    db_create_multiple_hosts(how_many=3)
+    response_status, response_data = api_get(
+        HOST_URL,
+        query_parameters={
+            "per_page": 1,
+            **build_order_query_parameters(order_by="updated", order_how=first_order_how),
+        },
+    )
+    next_cursor = response_data["next_cursor"]
+
+    response_status, response_data = api_get(
+        HOST_URL, query_parameters={"order_by": "updated", "order_how": next_order_how, "cursor": next_cursor}
+    )
+    assert_response_status(response_status, expected_status=400)
+
+
+@pytest.mark.parametrize("count_strategy", ("exact", "estimated", "cached"))
+def test_query_hosts_with_count_strategy(db_create_multiple_hosts, api_get, count_strategy):
+    created_hosts = db_create_multiple_hosts(how_many=3)
+
+    response_status, response_data = api_get(
+        HOST_URL, query_parameters={"per_page": 2, "count_strategy": count_strategy}
+    )
+    assert response_status == 200
+    assert response_data["count_strategy"] == count_strategy
+    assert len(response_data["results"]) == 2
+    # The planner estimate depends on the table statistics, it is not checked against the number of hosts.
+    assert isinstance(response_data["total"], int)
+    if count_strategy != "estimated":
+        assert response_data["total"] == len(created_hosts)
+
+
+def test_query_hosts_default_count_strategy(db_create_multiple_hosts, api_get):
+    db_create_multiple_hosts(how_many=2)
+
+    response_status, response_data = api_get(HOST_URL)
+    assert response_status == 200
+    assert response_data["count_strategy"] == "exact"
+    assert response_data["total"] == 2
+
+
+def test_query_hosts_cached_count(db_create_multiple_hosts, db_create_host, api_get):
+    created_hosts = db_create_multiple_hosts(how_many=2)
+    invalidate_host_counts(created_hosts[0].account)
+    query_parameters = {"count_strategy": "cached"}
+
+    _, response_data = api_get(HOST_URL, query_parameters=query_parameters)
+    assert response_data["total"] == 2
+
+    # A write bypassing the ORM, as another process would, is not seen before the TTL expires.
+    db.session.execute(Host.__table__.delete().where(Host.id == created_hosts[0].id))
+    db.session.commit()
+    _, response_data = api_get(HOST_URL, query_parameters=query_parameters)
+    assert response_data["total"] == 2
+    _, response_data = api_get(HOST_URL)
+    assert response_data["total"] == 1
+
+    # A host written by this process drops the cached totals of its account.
+    db_create_host()
+    _, response_data = api_get(HOST_URL, query_parameters=query_parameters)
+    assert response_data["total"] == 2
+
+
+def test_query_hosts_with_invalid_count_strategy(db_create_multiple_hosts, api_get):
+    db_create_multiple_hosts(how_many=1)
+
+    response_status, response_data = api_get(HOST_URL, query_parameters={"count_strategy": "guessed"})
+    assert_response_status(response_status, expected_status=400)
+
+
 def test_invalid_order_by(mq_create_three_specific_hosts, api_get, subtests):
     created_hosts = mq_create_three_specific_hosts
 
@@ -1121,6 +1269,170 @@ def test_host_list_sp_fields_not_requested(patch_xjoin_post, query_source_xjoin,
         assert "system_profile" not in host_data
 
 
+def test_sp_sparse_fields_db(db_create_multiple_hosts, api_get, subtests):
+    system_profile = {
+        "os_kernel_version": "3.10.0",
+        "arch": "x86_64",
+        "sap_sids": ["H2O", "PH3", "CO2"],
+        "installed_packages": ["rpm1-0:0.0.1.el7.x86_64"],
+    }
+    hosts = db_create_multiple_hosts(how_many=2, extra_data={"system_profile_facts": system_profile})
+
+    for query, expected_system_profile in (
+        (
+            "?fields[system_profile]=os_kernel_version,arch,sap_sids",
+            {"os_kernel_version": "3.10.0", "arch": "x86_64", "sap_sids": ["H2O", "PH3", "CO2"]},
+        ),
+        ("?fields[system_profile]=arch&fields[system_profile]=unknown_field", {"arch": "x86_64"}),
+        ("?fields[system_profile]=unknown_field", {}),
+    ):
+        with subtests.test(query=query):
+            response_status, response_data = api_get(build_system_profile_url(hosts, query=query))
+
+            assert_response_status(response_status, 200)
+            assert response_data["total"] == 2
+            for result in response_data["results"]:
+                assert result["system_profile"] == expected_system_profile
+
+    response_status, response_data = api_get(build_system_profile_url(hosts))
+    assert_response_status(response_status, 200)
+    for result in response_data["results"]:
+        assert result["system_profile"] == system_profile
+
+
+def test_sp_sparse_fields_db_invalid_requests(db_create_host, api_get, subtests):
+    host = db_create_host()
+
+    for query in (
+        "?fields[system_profile]=os_kernel_version&order_how=ASC",
+        "?fields[system_profile]=os_kernel_version&order_by=modified",
+        "?fields[foo]=bar",
+    ):
+        with subtests.test(query=query):
+            response_status, response_data = api_get(build_system_profile_url([host], query=query))
+            assert_response_status(response_status, 400)
+
+
+def test_host_list_sp_fields_requested_db(db_create_multiple_hosts, api_get):
+    system_profile = {"arch": "x86_64", "os_kernel_version": "3.10.0", "installed_packages": ["rpm1"]}
+    db_create_multiple_hosts(how_many=3, extra_data={"system_profile_facts": system_profile})
+
+    response_status, response_data = api_get(HOST_URL, query_parameters={"fields[system_profile]": "arch,random"})
+    assert response_status == 200
+    assert len(response_data["results"]) == 3
+    for host_data in response_data["results"]:
+        assert host_data["system_profile"] == {"arch": "x86_64"}
+
+    # The sparse system profile is not written back.
+    response_status, response_data = api_get(
+        HOST_URL, query_parameters={"fields[system_profile]": "installed_packages"}
+    )
+    for host_data in response_data["results"]:
+        assert host_data["system_profile"] == {"installed_packages": ["rpm1"]}
+
+
+def test_host_list_sp_fields_not_requested_db(db_create_multiple_hosts, api_get):
+    db_create_multiple_hosts(how_many=2, extra_data={"system_profile_facts": {"arch": "x86_64"}})
+
+    response_status, response_data = api_get(HOST_URL)
+    assert response_status == 200
+    for host_data in response_data["results"]:
+        assert "system_profile" not in host_data
+
+
+@pytest.fixture(scope="function")
+def db_create_filtered_hosts(db_create_host):
+    system_profiles = (
+        {
+            "rhc_client_id": "8dd97934-8ce4-11eb-8dcd-0242ac130003",
+            "host_type": "edge",
+            "sap_system": True,
+            "sap_sids": ["H2O", "PH3"],
+            "insights_client_version": "3.0.6-2.el7_6",
+            "number_of_cpus": 2,
+            "operating_system": {"name": "RHEL", "major": 7, "minor": 9},
+            "installed_packages": ["rpm1-0:0.0.1.el7.x86_64"],
+        },
+        {
+            "rhc_client_id": "6e2c3332-936c-4167-b9be-c219f4303c85",
+            "sap_system": False,
+            "sap_sids": ["H2O"],
+            "insights_client_version": "2.1.0",
+            "number_of_cpus": 8,
+            "operating_system": {"name": "RHEL", "major": 8, "minor": 4},
+        },
+        {},
+    )
+    return [
+        str(db_create_host(extra_data={"system_profile_facts": system_profile}).id)
+        for system_profile in system_profiles
+    ]
+
+
+@pytest.mark.parametrize(
+    "query,expected_hosts",
+    (
+        ("[rhc_client_id]=8dd97934-8ce4-11eb-8dcd-0242ac130003", (0,)),
+        ("[rhc_client_id][eq]=6e2c3332-936c-4167-b9be-c219f4303c85", (1,)),
+        ("[rhc_client_id]=nil", (2,)),
+        ("[rhc_client_id][eq]=not_nil", (0, 1)),
+        (
+            "[rhc_client_id][eq][]=8dd97934-8ce4-11eb-8dcd-0242ac130003"
+            "&filter[system_profile][rhc_client_id][eq][]=6e2c3332-936c-4167-b9be-c219f4303c85",
+            (0, 1),
+        ),
+        ("[host_type]=edge", (0,)),
+        ("[sap_system]=true", (0,)),
+        ("[sap_system]=False", (1,)),
+        ("[sap_sids]=H2O", (0, 1)),
+        ("[sap_sids][]=H2O&filter[system_profile][sap_sids][]=PH3", (0,)),
+        ("[insights_client_version]=3.*", (0,)),
+        ("[insights_client_version]=2.1.0", (1,)),
+        ("[number_of_cpus]=2", (0,)),
+        ("[number_of_cpus][gte]=4", (1,)),
+        ("[number_of_cpus][gt]=1&filter[system_profile][number_of_cpus][lte]=2", (0,)),
+        ("[operating_system][RHEL][version][gte]=8", (1,)),
+        ("[operating_system][RHEL][version][lt]=7.10", (0,)),
+        (
+            "[operating_system][RHEL][version][gt]=7.4"
+            "&filter[system_profile][operating_system][RHEL][version][lt]=8.4",
+            (0,),
+        ),
+        ("[operating_system][CENT][version][gte]=7", ()),
+        ("[installed_packages]=rpm1-0:0.0.1.el7.x86_64", (0,)),
+        ("[sap_system]=true&filter[system_profile][number_of_cpus][gte]=4", ()),
+    ),
+)
+def test_query_hosts_filter_system_profile_db(db_create_filtered_hosts, api_get, query, expected_hosts):
+    response_status, response_data = api_get(build_hosts_url(query=f"?filter[system_profile]{query}"))
+
+    assert_response_status(response_status, 200)
+    assert response_data["total"] == len(expected_hosts)
+    assert {host["id"] for host in response_data["results"]} == {
+        db_create_filtered_hosts[index] for index in expected_hosts
+    }
+
+
+def test_query_hosts_filter_system_profile_db_invalid(db_create_filtered_hosts, api_get, subtests):
+    for query in (
+        "[sap_system]=maybe",
+        "[number_of_cpus]=many",
+        "[number_of_cpus][lt]=many",
+        "[number_of_cpus][matches]=1",
+        "[rhc_client_id][foo]=bar",
+        "[operating_system][RHEL]=7",
+        "[operating_system][RHEL][version][eq]=7",
+        "[rhsm]=foo",
+        "[unknown_field]=foo",
+    ):
+        with subtests.test(query=query):
+            response_status, _ = api_get(build_hosts_url(query=f"?filter[system_profile]{query}"))
+            assert_response_status(response_status, 400)
+
+    response_status, _ = api_get(build_hosts_url(query="?filter[foo]=bar"))
+    assert_response_status(response_status, 400)
+
+
 def test_unindexed_fields_fail_gracefully(query_source_xjoin, api_get):
     url_builders = (
         build_hosts_url,
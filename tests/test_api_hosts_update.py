@@ -293,12 +293,12 @@ def test_event_producer_instrumentation(mocker, event_producer, future_mock, db_
         (message_produced, future_mock.callbacks, future_mock.success),
         (message_not_produced, future_mock.errbacks, future_mock.failure),
     ):
-        assert len(future_callbacks) == 1
-        assert future_callbacks[0].method == expected_callback
+        instrumentation_callbacks = [callback for callback in future_callbacks if callback.method == expected_callback]
+        assert len(instrumentation_callbacks) == 1
 
         fire_callbacks()
-        args = future_callbacks[0].args + (future_callbacks[0].extra_arg,)
-        expected_callback.assert_called_once_with(*args, **future_callbacks[0].kwargs)
+        args = instrumentation_callbacks[0].args + (instrumentation_callbacks[0].extra_arg,)
+        expected_callback.assert_called_once_with(*args, **instrumentation_callbacks[0].kwargs)
 
 
 def test_add_facts_without_fact_dict(api_patch, db_create_host):
@@ -1,9 +1,29 @@
+from pytest import fixture
 from pytest import mark
-
+from sqlalchemy import event
+
+from app.auth.identity import Identity
+from app.models import canonical_fact_pairs
+from app.models import db
+from app.models import Host
+from app.models import HostCanonicalFact
+from lib.host_repository import ELEVATED_CANONICAL_FACT_FIELDS
+from lib.host_repository import find_existing_host
+from lib.host_repository import find_existing_hosts
+from lib.host_repository import multiple_canonical_facts_host_query
 from tests.helpers.db_utils import assert_host_exists_in_db
 from tests.helpers.db_utils import minimal_db_host
 from tests.helpers.test_utils import generate_uuid
 from tests.helpers.test_utils import minimal_host
+from tests.helpers.test_utils import now
+from tests.helpers.test_utils import USER_IDENTITY
+
+
+@fixture(autouse=True, params=(False, True), ids=("canonical_facts", "lookup_table"))
+def host_canonical_facts_lookup(request, inventory_config):
+    # Every deduplication test runs with both the host canonical facts and the lookup table searched.
+    inventory_config.host_canonical_facts_lookup = request.param
+    yield request.param
 
 
 def test_find_host_using_subset_canonical_fact_match(db_create_host):
@@ -122,3 +142,159 @@ def test_provider_id_preference_over_other_elevated_facts(db_create_host, host_c
     }
 
     assert_host_exists_in_db(created_hosts[expected_host].id, search_canonical_facts)
+
+
+def test_find_existing_hosts_matches_find_existing_host(db_create_host):
+    identity = Identity(USER_IDENTITY)
+    other_account_identity = Identity({**USER_IDENTITY, "account_number": "other"})
+
+    insights_id_host = db_create_host(host=minimal_db_host(canonical_facts={"insights_id": generate_uuid()}))
+    smid_host = db_create_host(host=minimal_db_host(canonical_facts={"subscription_manager_id": generate_uuid()}))
+    provider_host = db_create_host(
+        host=minimal_db_host(canonical_facts={"provider_type": "aws", "provider_id": generate_uuid()})
+    )
+    subset_host = db_create_host(host=minimal_db_host(canonical_facts={"fqdn": "fred", "bios_uuid": generate_uuid()}))
+
+    search = (
+        (identity, {"insights_id": insights_id_host.canonical_facts["insights_id"], "fqdn": "barney"}),
+        (identity, {"subscription_manager_id": smid_host.canonical_facts["subscription_manager_id"]}),
+        (identity, {**provider_host.canonical_facts, "insights_id": generate_uuid()}),
+        (identity, {"fqdn": "fred"}),
+        (identity, {**subset_host.canonical_facts, "rhel_machine_id": generate_uuid()}),
+        (identity, {"insights_id": generate_uuid()}),
+        (other_account_identity, {"insights_id": insights_id_host.canonical_facts["insights_id"]}),
+    )
+
+    found_hosts = find_existing_hosts(search)
+
+    assert [host and host.id for host in found_hosts] == [
+        insights_id_host.id,
+        smid_host.id,
+        provider_host.id,
+        subset_host.id,
+        subset_host.id,
+        None,
+        None,
+    ]
+    assert found_hosts == [find_existing_host(identity, canonical_facts) for identity, canonical_facts in search]
+
+
+def test_find_existing_hosts_elevated_fact_priority(db_create_host):
+    multiple_hosts_canonical_facts = (
+        {"subscription_manager_id": generate_uuid()},
+        {"insights_id": generate_uuid()},
+        {"provider_type": "aws", "provider_id": generate_uuid()},
+    )
+    created_hosts = [
+        db_create_host(host=minimal_db_host(canonical_facts=canonical_facts))
+        for canonical_facts in multiple_hosts_canonical_facts
+    ]
+
+    identity = Identity(USER_IDENTITY)
+    search = (
+        (identity, {**multiple_hosts_canonical_facts[0], **multiple_hosts_canonical_facts[1]}),
+        (identity, {**multiple_hosts_canonical_facts[0], **multiple_hosts_canonical_facts[2]}),
+        (
+            identity,
+            {
+                key: value
+                for canonical_facts in multiple_hosts_canonical_facts
+                for key, value in canonical_facts.items()
+            },
+        ),
+    )
+
+    found_hosts = find_existing_hosts(search)
+
+    assert [host.id for host in found_hosts] == [created_hosts[1].id, created_hosts[2].id, created_hosts[2].id]
+
+
+def test_find_existing_hosts_constant_number_of_queries(db_create_multiple_hosts):
+    created_hosts = db_create_multiple_hosts(how_many=20)
+    identity = Identity(USER_IDENTITY)
+    search = [(identity, host.canonical_facts) for host in created_hosts] + [(identity, {"fqdn": generate_uuid()})]
+
+    statements = []
+
+    def _count_statement(*args, **kwargs):
+        statements.append(args)
+
+    event.listen(db.engine, "before_cursor_execute", _count_statement)
+    try:
+        found_hosts = find_existing_hosts(search)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _count_statement)
+
+    assert [host and host.id for host in found_hosts] == [host.id for host in created_hosts] + [None]
+    assert len(statements) <= len(ELEVATED_CANONICAL_FACT_FIELDS) + 1
+
+
+def _indexed_canonical_facts(host_id):
+    rows = HostCanonicalFact.query.filter(HostCanonicalFact.host_id == host_id).all()
+    return {(row.account, row.fact_name, row.fact_value) for row in rows}
+
+
+def _expected_index(host):
+    return {
+        (host.account, fact_name, fact_value) for fact_name, fact_value in canonical_fact_pairs(host.canonical_facts)
+    }
+
+
+def test_canonical_fact_index_follows_host_changes(db_create_host):
+    canonical_facts = {"fqdn": "fred", "ip_addresses": ["10.0.0.1", "10.0.0.2"]}
+    host = db_create_host(host=minimal_db_host(canonical_facts=canonical_facts))
+    assert _indexed_canonical_facts(host.id) == _expected_index(host)
+
+    input_host = Host(
+        {"ip_addresses": ["10.0.0.2", "10.0.0.3"], "bios_uuid": generate_uuid()},
+        reporter="test",
+        stale_timestamp=now(),
+    )
+    host.update(input_host)
+    db.session.commit()
+
+    assert host.canonical_facts["ip_addresses"] == ["10.0.0.2", "10.0.0.3"]
+    assert _indexed_canonical_facts(host.id) == _expected_index(host)
+
+    db.session.delete(host)
+    db.session.commit()
+    assert _indexed_canonical_facts(host.id) == set()
+
+
+@mark.parametrize(
+    "search_canonical_facts",
+    (
+        {"ip_addresses": ["10.0.0.1"]},
+        {"ip_addresses": ["10.0.0.2", "10.0.0.1"], "fqdn": "fred"},
+        {"ip_addresses": ["10.0.0.1", "10.0.0.2", "10.0.0.3"], "fqdn": "fred", "bios_uuid": generate_uuid()},
+        {"ip_addresses": ["10.0.0.1", "10.0.0.3"]},
+        {"ip_addresses": ["10.0.0.1"], "fqdn": "barney"},
+        {"fqdn": "fred", "rhel_machine_id": generate_uuid()},
+        {"mac_addresses": ["aa:bb:cc:dd:ee:ff"]},
+    ),
+)
+def test_find_host_by_canonical_fact_index_matches_jsonb_containment(db_create_host, search_canonical_facts):
+    canonical_facts = {"fqdn": "fred", "ip_addresses": ["10.0.0.1", "10.0.0.2"]}
+    db_create_host(host=minimal_db_host(canonical_facts=canonical_facts))
+    db_create_host(host=minimal_db_host(canonical_facts={"fqdn": "wilma"}))
+    identity = Identity(USER_IDENTITY)
+
+    expected_host = multiple_canonical_facts_host_query(
+        identity, search_canonical_facts, restrict_to_owner_id=False
+    ).one_or_none()
+
+    assert find_existing_host(identity, search_canonical_facts) == expected_host
+    assert find_existing_hosts(((identity, search_canonical_facts),)) == [expected_host]
+
+
+def test_find_host_missing_from_canonical_fact_index(db_create_host, host_canonical_facts_lookup):
+    # A host written by a version not maintaining the lookup table, before the table is synced.
+    canonical_facts = {"insights_id": generate_uuid(), "fqdn": "fred"}
+    host = db_create_host(host=minimal_db_host(canonical_facts=canonical_facts))
+    HostCanonicalFact.query.filter(HostCanonicalFact.host_id == host.id).delete()
+    db.session.commit()
+    identity = Identity(USER_IDENTITY)
+
+    for search_canonical_facts in (canonical_facts, {"fqdn": "fred"}):
+        found_host = find_existing_host(identity, search_canonical_facts)
+        assert found_host == (None if host_canonical_facts_lookup else host)
@@ -1,21 +1,45 @@
 import json
+import threading
+from collections import defaultdict
 from copy import deepcopy
 from datetime import datetime
 from datetime import timedelta
+from functools import partial
+from types import SimpleNamespace
 
 import marshmallow
 import pytest
+from kafka import TopicPartition
+from kafka.structs import OffsetAndMetadata
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.exc import OperationalError
 
 from app import UNKNOWN_REQUEST_ID_VALUE
+from app.auth.identity import Identity
 from app.exceptions import InventoryException
 from app.exceptions import ValidationException
 from app.logging import threadctx
+from app.models import canonical_fact_pairs
+from app.models import db
+from app.queue import metrics
+from app.queue.backpressure import Backpressure
+from app.queue.queue import _host_dispatch_key
+from app.queue.queue import _load_operation
+from app.queue.queue import _same_host_runs
+from app.queue.queue import _throttle_lanes
 from app.queue.queue import _validate_json_object_for_utf8
 from app.queue.queue import event_loop
 from app.queue.queue import handle_message
+from app.queue.queue import multi_topic_event_loop
+from app.queue.queue import OperationSchema
+from app.queue.queue import parse_operation_message
 from app.queue.queue import update_system_profile
+from app.queue.worker_pool import OffsetTracker
+from lib import host_repository
 from lib.host_repository import AddHostResult
+from lib.host_repository import find_existing_host
+from tests.helpers.db_utils import update_host_in_db
 from tests.helpers.mq_utils import assert_mq_host_data
 from tests.helpers.mq_utils import expected_headers
 from tests.helpers.mq_utils import wrap_message
@@ -156,6 +180,626 @@ def test_shutdown_handler(mocker, flask_app):
     assert handle_message_mock.call_count == 2
 
 
+def _batch_consumer_mock(mocker, messages):
+    fake_consumer = mocker.Mock()
+    fake_consumer.poll.return_value = {"poll1": [SimpleNamespace(value=message) for message in messages]}
+    return fake_consumer
+
+
+def _batch_host_message(**values):
+    host = minimal_host(account=SYSTEM_IDENTITY["account_number"], insights_id=generate_uuid(), **values)
+    return json.dumps(wrap_message(host.data(), "add_host", get_platform_metadata()))
+
+
+def test_event_loop_batch_mode_single_transaction(mocker, flask_app, inventory_config, db_get_hosts):
+    inventory_config.mq_batch_mode = True
+    messages = [_batch_host_message() for _ in range(3)]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+
+    def _handler(message, event_producer):
+        # Events are held back until the whole batch is committed.
+        mock_event_producer.write_event.assert_not_called()
+        handle_message(message, event_producer)
+
+    commit_spy = mocker.spy(db.session, "commit")
+    event_loop(fake_consumer, flask_app, mock_event_producer, _handler, mocker.Mock(side_effect=(False, True)))
+
+    assert commit_spy.call_count == 1
+    assert mock_event_producer.write_event.call_count == 3
+    fake_consumer.commit.assert_called_once()
+
+    host_ids = [call_args[0][1] for call_args in mock_event_producer.write_event.call_args_list]
+    assert db_get_hosts(host_ids).count() == 3
+
+
+def test_event_loop_batch_mode_redrives_failed_messages(mocker, flask_app, inventory_config, db_get_hosts):
+    inventory_config.mq_batch_mode = True
+    messages = [_batch_host_message() for _ in range(3)]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+
+    attempts = []
+
+    def _handler(message, event_producer):
+        attempts.append(message)
+        if message == messages[1] and attempts.count(message) == 1:
+            raise IntegrityError("INSERT", {}, "fake_orig")
+        handle_message(message, event_producer)
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, _handler, mocker.Mock(side_effect=(False, True)))
+
+    assert attempts == [messages[0], messages[1], messages[2], messages[1]]
+    assert mock_event_producer.write_event.call_count == 3
+
+    host_ids = [call_args[0][1] for call_args in mock_event_producer.write_event.call_args_list]
+    assert db_get_hosts(host_ids).count() == 3
+
+
+def test_event_loop_batch_mode_does_not_redrive_invalid_messages(mocker, flask_app, inventory_config, db_get_hosts):
+    inventory_config.mq_batch_mode = True
+    messages = [_batch_host_message(), _batch_host_message(display_name=""), _batch_host_message()]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    handler = mocker.Mock(wraps=handle_message)
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handler, mocker.Mock(side_effect=(False, True)))
+
+    assert handler.call_count == 3
+    assert mock_event_producer.write_event.call_count == 2
+    fake_consumer.commit.assert_called_once()
+
+
+def test_event_loop_dead_letters_failed_messages(mocker, flask_app):
+    message = _batch_host_message(display_name="")
+    fake_consumer = _batch_consumer_mock(mocker, [message])
+    mock_event_producer = mocker.Mock()
+    mock_dead_letter_producer = mocker.Mock()
+
+    event_loop(
+        fake_consumer,
+        flask_app,
+        mock_event_producer,
+        handle_message,
+        mocker.Mock(side_effect=(False, True)),
+        mock_dead_letter_producer,
+    )
+
+    mock_event_producer.write_event.assert_not_called()
+    mock_dead_letter_producer.write_dead_letter.assert_called_once()
+    dead_letter, error, stage_timings = mock_dead_letter_producer.write_dead_letter.call_args[0]
+    assert dead_letter.value == message
+    assert isinstance(error, ValidationException)
+    assert {"parse", "deserialize"} <= set(stage_timings)
+    assert "database" not in stage_timings
+
+
+def test_event_loop_survives_dead_letter_failures(mocker, flask_app):
+    messages = [_batch_host_message(display_name=""), _batch_host_message()]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    mock_dead_letter_producer = mocker.Mock(**{"write_dead_letter.side_effect": KeyError("event_type")})
+
+    event_loop(
+        fake_consumer,
+        flask_app,
+        mock_event_producer,
+        handle_message,
+        mocker.Mock(side_effect=(False, True)),
+        mock_dead_letter_producer,
+    )
+
+    mock_dead_letter_producer.write_dead_letter.assert_called_once()
+    mock_event_producer.write_event.assert_called_once()
+
+
+def test_event_loop_batch_mode_dead_letters_failed_messages(mocker, flask_app, inventory_config):
+    inventory_config.mq_batch_mode = True
+    messages = [_batch_host_message(), _batch_host_message(display_name=""), _batch_host_message()]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    mock_dead_letter_producer = mocker.Mock()
+
+    event_loop(
+        fake_consumer,
+        flask_app,
+        mock_event_producer,
+        handle_message,
+        mocker.Mock(side_effect=(False, True)),
+        mock_dead_letter_producer,
+    )
+
+    assert mock_event_producer.write_event.call_count == 2
+    mock_dead_letter_producer.write_dead_letter.assert_called_once()
+    dead_letter, error, stage_timings = mock_dead_letter_producer.write_dead_letter.call_args[0]
+    assert dead_letter.value == messages[1]
+    assert isinstance(error, ValidationException)
+    assert {"parse", "deserialize"} <= set(stage_timings)
+    assert "database" not in stage_timings
+
+
+def _same_host_messages(insights_id, *values):
+    return [
+        json.dumps(
+            wrap_message(
+                minimal_host(account=SYSTEM_IDENTITY["account_number"], insights_id=insights_id, **host_values).data(),
+                "add_host",
+                {**get_platform_metadata(), "request_id": generate_uuid()},
+            )
+        )
+        for host_values in values
+    ]
+
+
+def test_event_loop_batch_mode_coalesces_same_host_messages(mocker, flask_app, inventory_config, db_get_host):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    insights_id = generate_uuid()
+    messages = _same_host_messages(
+        insights_id,
+        {"display_name": "first", "facts": [{"namespace": "ns1", "facts": {"key": "value"}}]},
+        {"display_name": "second", "system_profile": {"owner_id": OWNER_ID, "number_of_cpus": 2}},
+        {"display_name": "third", "ansible_host": "ansible"},
+    )
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    handler = mocker.Mock(wraps=handle_message)
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handler, mocker.Mock(side_effect=(False, True)))
+
+    assert handler.call_count == 3
+    mock_event_producer.write_event.assert_called_once()
+    event, host_id, headers = mock_event_producer.write_event.call_args[0]
+    event = json.loads(event)
+    assert event["type"] == "created"
+    assert event["platform_metadata"]["request_id"] == json.loads(messages[2])["platform_metadata"]["request_id"]
+    assert event["host"]["display_name"] == "third"
+    assert event["host"]["ansible_host"] == "ansible"
+    assert event["host"]["system_profile"]["number_of_cpus"] == 2
+
+    host = db_get_host(host_id)
+    assert host.canonical_facts["insights_id"] == insights_id
+    assert host.display_name == "third"
+    assert host.facts == {"ns1": {"key": "value"}}
+    assert host.system_profile_facts["number_of_cpus"] == 2
+
+
+def test_event_loop_batch_mode_writes_coalesced_host_once(
+    mocker, flask_app, inventory_config, db_create_host, db_get_host
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    insights_id = generate_uuid()
+    host_id = db_create_host(extra_data={"canonical_facts": {"insights_id": insights_id}}).id
+    messages = _same_host_messages(insights_id, {"display_name": "first"}, {"display_name": "second"})
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+
+    statements = []
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+    try:
+        event_loop(
+            fake_consumer, flask_app, mock_event_producer, handle_message, mocker.Mock(side_effect=(False, True))
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _before_cursor_execute)
+
+    assert len([statement for statement in statements if statement.startswith("UPDATE hosts")]) == 1
+    mock_event_producer.write_event.assert_called_once()
+    assert json.loads(mock_event_producer.write_event.call_args[0][0])["type"] == "updated"
+    assert db_get_host(host_id).display_name == "second"
+
+
+def test_event_loop_batch_mode_handles_failed_coalesced_messages_one_by_one(
+    mocker, flask_app, inventory_config, db_get_host
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    messages = _same_host_messages(
+        generate_uuid(), {"display_name": "first"}, {"display_name": ""}, {"display_name": "third"}
+    )
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    mock_dead_letter_producer = mocker.Mock()
+
+    event_loop(
+        fake_consumer,
+        flask_app,
+        mock_event_producer,
+        handle_message,
+        mocker.Mock(side_effect=(False, True)),
+        mock_dead_letter_producer,
+    )
+
+    assert mock_event_producer.write_event.call_count == 2
+    mock_dead_letter_producer.write_dead_letter.assert_called_once()
+    assert mock_dead_letter_producer.write_dead_letter.call_args[0][0].value == messages[1]
+    host_id = mock_event_producer.write_event.call_args[0][1]
+    assert db_get_host(host_id).display_name == "third"
+
+
+def test_event_loop_batch_mode_does_not_coalesce_messages_differing_by_case(
+    mocker, flask_app, inventory_config, db_get_host
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    insights_id = generate_uuid()
+    messages = _same_host_messages(insights_id, {"display_name": "first"}) + _same_host_messages(
+        insights_id.upper(), {"display_name": "second"}
+    )
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handle_message, mocker.Mock(side_effect=(False, True)))
+
+    event_types = [json.loads(call_args[0][0])["type"] for call_args in mock_event_producer.write_event.call_args_list]
+    assert event_types == ["created", "updated"]
+    host_id = mock_event_producer.write_event.call_args[0][1]
+    assert db_get_host(host_id).display_name == "second"
+
+
+def test_event_loop_batch_mode_coalesced_unchanged_message_keeps_the_modification(
+    mocker, flask_app, inventory_config, db_get_host, db_get_host_by_insights_id
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    inventory_config.skip_unchanged_host_updates = True
+    insights_id = generate_uuid()
+    (first_message,) = _same_host_messages(insights_id, {"display_name": "first", "reporter": "reporter"})
+    handle_message(first_message, mocker.Mock())
+    host_id = db_get_host_by_insights_id(insights_id).id
+    modified_on = db_get_host(host_id).modified_on
+
+    # The second message only refreshes the staleness of the host updated by the first one.
+    stale_timestamp = (now() + timedelta(days=1)).isoformat()
+    messages = _same_host_messages(
+        insights_id,
+        {"display_name": "changed", "reporter": "reporter", "stale_timestamp": stale_timestamp},
+        {"display_name": "changed", "reporter": "reporter", "stale_timestamp": stale_timestamp},
+    )
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    event_loop(fake_consumer, flask_app, mocker.Mock(), handle_message, mocker.Mock(side_effect=(False, True)))
+
+    assert db_get_host(host_id).modified_on > modified_on
+    # The content hash is tied to the kept modification, the same content is still recognized as unchanged.
+    mock_event_producer = mocker.Mock()
+    handle_message(messages[0], mock_event_producer)
+    mock_event_producer.write_event.assert_not_called()
+
+
+def test_event_loop_batch_mode_coalesced_system_profiles_update_their_own_hosts(
+    mocker, flask_app, inventory_config, db_create_host, db_get_host
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_coalesce = True
+    insights_id = generate_uuid()
+    host_id = db_create_host(extra_data={"canonical_facts": {"insights_id": insights_id}}).id
+    other_host_id = db_create_host().id
+    messages = [
+        json.dumps(
+            wrap_message(
+                minimal_host(
+                    account=SYSTEM_IDENTITY["account_number"],
+                    insights_id=insights_id,
+                    system_profile={"number_of_cpus": number_of_cpus},
+                    **values,
+                ).data(),
+                "add_host",
+                get_platform_metadata(),
+            )
+        )
+        # The same run key, but the second message targets another host by its id.
+        for number_of_cpus, values in ((1, {}), (2, {"id": str(other_host_id)}))
+    ]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    handler = partial(handle_message, message_operation=update_system_profile)
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handler, mocker.Mock(side_effect=(False, True)))
+
+    assert mock_event_producer.write_event.call_count == 2
+    assert db_get_host(host_id).system_profile_facts["number_of_cpus"] == 1
+    assert db_get_host(other_host_id).system_profile_facts["number_of_cpus"] == 2
+
+
+def _host_message(**values):
+    host = minimal_host(account=SYSTEM_IDENTITY["account_number"], **values)
+    return json.dumps(
+        wrap_message(host.data(), "add_host", {**get_platform_metadata(), "request_id": generate_uuid()})
+    )
+
+
+def test_event_loop_batch_mode_prefetches_existing_hosts(
+    mocker, flask_app, inventory_config, db_create_host, db_get_hosts
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_prefetch_hosts = True
+    insights_ids = [generate_uuid() for _ in range(3)]
+    host_ids = [
+        db_create_host(extra_data={"canonical_facts": {"insights_id": insights_id}}).id for insights_id in insights_ids
+    ]
+    messages = [_host_message(insights_id=insights_id, display_name="prefetched") for insights_id in insights_ids]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    find_existing_hosts = mocker.spy(host_repository, "_find_existing_hosts")
+    find_existing_host = mocker.spy(host_repository, "find_existing_host")
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handle_message, mocker.Mock(side_effect=(False, True)))
+
+    find_existing_hosts.assert_called_once()
+    find_existing_host.assert_not_called()
+    event_types = [json.loads(call_args[0][0])["type"] for call_args in mock_event_producer.write_event.call_args_list]
+    assert event_types == ["updated", "updated", "updated"]
+    assert {host.display_name for host in db_get_hosts(host_ids)} == {"prefetched"}
+
+
+def test_event_loop_batch_mode_looks_up_hosts_written_by_the_batch_again(
+    mocker, flask_app, inventory_config, db_create_host, db_get_host
+):
+    inventory_config.mq_batch_mode = True
+    inventory_config.mq_batch_prefetch_hosts = True
+    insights_id = generate_uuid()
+    existing_insights_id = generate_uuid()
+    subscription_manager_id = generate_uuid()
+    existing_host_id = db_create_host(extra_data={"canonical_facts": {"insights_id": existing_insights_id}}).id
+    messages = [
+        # Creates the host the next message is for.
+        _host_message(insights_id=insights_id, display_name="first"),
+        _host_message(insights_id=insights_id, display_name="second"),
+        # Gives the existing host the fact the next message is looked up by.
+        _host_message(insights_id=existing_insights_id, subscription_manager_id=subscription_manager_id),
+        _host_message(subscription_manager_id=subscription_manager_id, display_name="fourth"),
+    ]
+    fake_consumer = _batch_consumer_mock(mocker, messages)
+    mock_event_producer = mocker.Mock()
+    find_existing_host = mocker.spy(host_repository, "find_existing_host")
+
+    event_loop(fake_consumer, flask_app, mock_event_producer, handle_message, mocker.Mock(side_effect=(False, True)))
+
+    assert find_existing_host.call_count == 2
+    written_events = [
+        (call_args[0][1], json.loads(call_args[0][0])["type"])
+        for call_args in mock_event_producer.write_event.call_args_list
+    ]
+    created_host_id = written_events[0][0]
+    assert written_events == [
+        (created_host_id, "created"),
+        (created_host_id, "updated"),
+        (str(existing_host_id), "updated"),
+        (str(existing_host_id), "updated"),
+    ]
+    assert db_get_host(created_host_id).display_name == "second"
+    assert db_get_host(existing_host_id).display_name == "fourth"
+
+
+def test_same_host_runs_follow_elevated_canonical_fact_priority():
+    insights_id = generate_uuid()
+    messages = [
+        SimpleNamespace(value=json.dumps({"data": {"account": "test", **data}}))
+        for data in (
+            {"id": "same", "insights_id": insights_id},
+            {"id": "same", "insights_id": insights_id.upper()},
+            {"id": "same", "insights_id": generate_uuid()},
+            {"id": "other", "insights_id": generate_uuid(), "provider_id": "provider"},
+            {"insights_id": generate_uuid(), "provider_id": "provider"},
+            {"fqdn": "fqdn"},
+            {"fqdn": "fqdn"},
+        )
+    ]
+
+    assert _same_host_runs(messages) == [
+        [messages[0]],
+        [messages[1]],
+        [messages[2]],
+        [messages[3], messages[4]],
+        [messages[5]],
+        [messages[6]],
+    ]
+
+
+def _worker_pool_consumer_mock(mocker, messages_per_partition, number_of_partitions=3):
+    partitions = [
+        TopicPartition("platform.inventory.host-ingress", partition) for partition in range(number_of_partitions)
+    ]
+    fake_consumer = mocker.Mock()
+    fake_consumer.assignment.return_value = set(partitions)
+    fake_consumer.poll.side_effect = [
+        {
+            partition: [
+                SimpleNamespace(value=f"{partition.partition}-{offset}", offset=offset)
+                for offset in range(messages_per_partition)
+            ]
+            for partition in partitions
+        },
+        {},
+    ]
+    return fake_consumer, partitions
+
+
+def test_event_loop_worker_pool_preserves_partition_order(mocker, flask_app, inventory_config):
+    inventory_config.mq_worker_count = 2
+    fake_consumer, partitions = _worker_pool_consumer_mock(mocker, messages_per_partition=20)
+
+    handled = []
+
+    def _handler(message, event_producer):
+        handled.append((threading.current_thread().name, message))
+
+    event_loop(fake_consumer, flask_app, None, _handler, mocker.Mock(side_effect=(False, False, True)))
+
+    assert len(handled) == 60
+    for partition in partitions:
+        partition_handled = [
+            (thread, message) for thread, message in handled if message.startswith(f"{partition.partition}-")
+        ]
+        assert [message for _, message in partition_handled] == [
+            f"{partition.partition}-{offset}" for offset in range(20)
+        ]
+        assert len({thread for thread, _ in partition_handled}) == 1
+
+    last_commit = fake_consumer.commit.call_args_list[-1][0][0]
+    assert all(last_commit.get(partition) == OffsetAndMetadata(20, None) for partition in partitions)
+
+
+def test_event_loop_worker_pool_exits_on_db_failure(mocker, flask_app, inventory_config):
+    inventory_config.mq_worker_count = 2
+    fake_consumer, _ = _worker_pool_consumer_mock(mocker, messages_per_partition=1)
+    handler = mocker.Mock(side_effect=OperationalError("DB Problem", "fake_param", "fake_orig"))
+
+    with pytest.raises(SystemExit) as exit_info:
+        event_loop(fake_consumer, flask_app, None, handler, mocker.Mock(side_effect=(False, False, True)))
+
+    assert exit_info.value.code == 3
+
+
+def test_event_loop_worker_pool_raises_worker_error(mocker, flask_app, inventory_config):
+    inventory_config.mq_worker_count = 2
+    fake_consumer, partitions = _worker_pool_consumer_mock(mocker, messages_per_partition=1)
+    mocker.patch("app.queue.queue._process_message", side_effect=ValueError("Unexpected failure"))
+
+    with pytest.raises(ValueError, match="Unexpected failure"):
+        event_loop(fake_consumer, flask_app, None, mocker.Mock(), mocker.Mock(side_effect=(False, False, True)))
+
+    for commit_call in fake_consumer.commit.call_args_list:
+        assert all(offset == OffsetAndMetadata(0, None) for offset in commit_call[0][0].values())
+
+
+def test_multi_topic_event_loop_processes_topics_in_their_lanes(mocker, flask_app, inventory_config):
+    inventory_config.mq_lane_worker_counts = {"platform.inventory.host-ingress": 2}
+    topics = ("platform.inventory.host-ingress", "platform.inventory.system-profile")
+    partitions = [TopicPartition(topic, partition) for topic in topics for partition in range(2)]
+    fake_consumer = mocker.Mock()
+    fake_consumer.assignment.return_value = set(partitions)
+    fake_consumer.paused.return_value = set()
+    fake_consumer.poll.side_effect = [
+        {
+            partition: [
+                SimpleNamespace(value=f"{partition.topic}-{partition.partition}-{offset}", offset=offset)
+                for offset in range(10)
+            ]
+            for partition in partitions
+        },
+        {},
+    ]
+
+    handled = defaultdict(list)
+
+    def _handler(topic):
+        def _handle(message, event_producer):
+            handled[topic].append((threading.current_thread().name, message))
+
+        return _handle
+
+    multi_topic_event_loop(
+        fake_consumer,
+        flask_app,
+        None,
+        {topic: _handler(topic) for topic in topics},
+        mocker.Mock(side_effect=(False, False, True)),
+    )
+
+    for topic in topics:
+        assert sorted(message for _, message in handled[topic]) == sorted(
+            f"{topic}-{partition}-{offset}" for partition in range(2) for offset in range(10)
+        )
+        assert all(thread.startswith(f"mq-worker-{topic}-") for thread, _ in handled[topic])
+    assert len({thread for thread, _ in handled["platform.inventory.host-ingress"]}) <= 2
+    assert len({thread for thread, _ in handled["platform.inventory.system-profile"]}) == 1
+
+    committed = {}
+    for call_args in fake_consumer.commit.call_args_list:
+        committed.update(call_args[0][0])
+    assert committed == {partition: OffsetAndMetadata(10, None) for partition in partitions}
+
+
+def test_throttle_lanes_pauses_only_saturated_topics(mocker):
+    ingress = TopicPartition("platform.inventory.host-ingress", 0)
+    system_profile = TopicPartition("platform.inventory.system-profile", 0)
+    fake_consumer = mocker.Mock()
+    fake_consumer.assignment.return_value = {ingress, system_profile}
+    fake_consumer.paused.return_value = set()
+    lanes = {
+        "platform.inventory.host-ingress": SimpleNamespace(saturated=True),
+        "platform.inventory.system-profile": SimpleNamespace(saturated=False),
+    }
+
+    _throttle_lanes(fake_consumer, lanes)
+    fake_consumer.pause.assert_called_once_with(ingress)
+
+    fake_consumer.paused.return_value = {ingress}
+    lanes["platform.inventory.host-ingress"].saturated = False
+    _throttle_lanes(fake_consumer, lanes)
+    fake_consumer.resume.assert_any_call(ingress)
+
+
+def test_offset_tracker_commits_lowest_pending_offset():
+    topic_partition = TopicPartition("platform.inventory.host-ingress", 0)
+    tracker = OffsetTracker()
+    for offset in range(5, 10):
+        tracker.dispatched(topic_partition, offset)
+
+    tracker.done(topic_partition, 5)
+    tracker.done(topic_partition, 7)
+    assert tracker.committable() == {topic_partition: 6}
+
+    tracker.committed({topic_partition: 6})
+    assert tracker.committable() == {}
+
+    for offset in (6, 8, 9):
+        tracker.done(topic_partition, offset)
+    assert tracker.committable() == {topic_partition: 10}
+
+
+def test_backpressure_pauses_and_resumes_consumer(mocker):
+    partitions = {TopicPartition("platform.inventory.host-ingress", partition) for partition in range(2)}
+    fake_consumer = mocker.Mock()
+    fake_consumer.assignment.return_value = partitions
+    fake_consumer.paused.return_value = partitions
+    fake_event_producer = SimpleNamespace(in_flight=0)
+    backpressure = Backpressure(fake_consumer, fake_event_producer, high_watermark=10, low_watermark=5)
+
+    for in_flight, paused in ((9, False), (10, True), (6, True), (5, False)):
+        fake_event_producer.in_flight = in_flight
+        backpressure.check()
+        assert backpressure.paused is paused
+
+    fake_consumer.resume.assert_called_once_with(*partitions)
+    assert fake_consumer.pause.call_count == 2
+
+
+def test_event_loop_pauses_consumer_on_backpressure(mocker, flask_app, inventory_config):
+    inventory_config.mq_backpressure_high_watermark = 1
+    inventory_config.mq_backpressure_low_watermark = 0
+    partition = TopicPartition("platform.inventory.host-ingress", 0)
+    fake_consumer = mocker.Mock()
+    fake_consumer.assignment.return_value = {partition}
+    fake_consumer.poll.return_value = {}
+    fake_event_producer = SimpleNamespace(in_flight=1)
+
+    event_loop(fake_consumer, flask_app, fake_event_producer, mocker.Mock(), mocker.Mock(side_effect=(False, True)))
+
+    fake_consumer.pause.assert_called_once_with(partition)
+    fake_consumer.poll.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    ("host", "expected_key"),
+    (
+        ({"account": "test", "id": "ABC", "insights_id": "def"}, ("test", "id", "abc")),
+        ({"account": "test", "subscription_manager_id": "ABC", "insights_id": "def"}, ("test", "insights_id", "def")),
+        ({"account": "test", "fqdn": "foo.bar.com"}, "test"),
+    ),
+)
+def test_host_dispatch_key(host, expected_key):
+    topic_partition = TopicPartition("platform.inventory.host-ingress", 0)
+    message = SimpleNamespace(value=json.dumps(wrap_message(host)))
+    assert _host_dispatch_key(topic_partition, message) == expected_key
+
+
 # Leaving this in as a reminder that we need to impliment this test eventually
 # when the problem that it is supposed to test is fixed
 # https://projects.engineering.redhat.com/browse/RHCLOUD-3503
@@ -239,7 +883,7 @@ def test_handle_message_verify_message_key_and_metadata_not_required(mocker, mq_
     assert event["host"] == host_data
 
 
-@pytest.mark.parametrize("add_host_result", AddHostResult)
+@pytest.mark.parametrize("add_host_result", (AddHostResult.created, AddHostResult.updated))
 def test_handle_message_verify_message_headers(mocker, add_host_result, mq_create_or_update_host):
     host_id = generate_uuid()
     insights_id = generate_uuid()
@@ -1062,6 +1706,54 @@ def test_other_values_are_ignored(value):
     assert True
 
 
+@pytest.mark.parametrize(
+    "message",
+    (
+        '{"operation": "add_host", "data": {"display_name": "naïve fiancé"}}',
+        '{"operation": "add_host", "data": {"display_name": "na\\u00efve fianc\\u00e9"}}',
+    ),
+)
+def test_parse_operation_message_skips_object_walk_without_surrogate_escapes(mocker, message):
+    walk_mock = mocker.patch("app.queue.queue._validate_json_object_for_utf8")
+    assert parse_operation_message(message)["data"] == json.loads(message)["data"]
+    walk_mock.assert_not_called()
+
+
+def test_parse_operation_message_walks_object_with_surrogate_escapes(mocker):
+    walk_mock = mocker.patch("app.queue.queue._validate_json_object_for_utf8")
+    message = json.dumps({"operation": "add_host", "data": {"display_name": "🧜🏿‍♂️"}})
+
+    parse_operation_message(message)
+
+    walk_mock.assert_called_once_with(json.loads(message))
+
+
+@pytest.mark.parametrize(
+    "parsed_message",
+    (
+        {"operation": "add_host", "data": {}},
+        {"operation": "add_host", "data": {"account": "test"}, "platform_metadata": {"request_id": "1"}},
+        {"operation": 1, "data": []},
+        {"operation": "add_host", "data": None, "platform_metadata": None},
+        {"operation": "add_host", "data": {}, "unknown": "field"},
+        {"platform_metadata": "metadata"},
+        ["operation", "data"],
+        "operation",
+        None,
+    ),
+)
+def test_load_operation_matches_operation_schema(parsed_message):
+    try:
+        expected = OperationSchema().load(parsed_message)
+    except marshmallow.ValidationError as error:
+        with pytest.raises(marshmallow.ValidationError) as error_info:
+            _load_operation(parsed_message)
+        assert error_info.value.messages == error.messages
+        assert error_info.value.valid_data == error.valid_data
+    else:
+        assert _load_operation(parsed_message) == expected
+
+
 def test_host_account_using_mq(mq_create_or_update_host, api_get, db_get_host, db_get_hosts):
     host = minimal_host(account=SYSTEM_IDENTITY["account_number"], fqdn="d44533.foo.redhat.co")
     host.account = SYSTEM_IDENTITY["account_number"]
@@ -1416,3 +2108,302 @@ def test_add_host_with_canonical_facts_MAC_address_valid_formats(mq_create_or_up
     host_from_db = db_get_host(created_host.id)
 
     assert created_host.mac_addresses == host_from_db.canonical_facts["mac_addresses"]
+
+
+def _send_host_message(host, event_producer):
+    message = wrap_message(host.data(), platform_metadata=get_platform_metadata())
+    handle_message(json.dumps(message), event_producer)
+
+
+@pytest.mark.parametrize("new_stale_timestamp", (False, True))
+def test_add_host_unchanged_only_refreshes_staleness(
+    inventory_config, mq_create_or_update_host, event_producer_mock, db_get_host, new_stale_timestamp
+):
+    inventory_config.skip_unchanged_host_updates = True
+
+    host = minimal_host(
+        insights_id=generate_uuid(), system_profile={"number_of_cpus": 1, "installed_packages": ["vim-8.2-1.x86_64"]}
+    )
+    host_id = mq_create_or_update_host(host).id
+    modified_on = db_get_host(host_id).modified_on
+
+    event_producer_mock.event = None
+    if new_stale_timestamp:
+        host.stale_timestamp = (now() + timedelta(days=10)).isoformat()
+    _send_host_message(host, event_producer_mock)
+
+    if new_stale_timestamp:
+        # The downstream consumers are told about the new staleness.
+        event = json.loads(event_producer_mock.event)
+        assert event["type"] == "updated"
+        assert event["host"]["stale_timestamp"] == host.stale_timestamp
+    else:
+        assert event_producer_mock.event is None
+    updated_host = db_get_host(host_id)
+    assert updated_host.modified_on == modified_on
+    assert updated_host.stale_timestamp.isoformat() == host.stale_timestamp
+    assert updated_host.per_reporter_staleness[host.reporter]["stale_timestamp"] == host.stale_timestamp
+
+
+def test_add_host_changed_is_fully_updated(
+    inventory_config, mq_create_or_update_host, event_producer_mock, db_get_host
+):
+    inventory_config.skip_unchanged_host_updates = True
+
+    host = minimal_host(insights_id=generate_uuid())
+    host_id = mq_create_or_update_host(host).id
+
+    event_producer_mock.event = None
+    host.display_name = "updated-display-name"
+    _send_host_message(host, event_producer_mock)
+
+    assert json.loads(event_producer_mock.event)["type"] == "updated"
+    assert db_get_host(host_id).display_name == "updated-display-name"
+
+
+@pytest.mark.parametrize("other_change", ({"reporter": "other-reporter"}, {"patch": True}))
+def test_add_host_unchanged_after_other_change_is_fully_updated(
+    inventory_config, mq_create_or_update_host, event_producer_mock, db_get_host, other_change
+):
+    inventory_config.skip_unchanged_host_updates = True
+
+    host = minimal_host(insights_id=generate_uuid())
+    host_id = mq_create_or_update_host(host).id
+
+    if "patch" in other_change:
+        db_get_host(host_id).patch({"display_name": "patched-display-name"})
+        db.session.commit()
+    else:
+        other_host = minimal_host(insights_id=host.insights_id, display_name="other-display-name", **other_change)
+        mq_create_or_update_host(other_host)
+
+    event_producer_mock.event = None
+    _send_host_message(host, event_producer_mock)
+
+    assert json.loads(event_producer_mock.event)["type"] == "updated"
+    assert db_get_host(host_id).display_name == host.display_name
+
+
+def test_add_host_unchanged_is_updated_when_disabled(mq_create_or_update_host, event_producer_mock, db_get_host):
+    host = minimal_host(insights_id=generate_uuid())
+    host_id = mq_create_or_update_host(host).id
+    modified_on = db_get_host(host_id).modified_on
+
+    event_producer_mock.event = None
+    _send_host_message(host, event_producer_mock)
+
+    assert json.loads(event_producer_mock.event)["type"] == "updated"
+    assert db_get_host(host_id).modified_on > modified_on
+
+
+def _upsert_host_messages(insights_id):
+    # The staleness is compared between the runs, all the messages need the same one
+    stale_timestamp = "2100-01-01T00:00:00+00:00"
+
+    first = minimal_host(
+        insights_id=insights_id,
+        stale_timestamp=stale_timestamp,
+        fqdn="first.upsert.test",
+        facts=[{"namespace": "ns1", "facts": {"key1": "value1"}}],
+        tags={"ns1": {"key1": ["value1"]}, "ns2": {"key2": ["value2"]}},
+        system_profile={"number_of_cpus": 1, "arch": "x86_64"},
+        reporter="puptoo",
+    )
+    del first.display_name
+
+    second = minimal_host(
+        insights_id=insights_id,
+        stale_timestamp=stale_timestamp,
+        subscription_manager_id=generate_uuid(),
+        display_name="second-display-name",
+        ansible_host="second-ansible-host",
+        facts=[{"namespace": "ns2", "facts": {"key2": "value2"}}],
+        tags={"ns1": {}, "ns3": {"key3": ["value3"]}},
+        system_profile={"number_of_cpus": 2},
+        reporter="yupana",
+    )
+
+    third = minimal_host(
+        insights_id=insights_id, stale_timestamp=stale_timestamp, fqdn="third.upsert.test", tags={}, reporter="puptoo"
+    )
+    del third.display_name
+
+    return first, second, third
+
+
+def _comparable_host(host):
+    per_reporter_staleness = {
+        reporter: {key: value for key, value in staleness.items() if key != "last_check_in"}
+        for reporter, staleness in host.per_reporter_staleness.items()
+    }
+    canonical_facts = {
+        key: value
+        for key, value in host.canonical_facts.items()
+        if key not in ("insights_id", "subscription_manager_id")
+    }
+    return {
+        "display_name": host.display_name,
+        "ansible_host": host.ansible_host,
+        "facts": host.facts,
+        "tags": host.tags,
+        "canonical_facts": canonical_facts,
+        "system_profile_facts": host.system_profile_facts,
+        "reporter": host.reporter,
+        "per_reporter_staleness": per_reporter_staleness,
+    }
+
+
+def test_add_host_upsert_matches_regular_add_host(
+    inventory_config, host_upsert, mq_create_or_update_host, event_producer_mock, db_get_host
+):
+    results = []
+    for upsert in (False, True):
+        inventory_config.host_upsert = upsert
+
+        host_ids = set()
+        event_types = []
+        for host in _upsert_host_messages(generate_uuid()):
+            host_ids.add(mq_create_or_update_host(host).id)
+            event_types.append(json.loads(event_producer_mock.event)["type"])
+
+        assert len(host_ids) == 1
+        assert event_types == ["created", "updated", "updated"]
+        results.append(_comparable_host(db_get_host(host_ids.pop())))
+
+    assert results[0] == results[1]
+
+
+def test_add_host_upsert_single_statement(host_upsert, mq_create_or_update_host, db_get_host):
+    host = minimal_host(insights_id=generate_uuid())
+    host_id = mq_create_or_update_host(host).id
+
+    statements = []
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+    try:
+        host.display_name = "upserted-display-name"
+        mq_create_or_update_host(host)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _before_cursor_execute)
+
+    assert [statement.split()[0] for statement in statements if "hosts" in statement] == ["INSERT"]
+    assert db_get_host(host_id).display_name == "upserted-display-name"
+
+
+def test_add_host_upsert_falls_back_on_lower_priority_conflict(
+    host_upsert, mq_create_or_update_host, event_producer_mock, db_get_hosts
+):
+    insights_id = generate_uuid()
+    host_id = mq_create_or_update_host(minimal_host(insights_id=insights_id)).id
+
+    provider_id = generate_uuid()
+    host = minimal_host(insights_id=insights_id, provider_id=provider_id, provider_type="aws")
+    mq_create_or_update_host(host)
+
+    assert json.loads(event_producer_mock.event)["type"] == "updated"
+    hosts = db_get_hosts([host_id]).all()
+    assert len(hosts) == 1
+    assert hosts[0].canonical_facts["provider_id"] == provider_id
+
+
+@pytest.mark.parametrize("upsert", (False, True))
+def test_add_host_re_registers_culled_host(
+    request, mq_create_or_update_host, event_producer_mock, db_get_host, upsert
+):
+    if upsert:
+        request.getfixturevalue("host_upsert")
+    host = minimal_host(insights_id=generate_uuid())
+    culled_host_id = mq_create_or_update_host(host).id
+    # Culled, but not deleted by the reaper yet
+    update_host_in_db(culled_host_id, stale_timestamp=now() - timedelta(days=365))
+
+    host_id = mq_create_or_update_host(host).id
+
+    assert host_id != culled_host_id
+    assert json.loads(event_producer_mock.event)["type"] == "created"
+    culled_host = db_get_host(culled_host_id)
+    # Only the upsert unique indexes need the culled host to give its elevated canonical facts up.
+    assert culled_host.elevated_facts_released == upsert
+    assert culled_host.stale_timestamp < now()
+    assert not db_get_host(host_id).elevated_facts_released
+
+    # The culled host is never found again, the new one is updated from now on.
+    assert mq_create_or_update_host(host).id == host_id
+
+
+@pytest.mark.parametrize("upsert", (False, True))
+def test_add_host_update_with_lower_priority_fact_of_another_host(
+    request, mq_create_or_update_host, db_get_host, upsert
+):
+    if upsert:
+        request.getfixturevalue("host_upsert")
+    insights_id = generate_uuid()
+    subscription_manager_id = generate_uuid()
+    host_id = mq_create_or_update_host(minimal_host(insights_id=insights_id)).id
+    other_host_id = mq_create_or_update_host(minimal_host(subscription_manager_id=subscription_manager_id)).id
+
+    # The insights_id has a higher priority, the first host is updated.
+    host = minimal_host(insights_id=insights_id, subscription_manager_id=subscription_manager_id)
+    assert mq_create_or_update_host(host).id == host_id
+
+    # The unique indexes keep the subscription_manager_id with the host holding it, the regular deduplication
+    # lets both hosts have it.
+    assert db_get_host(other_host_id).canonical_facts["subscription_manager_id"] == subscription_manager_id
+    updated_facts = db_get_host(host_id).canonical_facts
+    assert ("subscription_manager_id" not in updated_facts) == upsert
+
+
+def test_add_host_upsert_maintains_canonical_fact_index(host_upsert, mq_create_or_update_host, db_get_host):
+    host = minimal_host(insights_id=generate_uuid(), ip_addresses=["10.0.0.1", "10.0.0.2"])
+    host_id = mq_create_or_update_host(host).id
+
+    host.ip_addresses = ["10.0.0.2", "10.0.0.3"]
+    mq_create_or_update_host(host)
+
+    db_host = db_get_host(host_id)
+    indexed_facts = {(row.fact_name, row.fact_value) for row in db_host.canonical_fact_index}
+    assert indexed_facts == canonical_fact_pairs(db_host.canonical_facts)
+    assert ("ip_addresses", "10.0.0.1") not in indexed_facts
+    found_host = find_existing_host(Identity(USER_IDENTITY), {"ip_addresses": ["10.0.0.3"]})
+    assert str(found_host.id) == host_id
+
+
+def test_handle_message_observes_stage_timings(mocker, flask_app, event_producer_mock):
+    host = minimal_host(insights_id=generate_uuid(), reporter="timed")
+    observe = mocker.spy(metrics.ingress_message_stage_time, "labels")
+
+    _send_host_message(host, event_producer_mock)
+
+    observed_stages = {call_args for call_args, _ in observe.call_args_list}
+    assert observed_stages >= {
+        ("parse", "timed"),
+        ("identity", "timed"),
+        ("deserialize", "timed"),
+        ("validation", "timed"),
+        ("database", "timed"),
+        ("flush", "timed"),
+        ("serialize", "timed"),
+        ("commit", "timed"),
+        ("build_event", "timed"),
+        ("produce", "timed"),
+    }
+
+
+@pytest.mark.parametrize(("threshold", "logged"), ((0, False), (0.000001, True), (3600, False)))
+def test_handle_message_logs_slow_messages(
+    mocker, flask_app, inventory_config, event_producer_mock, threshold, logged
+):
+    inventory_config.mq_slow_message_threshold = threshold
+    host = minimal_host(insights_id=generate_uuid())
+    logger_mock = mocker.patch("app.queue.queue.logger")
+
+    _send_host_message(host, event_producer_mock)
+
+    if logged:
+        logger_mock.warning.assert_called_once()
+        assert "parse" in logger_mock.warning.call_args[1]["extra"]["stage_timings"]
+    else:
+        logger_mock.warning.assert_not_called()
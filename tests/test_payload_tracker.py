@@ -1,12 +1,18 @@
+import json
+import threading
 import uuid
+from contextlib import nullcontext
 from unittest.mock import Mock
 from unittest.mock import patch
 
 import pytest
 
 from app.payload_tracker import _UNKNOWN_REQUEST_ID
+from app.payload_tracker import flush_payload_tracker
+from app.payload_tracker import PayloadTrackerCoalescer
 from app.payload_tracker import PayloadTrackerContext
 from app.payload_tracker import PayloadTrackerProcessingContext
+from app.payload_tracker import PayloadTrackerSender
 from tests.helpers.tracker_utils import assert_mock_send_call
 from tests.helpers.tracker_utils import assert_payload_tracker_is_disabled
 from tests.helpers.tracker_utils import build_expected_tracker_message
@@ -339,3 +345,116 @@ def test_payload_tracker_processing_context_success(payload_tracker, tracker_dat
             assert_mock_send_call(producer, DEFAULT_TOPIC, expected_msg)
 
             producer.reset_mock()
+
+
+@pytest.mark.parametrize("fail", (False, True))
+def test_payload_tracker_terminal_status_only(payload_tracker, tracker_datetime_mock, fail):
+    expected_request_id = "REQUEST_ID"
+    expected_inventory_id = uuid.uuid4()
+    producer = Mock()
+
+    with patch.dict("os.environ", {"PAYLOAD_TRACKER_TERMINAL_STATUS_ONLY": "true"}):
+        tracker = payload_tracker(request_id=expected_request_id, producer=producer)
+
+    with pytest.raises(ValueError) if fail else nullcontext():
+        with PayloadTrackerContext(payload_tracker=tracker, current_operation="test operation"):
+            with PayloadTrackerProcessingContext(payload_tracker=tracker) as processing_context:
+                processing_context.inventory_id = expected_inventory_id
+            if fail:
+                method_to_raise_exception()
+
+    if fail:
+        expected_status, expected_status_msg = (
+            "error",
+            build_payload_tracker_context_error_message("ValueError", "test operation", "something bad happened!"),
+        )
+    else:
+        expected_status, expected_status_msg = "success", None
+
+    expected_msg = build_expected_tracker_message(
+        status=expected_status,
+        status_msg=expected_status_msg,
+        request_id=expected_request_id,
+        datetime_mock=tracker_datetime_mock,
+    )
+    expected_msg["inventory_id"] = str(expected_inventory_id)
+
+    producer.send.assert_called_once()
+    assert_mock_send_call(producer, DEFAULT_TOPIC, expected_msg)
+
+
+def test_payload_tracker_coalescer_drops_oldest_pending_inventory_ids():
+    send_message = Mock()
+    coalescer = PayloadTrackerCoalescer(send_message, max_pending_requests=2)
+
+    for request_id in ("1", "2", "3"):
+        coalescer.add(DEFAULT_TOPIC, {"request_id": request_id, "status": "processing", "inventory_id": request_id})
+    for request_id in ("1", "2", "3"):
+        coalescer.add(DEFAULT_TOPIC, {"request_id": request_id, "status": "success"})
+
+    assert [args[1].get("inventory_id") for args, _ in send_message.call_args_list] == [None, "2", "3"]
+
+
+def test_payload_tracker_async_sends_in_background(payload_tracker, tracker_datetime_mock, subtests):
+    expected_request_id = "1234567890"
+    producer = Mock()
+
+    with patch.dict("os.environ", {"PAYLOAD_TRACKER_ASYNC": "true"}):
+        tracker = payload_tracker(request_id=expected_request_id, producer=producer)
+
+    for method_to_test, expected_status in get_payload_tracker_methods(tracker):
+        with subtests.test(method_to_test=method_to_test):
+            method_to_test()
+            flush_payload_tracker()
+
+            expected_msg = build_expected_tracker_message(
+                status=expected_status, request_id=expected_request_id, datetime_mock=tracker_datetime_mock
+            )
+            assert_mock_send_call(producer, DEFAULT_TOPIC, expected_msg)
+
+            producer.reset_mock()
+
+
+def test_payload_tracker_sender_drops_oldest_messages():
+    producer = Mock()
+    sender = PayloadTrackerSender(producer, queue_size=2)
+
+    for status in ("received", "processing", "processing_success"):
+        sender.add(DEFAULT_TOPIC, {"request_id": "1234567890", "status": status})
+
+    sender.start()
+    sender.close()
+
+    assert [json.loads(args[1])["status"] for args, _ in producer.send.call_args_list] == [
+        "processing",
+        "processing_success",
+    ]
+
+
+def test_payload_tracker_sender_flush_times_out():
+    sending = threading.Event()
+    producer = Mock(**{"send.side_effect": lambda *args: sending.wait(5)})
+    sender = PayloadTrackerSender(producer, queue_size=10, flush_timeout=0.01)
+    sender.start()
+
+    sender.add(DEFAULT_TOPIC, {"request_id": "1234567890", "status": "received"})
+
+    assert sender.flush() is False
+    sending.set()
+    assert sender.flush(timeout=5) is True
+    sender.close()
+
+
+@pytest.mark.parametrize(
+    ("success_sample_rate", "expected_statuses"), ((0, ["received", "error"]), (1, ["received", "success", "error"]))
+)
+def test_payload_tracker_sender_samples_success_statuses(success_sample_rate, expected_statuses):
+    producer = Mock()
+    sender = PayloadTrackerSender(producer, queue_size=10, success_sample_rate=success_sample_rate)
+    sender.start()
+
+    for request_id, status in (("1", "received"), ("1", "success"), ("2", "error")):
+        sender.add(DEFAULT_TOPIC, {"request_id": request_id, "status": status})
+    sender.close()
+
+    assert [json.loads(args[1])["status"] for args, _ in producer.send.call_args_list] == expected_statuses
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from base64 import b64decode
 from base64 import b64encode
 from copy import deepcopy
 from datetime import datetime
@@ -6,16 +7,27 @@ from datetime import timedelta
 from datetime import timezone
 from itertools import product
 from json import dumps
+from json import loads
 from random import choice
+from types import SimpleNamespace
 from unittest import main
 from unittest import TestCase
+from unittest.mock import ANY
+from unittest.mock import call
 from unittest.mock import MagicMock
 from unittest.mock import Mock
 from unittest.mock import patch
 from uuid import UUID
 from uuid import uuid4
 
+from connexion.decorators.validation import coerce_type
+from jsonschema.validators import validator_for
 from kafka.errors import KafkaError
+from kafka.future import Future
+from marshmallow import fields as marshmallow_fields
+from marshmallow import post_dump
+from marshmallow import Schema
+from sqlalchemy.exc import IntegrityError
 
 from api import api_operation
 from api import custom_escape
@@ -25,21 +37,31 @@ from api.parsing import custom_fields_parser
 from app import create_app
 from app.auth.identity import from_auth_header
 from app.auth.identity import from_bearer_token
+from app.auth.identity import FrozenIdentity
 from app.auth.identity import Identity
+from app.auth.identity import IdentityCache
 from app.auth.identity import SHARED_SECRET_ENV_VAR
 from app.config import Config
 from app.culling import _Config as CullingConfig
 from app.culling import Timestamps
 from app.environment import RuntimeEnvironment
 from app.exceptions import InputFormatException
+from app.exceptions import InventoryException
 from app.exceptions import ValidationException
+from app.instrumentation import stage_timer
+from app.instrumentation import start_stage_timings
 from app.logging import threadctx
+from app.models import _system_profile_normalizers
 from app.models import Host
 from app.models import HostSchema
+from app.models import LimitedHostSchema
 from app.models import SystemProfileNormalizer
+from app.queue.event_producer import DeadLetterProducer
 from app.queue.event_producer import EventProducer
 from app.queue.event_producer import logger as event_producer_logger
 from app.queue.events import build_event
+from app.queue.events import EVENT_TYPE_MAP
+from app.queue.events import EventSerializer
 from app.queue.events import EventType
 from app.queue.events import message_headers
 from app.serialization import _deserialize_canonical_facts
@@ -56,6 +78,7 @@ from app.serialization import serialize_canonical_facts
 from app.serialization import serialize_host
 from app.serialization import serialize_host_system_profile
 from app.utils import Tag
+from lib.host_count import HostCountCache
 from tests.helpers.mq_utils import expected_encoded_headers
 from tests.helpers.system_profile_utils import INVALID_SYSTEM_PROFILES
 from tests.helpers.system_profile_utils import mock_system_profile_specification
@@ -174,6 +197,122 @@ class AuthIdentityFromAuthHeaderTestCase(AuthIdentityConstructorTestCase):
             from_auth_header(base64)
 
 
+class AuthIdentityCacheTestCase(TestCase):
+    @staticmethod
+    def _header(identity):
+        return b64encode(dumps({"identity": identity}).encode()).decode("ascii")
+
+    def _cache(self, size):
+        decode = Mock(side_effect=lambda base64: FrozenIdentity(loads(b64decode(base64))["identity"]))
+        return IdentityCache(size, decode), decode
+
+    @patch("app.auth.identity.identity_cache_miss")
+    @patch("app.auth.identity.identity_cache_hit")
+    def test_decoded_once(self, identity_cache_hit, identity_cache_miss):
+        cache, decode = self._cache(10)
+        header = self._header(SYSTEM_IDENTITY)
+
+        identities = [cache.get(header) for _ in range(3)]
+
+        decode.assert_called_once_with(header)
+        self.assertIs(identities[0], identities[1])
+        self.assertIs(identities[0], identities[2])
+        self.assertEqual(identity_cache_miss.inc.call_count, 1)
+        self.assertEqual(identity_cache_hit.inc.call_count, 2)
+
+    def test_least_recently_used_evicted(self):
+        cache, decode = self._cache(2)
+        headers = [self._header({**USER_IDENTITY, "account_number": str(account)}) for account in range(3)]
+
+        for header in (headers[0], headers[1], headers[0], headers[2], headers[0], headers[1]):
+            cache.get(header)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(
+            decode.call_args_list, [call(headers[0]), call(headers[1]), call(headers[2]), call(headers[1])]
+        )
+
+    def test_invalid_identity_not_cached(self):
+        cache, decode = self._cache(10)
+        header = self._header({**USER_IDENTITY, "account_number": None})
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.get(header)
+
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_disabled(self):
+        cache, decode = self._cache(0)
+        header = self._header(USER_IDENTITY)
+
+        cache.get(header)
+        cache.get(header)
+
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual(len(cache), 0)
+
+    def test_cached_identity_is_frozen(self):
+        identity = from_auth_header(self._header(SYSTEM_IDENTITY))
+
+        with self.assertRaises(AttributeError):
+            identity.account_number = "other"
+        with self.assertRaises(TypeError):
+            identity.system["cn"] = "other"
+        self.assertEqual(identity._asdict(), Identity(deepcopy(SYSTEM_IDENTITY))._asdict())
+
+    def test_account_number_set_on_cache_hit(self):
+        header = self._header(USER_IDENTITY)
+        from_auth_header(header)
+        threadctx.account_number = "other"
+
+        from_auth_header(header)
+
+        self.assertEqual(threadctx.account_number, USER_IDENTITY["account_number"])
+
+
+class HostCountCacheTestCase(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = HostCountCache(2, clock=lambda: self.now)
+
+    def test_total_expires(self):
+        self.cache.set("account", "key", 5, 30)
+
+        self.now = 29
+        self.assertEqual(self.cache.get("account", "key"), 5)
+        self.now = 30
+        self.assertIsNone(self.cache.get("account", "key"))
+
+    def test_invalidated_per_account(self):
+        self.cache.set("account", "key", 5, 30)
+        self.cache.set("account", "other key", 6, 30)
+        self.cache.set("other account", "key", 7, 30)
+
+        self.cache.invalidate("account")
+
+        self.assertIsNone(self.cache.get("account", "key"))
+        self.assertIsNone(self.cache.get("account", "other key"))
+        self.assertEqual(self.cache.get("other account", "key"), 7)
+
+    def test_least_recently_used_account_evicted(self):
+        for account in ("1", "2"):
+            self.cache.set(account, "key", 5, 30)
+        self.cache.get("1", "key")
+        self.cache.set("3", "key", 5, 30)
+
+        self.assertEqual(self.cache.get("1", "key"), 5)
+        self.assertIsNone(self.cache.get("2", "key"))
+        self.assertEqual(self.cache.get("3", "key"), 5)
+
+    def test_disabled(self):
+        cache = HostCountCache(0)
+        cache.set("account", "key", 5, 30)
+
+        self.assertIsNone(cache.get("account", "key"))
+
+
 class AuthIdentityValidateTestCase(TestCase):
     def test_valid(self):
         try:
@@ -395,6 +534,31 @@ class ConfigTestCase(TestCase):
                     with self.assertRaises(ValueError):
                         self._config()
 
+    def test_kafka_consumer_topic_lanes(self):
+        new_env = {
+            "KAFKA_CONSUMER_TOPICS": "platform.inventory.host-ingress, platform.inventory.system-profile",
+            "INVENTORY_MQ_WORKER_COUNT": "2",
+            "INVENTORY_MQ_LANE_WORKER_COUNTS": "4",
+        }
+        with set_environment(new_env):
+            config = self._config()
+
+        self.assertEqual(
+            config.kafka_consumer_topics, ["platform.inventory.host-ingress", "platform.inventory.system-profile"]
+        )
+        self.assertEqual(
+            config.mq_lane_worker_counts,
+            {"platform.inventory.host-ingress": 4, "platform.inventory.system-profile": 2},
+        )
+        self.assertFalse(config.kafka_consumer["enable_auto_commit"])
+
+    def test_kafka_consumer_topics_default(self):
+        with set_environment({"KAFKA_CONSUMER_TOPIC": "platform.inventory.system-profile"}):
+            config = self._config()
+
+        self.assertEqual(config.kafka_consumer_topics, ["platform.inventory.system-profile"])
+        self.assertTrue(config.kafka_consumer["enable_auto_commit"])
+
     def test_kafka_producer_defaults(self):
         config = self._config()
 
@@ -411,7 +575,14 @@ class ConfigTestCase(TestCase):
 
 
 @patch("app.db.get_engine")
-@patch("app.Config", **{"return_value.mgmt_url_path_prefix": "/"})
+@patch(
+    "app.Config",
+    **{
+        "return_value.mgmt_url_path_prefix": "/",
+        "return_value.payload_tracker_terminal_status_only": False,
+        "return_value.payload_tracker_async": False,
+    },
+)
 class CreateAppConfigTestCase(TestCase):
     def test_config_is_assigned(self, config, get_engine):
         app = create_app(RuntimeEnvironment.TEST)
@@ -1661,6 +1832,20 @@ class HostUpdateStaleTimestamp(TestCase):
                 self.assertEqual(new_reporter, host.reporter)
 
 
+class HostReportedContentHashTestCase(TestCase):
+    def test_hash_does_not_depend_on_time_zone(self):
+        host = Host(
+            canonical_facts={"fqdn": "some fqdn"},
+            stale_timestamp=datetime.now(timezone.utc) + timedelta(days=1),
+            reporter="some reporter",
+        )
+        content_digest = host.reported_content_digest()
+        host.update_reported_content_hash("some reporter", content_digest)
+
+        host.modified_on = host.modified_on.astimezone(timezone(timedelta(hours=2)))
+        self.assertTrue(host.is_reported_content_unchanged("some reporter", content_digest))
+
+
 class SerializationDeserializeTags(TestCase):
     def test_deserialize_structured(self):
         for function in (_deserialize_tags, _deserialize_tags_list):
@@ -1811,6 +1996,257 @@ class EventProducerTests(TestCase):
             self.event_producer._kafka_producer.send.side_effect,
         )
 
+    def test_in_flight_events_are_counted_until_delivered(self):
+        futures = [Future(), Future()]
+        self.event_producer._kafka_producer.send.side_effect = futures
+        event = build_event(EventType.created, self.basic_host)
+        headers = message_headers(EventType.created, self.basic_host["id"])
+
+        for _ in futures:
+            self.event_producer.write_event(event, self.basic_host["id"], headers)
+        self.assertEqual(self.event_producer.in_flight, 2)
+
+        futures[0].success(None)
+        futures[1].failure(KafkaError())
+        self.assertEqual(self.event_producer.in_flight, 0)
+
+    def test_in_flight_event_not_counted_on_send_error(self):
+        self.event_producer._kafka_producer.send.side_effect = KafkaError()
+        event = build_event(EventType.created, self.basic_host)
+        headers = message_headers(EventType.created, self.basic_host["id"])
+
+        with self.assertRaises(KafkaError):
+            self.event_producer.write_event(event, self.basic_host["id"], headers)
+        self.assertEqual(self.event_producer.in_flight, 0)
+
+    @patch("app.queue.event_producer.KafkaProducer")
+    def _aggregate_event_producer(self, futures, mock_kafka_producer):
+        self.config.event_producer_aggregate_delivery = True
+        event_producer = EventProducer(self.config)
+        event_producer._kafka_producer.send.side_effect = futures
+        return event_producer
+
+    def _write_events(self, event_producer, event_types):
+        for event_type in event_types:
+            event = build_event(event_type, self.basic_host)
+            headers = message_headers(event_type, self.basic_host["id"])
+            event_producer.write_event(event, self.basic_host["id"], headers)
+
+    @patch("app.queue.event_producer.message_not_produced")
+    @patch("app.queue.event_producer.message_produced")
+    def test_aggregate_delivery_logs_failures_only(self, message_produced_mock, message_not_produced_mock):
+        futures = [Future(), Future()]
+        event_producer = self._aggregate_event_producer(futures)
+        self._write_events(event_producer, (EventType.created, EventType.updated))
+        self.assertEqual(event_producer.in_flight, 2)
+
+        futures[0].success(SimpleNamespace(topic=self.topic_name))
+        error = KafkaError()
+        futures[1].failure(error)
+
+        message_produced_mock.assert_not_called()
+        message_not_produced_mock.assert_called_once_with(
+            event_producer_logger, self.topic_name, ANY, self.basic_host["id"], ANY, error
+        )
+        self.assertEqual(event_producer.in_flight, 0)
+
+    @patch("app.queue.event_producer.message_not_produced")
+    def test_aggregate_delivery_summary(self, message_not_produced_mock):
+        futures = [Future(), Future(), Future()]
+        event_producer = self._aggregate_event_producer(futures)
+        self._write_events(event_producer, (EventType.created, EventType.created, EventType.updated))
+
+        with self.assertLogs(event_producer_logger, "INFO") as logs:
+            for future in futures[:2]:
+                future.success(SimpleNamespace(topic=self.topic_name))
+            futures[2].failure(KafkaError())
+            event_producer_logger.info("No summary before the interval has passed")
+            event_producer.close()
+
+        summary = logs.records[1]
+        self.assertEqual(summary.getMessage(), "Produced 2 events, 1 events not produced in the last 0 s")
+        self.assertEqual(summary.produced, {self.topic_name: {"created": 2}})
+        self.assertEqual(summary.not_produced, {self.topic_name: {"updated": 1}})
+        self.assertEqual(len(logs.records), 2)
+
+
+class EventSerializerGoldenTestCase(TestCase):
+    """
+    The precompiled serializer must produce exactly the same JSON as the marshmallow schemas.
+    """
+
+    def setUp(self):
+        threadctx.request_id = str(uuid4())
+
+    @staticmethod
+    def _serialized_host(**values):
+        host = Host(
+            canonical_facts={
+                "insights_id": str(uuid4()),
+                "fqdn": "héllo.example.com",
+                "ip_addresses": ["10.0.0.1", "10.0.0.2"],
+                "mac_addresses": ["aa:bb:cc:dd:ee:ff"],
+                "provider_id": "i-05d2313e6b9a42b16",
+                "provider_type": "aws",
+            },
+            display_name='display name \u2603 "quoted" / slash',
+            account="test",
+            facts={"some namespace": {"some key": "some value"}},
+            tags={"some namespace": {"some key": ["some value", "another value"]}, "null": {"key": []}},
+            system_profile_facts={"number_of_cpus": 1.5, "installed_packages": ["vim"], "nested": {"a": None}},
+            stale_timestamp=datetime.now(timezone.utc),
+            reporter="test",
+            **values,
+        )
+        host.id = uuid4()
+        host.created_on = datetime.now(timezone.utc)
+        host.modified_on = datetime.now(timezone.utc)
+        config = CullingConfig(stale_warning_offset_delta=timedelta(days=7), culled_offset_delta=timedelta(days=14))
+        return serialize_host(host, Timestamps(config), DEFAULT_FIELDS + ("tags", "system_profile"))
+
+    def _assert_golden(self, event_type, host, **kwargs):
+        schema, event = EVENT_TYPE_MAP[event_type](event_type, host, **kwargs)
+        self.assertEqual(EventSerializer(schema).dumps(event), schema().dumps(event))
+
+    def test_create_update_events(self):
+        hosts = (
+            self._serialized_host(),
+            self._serialized_host(ansible_host="ansible"),
+            {"id": str(uuid4()), "account": "test", "display_name": None, "tags": [], "system_profile": {}},
+            {"id": str(uuid4()), "account": "test", "ip_addresses": None, "tags": None, "system_profile": None},
+            {"account": "test", "facts": [{"namespace": "ignored"}]},
+        )
+        for event_type, host, platform_metadata in product(
+            (EventType.created, EventType.updated), hosts, (None, {"request_id": "1", "b64_identity": "abc"})
+        ):
+            with self.subTest(event_type=event_type, host=host, platform_metadata=platform_metadata):
+                self._assert_golden(event_type, host, platform_metadata=platform_metadata)
+
+    def test_delete_event(self):
+        for canonical_facts in ({"insights_id": str(uuid4())}, {"fqdn": "fqdn"}):
+            host = Host(
+                canonical_facts=canonical_facts,
+                account="test",
+                stale_timestamp=datetime.now(timezone.utc),
+                reporter="test",
+            )
+            host.id = uuid4()
+            with self.subTest(canonical_facts=canonical_facts):
+                self._assert_golden(EventType.delete, host)
+
+    def test_unsupported_schemas_are_rejected(self):
+        class ProcessedSchema(Schema):
+            value = marshmallow_fields.Str()
+
+            @post_dump
+            def process(self, data, **kwargs):
+                return data
+
+        class UnsupportedFieldSchema(Schema):
+            value = marshmallow_fields.Method("get_value")
+
+        for schema in (ProcessedSchema, UnsupportedFieldSchema):
+            with self.subTest(schema=schema):
+                with self.assertRaises(ValueError):
+                    EventSerializer(schema)
+
+
+class DeadLetterProducerTests(TestCase):
+    @patch("app.queue.event_producer.KafkaProducer")
+    def setUp(self, mock_kafka_producer):
+        super().setUp()
+
+        self.config = Config(RuntimeEnvironment.TEST)
+        self.config.dead_letter_topic = "platform.inventory.host-ingress-dead-letter"
+        self.dead_letter_producer = DeadLetterProducer(self.config)
+        self.message = SimpleNamespace(
+            topic="platform.inventory.host-ingress",
+            partition=1,
+            offset=2,
+            key=b"key",
+            value='{"operation": "add_host"}',
+        )
+
+    def test_happy_path(self):
+        error = ValueError("Invalid host")
+        self.dead_letter_producer.write_dead_letter(self.message, error, {"parse": 0.5})
+
+        self.dead_letter_producer._kafka_producer.send.assert_called_once_with(
+            self.config.dead_letter_topic,
+            key=b"key",
+            value=b'{"operation": "add_host"}',
+            headers=[
+                ("exception", b"builtins.ValueError"),
+                ("error", b"Invalid host"),
+                ("source_topic", b"platform.inventory.host-ingress"),
+                ("source_partition", b"1"),
+                ("source_offset", b"2"),
+                ("stage_timings", b'{"parse": 0.5}'),
+            ],
+        )
+
+    def test_error_is_only_the_exception_message(self):
+        database_error = IntegrityError(
+            "INSERT INTO hosts ...", {"canonical_facts": {"fqdn": "host"}}, Exception("dup")
+        )
+        for error, message in (
+            (database_error, b"dup"),
+            (ValidationException("Invalid host"), b"Invalid host"),
+            (InventoryException(title="Bad Request", detail="Invalid host"), b"Invalid host"),
+        ):
+            with self.subTest(error=error):
+                self.dead_letter_producer._kafka_producer.send.reset_mock()
+                self.dead_letter_producer.write_dead_letter(self.message, error, {})
+
+                headers = dict(self.dead_letter_producer._kafka_producer.send.call_args[1]["headers"])
+                self.assertEqual(headers["error"], message)
+
+    def test_kafka_errors_are_not_raised(self):
+        self.dead_letter_producer._kafka_producer.send.side_effect = KafkaError()
+
+        with self.assertLogs(event_producer_logger, "ERROR"):
+            self.dead_letter_producer.write_dead_letter(self.message, ValueError(), {})
+
+    def _send_future(self):
+        future = Future()
+        # The callbacks must not fail, their errors are raised instead of being logged by Kafka.
+        future.error_on_callbacks = True
+        self.dead_letter_producer._kafka_producer.send.return_value = future
+        self.dead_letter_producer.write_dead_letter(self.message, ValueError(), {})
+        return future
+
+    def test_delivery_callbacks(self):
+        with self.assertLogs(event_producer_logger, "INFO"):
+            self._send_future().success(SimpleNamespace(topic=self.config.dead_letter_topic, offset=3, timestamp=4))
+
+        with self.assertLogs(event_producer_logger, "ERROR"):
+            self._send_future().failure(KafkaError())
+
+
+class InstrumentationStageTimerTestCase(TestCase):
+    def setUp(self):
+        start_stage_timings()
+
+    def tearDown(self):
+        vars(threadctx).pop("stage_timings", None)
+
+    @patch("app.instrumentation.perf_counter", side_effect=(0.0, 1.0, 3.0, 6.0, 10.0, 11.0))
+    def test_nested_stage_time_is_not_counted_in_enclosing_stage(self, perf_counter):
+        with stage_timer("outer"):
+            with stage_timer("inner"):
+                pass
+        with stage_timer("inner"):
+            pass
+
+        self.assertEqual(threadctx.stage_timings, {"outer": 4.0, "inner": 3.0})
+
+    def test_no_timings_outside_of_message(self):
+        del threadctx.stage_timings
+        with stage_timer("stage"):
+            pass
+
+        self.assertFalse(hasattr(threadctx, "stage_timings"))
+
 
 class ModelsSystemProfileNormalizerFilterKeysTestCase(TestCase):
     def setUp(self):
@@ -1952,6 +2388,103 @@ class ModelsSystemProfileNormalizerFilterKeysTestCase(TestCase):
         self.assertEqual(original, payload)
 
 
+class ModelsSystemProfileNormalizerCoerceTypesTestCase(TestCase):
+    def setUp(self):
+        self.normalizer = SystemProfileNormalizer()
+
+    def test_types_are_coerced_as_in_connexion(self):
+        for original in (
+            {"number_of_cpus": "1", "katello_agent_running": "true", "owner_id": "1"},
+            {"operating_system": {"major": "8", "minor": "1", "name": "RHEL"}, "rhsm": {"version": "8.1"}},
+            {"number_of_cpus": "one", "sap_system": "maybe", "operating_system": "RHEL 8.1"},
+            {"network_interfaces": [{"mtu": "1500"}], "cpu_flags": ["1"], "unknown": "1"},
+            {"owner_id": {}, "system_memory_bytes": 1.5, "is_marketplace": False},
+        ):
+            with self.subTest(original=original):
+                expected = deepcopy(original)
+                coerce_type(self.normalizer.schema["$defs"]["SystemProfile"], expected, "property")
+
+                payload = deepcopy(original)
+                self.normalizer.coerce_types(payload)
+                self.assertEqual(expected, payload)
+
+    def test_root_non_object_is_not_coerced(self):
+        self.normalizer.schema["$defs"]["SystemProfile"] = {"properties": {"number_of_cpus": {"type": "integer"}}}
+        payload = {"number_of_cpus": "1"}
+        self.normalizer.coerce_types(payload)
+        self.assertEqual({"number_of_cpus": "1"}, payload)
+
+
+class ModelsSystemProfileNormalizerCopyTestCase(TestCase):
+    def setUp(self):
+        self.normalizer = SystemProfileNormalizer()
+
+    def test_filtered_keys_match_filter_keys(self):
+        for original in (
+            {"number_of_cpus": 1, "number_of_gpus": 2},
+            {"network_interfaces": [{"ipv4_addresses": ["10.0.0.1"], "mac_addresses": ["aa:bb:cc:dd:ee:ff"]}]},
+            {
+                "disk_devices": [{"options": {"uid": "0"}, "size": 1}, {"options": "uid=0"}],
+                "network_interfaces": "eth0",
+            },
+        ):
+            with self.subTest(original=original):
+                payload = deepcopy(original)
+                result = self.normalizer.filtered_keys(payload)
+                self.assertEqual(original, payload)
+
+                self.normalizer.filter_keys(payload)
+                self.assertEqual(payload, result)
+
+    def test_coerced_types_match_coerce_types(self):
+        for original in (
+            {"number_of_cpus": "1", "owner_id": "1"},
+            {"operating_system": {"major": "8", "minor": "1", "name": "RHEL"}, "rhsm": {"version": "8.1"}},
+            {"number_of_cpus": "one", "operating_system": "RHEL 8.1"},
+        ):
+            with self.subTest(original=original):
+                payload = deepcopy(original)
+                result = self.normalizer.coerced_types(payload)
+                self.assertEqual(original, payload)
+
+                self.normalizer.coerce_types(payload)
+                self.assertEqual(payload, result)
+
+    def test_unchanged_values_are_shared(self):
+        payload = {"installed_packages": ["openssl-1:1.1.1c-2.fc30.x86_64"], "rhsm": {"version": "8.1"}}
+        self.assertIs(payload, self.normalizer.coerced_types(payload))
+        self.assertIs(payload["installed_packages"], self.normalizer.filtered_keys(payload)["installed_packages"])
+
+
+class ModelsSystemProfileNormalizerFilterPlanTestCase(TestCase):
+    def test_plan_is_built_once(self):
+        normalizer = SystemProfileNormalizer()
+        with patch.object(normalizer, "_resolver", wraps=normalizer._resolver) as resolver:
+            normalizer.filter_keys({"network_interfaces": [{"mtu": 1500}]})
+            resolve_count = resolver.resolve.call_count
+
+            normalizer.filter_keys({"network_interfaces": [{"mtu": 1500}], "disk_devices": [{"device": "/dev/sda"}]})
+            self.assertEqual(resolve_count, resolver.resolve.call_count)
+
+    def test_recursive_definitions_are_filtered(self):
+        spec = {
+            "$defs": {
+                "SystemProfile": {"type": "object", "properties": {"tree": {"$ref": "#/$defs/Node"}}},
+                "Node": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string"},
+                        "children": {"type": "array", "items": {"$ref": "#/$defs/Node"}},
+                    },
+                },
+            }
+        }
+        normalizer = SystemProfileNormalizer(system_profile_schema=spec)
+        payload = {"tree": {"name": "a", "size": 1, "children": [{"name": "b", "size": 2, "children": []}]}}
+        normalizer.filter_keys(payload)
+        self.assertEqual({"tree": {"name": "a", "children": [{"name": "b", "children": []}]}}, payload)
+
+
 class ModelsSystemProfileTestCase(TestCase):
     def _payload(self, system_profile):
         return {
@@ -2006,21 +2539,70 @@ class ModelsSystemProfileTestCase(TestCase):
         expected = {"number_of_cpus": 1, "network_interfaces": [{"ipv4_addresses": ["10.10.10.1"]}]}
         self.assertEqual(expected, result["system_profile"])
 
-    @patch("app.models.jsonschema_validate")
-    def test_type_coercion_happens_before_loading(self, jsonschema_validate):
+    def test_input_is_not_modified(self):
+        system_profile = {
+            "number_of_cpus": "1",
+            "number_of_gpus": 2,
+            "operating_system": {"major": "8", "minor": 1, "name": "RHEL"},
+            "network_interfaces": [{"ipv4_addresses": ["10.10.10.1"], "mac_addresses": ["aa:bb:cc:dd:ee:ff"]}],
+            "installed_packages": ["openssl-1:1.1.1c-2.fc30.x86_64"],
+        }
+        original = deepcopy(system_profile)
+
+        result = HostSchema().load(self._payload(system_profile))
+
+        self.assertEqual(original, system_profile)
+        expected = {
+            "number_of_cpus": 1,
+            "operating_system": {"major": 8, "minor": 1, "name": "RHEL"},
+            "network_interfaces": [{"ipv4_addresses": ["10.10.10.1"]}],
+            "installed_packages": ["openssl-1:1.1.1c-2.fc30.x86_64"],
+        }
+        self.assertEqual(expected, result["system_profile"])
+
+    @patch("app.models.SystemProfileNormalizer.validate")
+    def test_type_coercion_happens_before_loading(self, validate):
         schema = HostSchema()
         payload = self._payload({"number_of_cpus": "1"})
         schema.load(payload)
-        jsonschema_validate.assert_called_once_with({"number_of_cpus": 1}, HostSchema.system_profile_normalizer.schema)
+        validate.assert_called_once_with({"number_of_cpus": 1})
 
-    @patch("app.models.jsonschema_validate")
-    def test_type_filtering_happens_after_loading(self, jsonschema_validate):
+    @patch("app.models.SystemProfileNormalizer.validate")
+    def test_type_filtering_happens_after_loading(self, validate):
         schema = HostSchema()
         payload = self._payload({"number_of_gpus": 1})
         result = schema.load(payload)
-        jsonschema_validate.assert_called_once_with({"number_of_gpus": 1}, HostSchema.system_profile_normalizer.schema)
+        validate.assert_called_once_with({"number_of_gpus": 1})
         self.assertEqual({}, result["system_profile"])
 
+    def test_custom_specification_validator_is_reused(self):
+        spec = system_profile_specification()
+        spec["$defs"]["SystemProfile"]["properties"]["number_of_cpus"]["minimum"] = 2
+        HostSchema()
+
+        with patch("app.models.validator_for", wraps=validator_for) as validator_for_mock:
+            for number_of_cpus in (1, 2):
+                schema = HostSchema(system_profile_schema=spec)
+                schema.validate(self._payload({"number_of_cpus": number_of_cpus}))
+
+            validator_for_mock.assert_called_once()
+
+        result = HostSchema(system_profile_schema=spec).validate(self._payload({"number_of_cpus": 1}))
+        self._assert_system_profile_is_invalid(result)
+        self.assertIs(
+            HostSchema(system_profile_schema=spec).system_profile_normalizer,
+            LimitedHostSchema(system_profile_schema=spec).system_profile_normalizer,
+        )
+
+    @patch("app.models.SYSTEM_PROFILE_NORMALIZERS_SIZE", 2)
+    def test_custom_specification_validators_are_bounded(self):
+        specs = [system_profile_specification() for _ in range(3)]
+        normalizers = [HostSchema(system_profile_schema=spec).system_profile_normalizer for spec in specs]
+
+        self.assertEqual(2, len(_system_profile_normalizers))
+        self.assertIsNot(normalizers[0], HostSchema(system_profile_schema=specs[0]).system_profile_normalizer)
+        self.assertIs(normalizers[2], HostSchema(system_profile_schema=specs[2]).system_profile_normalizer)
+
 
 class QueryParameterParsingTestCase(TestCase):
     def test_custom_fields_parser(self):
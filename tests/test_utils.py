@@ -1,11 +1,27 @@
 from collections import namedtuple
 from itertools import product
 from tempfile import TemporaryFile
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 
 from pytest import mark
+from pytest import raises
+from sqlalchemy.exc import IntegrityError
 from yaml import safe_load
 
+from app import threadctx
+from app import UNKNOWN_REQUEST_ID_VALUE
+from app.models import canonical_fact_pairs
+from app.models import db
+from app.models import Host
+from app.models import HostCanonicalFact
+from tests.helpers.test_utils import generate_uuid
+from utils.create_host_upsert_indexes import create_unique_indexes
+from utils.create_host_upsert_indexes import delete_duplicate_hosts
+from utils.create_host_upsert_indexes import drop_unique_indexes
 from utils.deploy import main as deploy
+from utils.replay_dead_letters import ReplayConsumer
+from utils.sync_host_canonical_facts import sync_host_canonical_facts
 
 RESOURCE_TEMPLATES_INDEXES = {
     "insights-inventory-reaper": 0,
@@ -124,3 +140,66 @@ def test_deploy_image_tag_is_replaced(args_targets):
 def test_deploy_formatting_is_not_changed():
     result = _run_deploy("abcd1234", ["prod", "stage"], DEPLOY_YML)
     assert _head(result) == _head(DEPLOY_YML)
+
+
+def _dead_letter(source_topic, exception):
+    return SimpleNamespace(headers=[("exception", exception.encode()), ("source_topic", source_topic.encode())])
+
+
+@mark.parametrize(("exception", "replayed"), ((None, (0, 2)), ("builtins.KeyError", (2,))))
+def test_replay_consumer_hands_over_the_source_topic_dead_letters(exception, replayed):
+    dead_letters = (
+        _dead_letter("platform.inventory.host-ingress", "builtins.ValueError"),
+        _dead_letter("platform.inventory.system-profile", "builtins.ValueError"),
+        _dead_letter("platform.inventory.host-ingress", "builtins.KeyError"),
+        _dead_letter("platform.inventory.unknown", "builtins.KeyError"),
+    )
+    consumer = MagicMock()
+    consumer.poll.return_value = {"dead-letter-0": dead_letters}
+
+    replay_consumer = ReplayConsumer(consumer, "platform.inventory.host-ingress", exception)
+
+    assert replay_consumer.poll(timeout_ms=1000) == {"dead-letter-0": [dead_letters[index] for index in replayed]}
+    replay_consumer.commit()
+    consumer.commit.assert_not_called()
+
+
+def test_sync_host_canonical_facts(db_create_multiple_hosts):
+    hosts = db_create_multiple_hosts(how_many=3)
+    expected_rows = {
+        (host.id, host.account, fact_name, fact_value)
+        for host in hosts
+        for fact_name, fact_value in canonical_fact_pairs(host.canonical_facts)
+    }
+    HostCanonicalFact.query.filter(HostCanonicalFact.host_id == hosts[0].id).delete()
+    db.session.add(HostCanonicalFact(host_id=hosts[1].id, account=hosts[1].account, fact_name="fqdn", fact_value="x"))
+    db.session.commit()
+
+    assert sync_host_canonical_facts(db.session, chunk_size=2) == 3
+
+    rows = {(row.host_id, row.account, row.fact_name, row.fact_value) for row in HostCanonicalFact.query.all()}
+    assert rows == expected_rows
+
+
+def test_create_host_upsert_indexes(db_create_host):
+    insights_id = generate_uuid()
+    duplicate_hosts = [db_create_host(extra_data={"canonical_facts": {"insights_id": insights_id}}) for _ in range(3)]
+    other_host = db_create_host()
+    event_producer = MagicMock()
+    threadctx.request_id = UNKNOWN_REQUEST_ID_VALUE
+
+    assert delete_duplicate_hosts(db.session, event_producer, chunk_size=1) == 2
+
+    # The most recently modified duplicate is kept.
+    assert {host.id for host in Host.query.all()} == {duplicate_hosts[-1].id, other_host.id}
+    assert event_producer.write_event.call_count == 2
+
+    create_unique_indexes(db.session.connection(), concurrently=False)
+    db.session.commit()
+    try:
+        with raises(IntegrityError):
+            db_create_host(extra_data={"canonical_facts": {"insights_id": insights_id}})
+    finally:
+        db.session.rollback()
+        drop_unique_indexes(db.session.connection(), concurrently=False)
+        db.session.commit()
@@ -0,0 +1,61 @@
+import logging
+import os
+from timeit import timeit
+from unittest.mock import patch
+from uuid import uuid4
+
+from kafka.future import Future
+from kafka.producer.future import RecordMetadata
+
+from app.config import Config
+from app.environment import RuntimeEnvironment
+from app.logging import threadctx
+from app.queue.event_producer import EventProducer
+from app.queue.events import build_event
+from app.queue.events import EventType
+from app.queue.events import message_headers
+
+ITERATIONS = int(os.environ.get("ITERATIONS", 20000))
+
+
+class InMemoryKafkaProducer:
+    # Stands in for the KafkaProducer: every record is acknowledged immediately, so the delivery callbacks run
+    # as soon as they are added.
+    def __init__(self, *args, **kwargs):
+        self.offset = 0
+
+    def send(self, topic, key=None, value=None, headers=None):
+        self.offset += 1
+        future = Future()
+        future.success(RecordMetadata(topic, 0, None, self.offset, 0, -1, None, len(key), len(value), -1))
+        return future
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def main():
+    threadctx.request_id = str(uuid4())
+    host = {"id": str(uuid4()), "account": "benchmark", "fqdn": "benchmark.example.com"}
+    event = build_event(EventType.updated, host)
+    headers = message_headers(EventType.updated, host["id"])
+    print("Iterations: ", ITERATIONS)
+
+    config = Config(RuntimeEnvironment.COMMAND)
+    for name, aggregate_delivery in (("per-event logs", False), ("aggregate delivery", True)):
+        config.event_producer_aggregate_delivery = aggregate_delivery
+        with patch("app.queue.event_producer.KafkaProducer", InMemoryKafkaProducer):
+            event_producer = EventProducer(config)
+
+        seconds = timeit(lambda: event_producer.write_event(event, host["id"], headers), number=ITERATIONS)
+        event_producer.close()
+        print(f"{name}: {seconds / ITERATIONS * 1000000:.1f} µs/event, {ITERATIONS / seconds:.1f} events/s")
+
+
+if __name__ == "__main__":
+    # The records are formatted and written as in production, only to nowhere.
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, "w"))
+    main()
@@ -0,0 +1,73 @@
+import logging
+import os
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from uuid import uuid4
+
+import payloads
+
+from app.culling import _Config as CullingConfig
+from app.culling import Timestamps
+from app.logging import threadctx
+from app.models import Host
+from app.queue.events import EVENT_TYPE_MAP
+from app.queue.events import EventSerializer
+from app.queue.events import EventType
+from app.queue.metrics import event_serialization_time
+from app.serialization import DEFAULT_FIELDS
+from app.serialization import serialize_host
+
+NUM_PACKAGES = int(os.environ.get("NUM_PACKAGES", 100))
+ITERATIONS = int(os.environ.get("ITERATIONS", 2000))
+
+
+def build_host():
+    # Builds a serialized host with a system profile containing NUM_PACKAGES installed packages
+    rpms = payloads.rpm_list()
+    payload = payloads.build_host_payload()
+    system_profile = {
+        **payload["system_profile"],
+        "installed_packages": [f"{index}-{rpms[index % len(rpms)]}" for index in range(NUM_PACKAGES)],
+    }
+    host = Host(
+        canonical_facts={"insights_id": str(uuid4()), "provider_id": payload["provider_id"]},
+        display_name=payload["display_name"],
+        account=payload["account"],
+        tags={"namespace": {"key": ["value"]}},
+        system_profile_facts=system_profile,
+        stale_timestamp=datetime.now(timezone.utc),
+        reporter="benchmark",
+    )
+    host.id = uuid4()
+    host.created_on = host.modified_on = datetime.now(timezone.utc)
+    config = CullingConfig(stale_warning_offset_delta=timedelta(days=7), culled_offset_delta=timedelta(days=14))
+    return serialize_host(host, Timestamps(config), DEFAULT_FIELDS + ("tags", "system_profile"))
+
+
+def main():
+    threadctx.request_id = str(uuid4())
+    host = build_host()
+    schema, event = EVENT_TYPE_MAP[EventType.updated](EventType.updated, host, platform_metadata={"request_id": "1"})
+    print("Installed packages: ", NUM_PACKAGES)
+    print("Iterations: ", ITERATIONS)
+
+    serializer = EventSerializer(schema)
+    assert serializer.dumps(event) == schema().dumps(event)
+
+    for name, dumps in (
+        # The serialization used before: a new schema instance on every call
+        ("marshmallow", lambda: schema().dumps(event)),
+        ("precompiled", lambda: serializer.dumps(event)),
+    ):
+        summary = event_serialization_time.labels(f"benchmark_{name}")
+        for _ in range(ITERATIONS):
+            with summary.time():
+                dumps()
+        seconds = summary._sum.get()
+        print(f"{name}: {seconds / ITERATIONS * 1000:.3f} ms/event, {ITERATIONS / seconds:.1f} events/s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
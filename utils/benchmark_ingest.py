@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import random
+import uuid
+from base64 import b64encode
+from collections import defaultdict
+from statistics import quantiles
+from time import perf_counter
+from types import SimpleNamespace
+
+import payloads
+from kafka import TopicPartition
+
+from app import create_app
+from app import db
+from app.environment import RuntimeEnvironment
+from app.logging import threadctx
+from app.models import Host
+from app.payload_tracker import init_payload_tracker
+from app.queue.queue import event_loop
+from app.queue.queue import handle_message
+
+NUM_MESSAGES = int(os.environ.get("NUM_MESSAGES", 2000))
+NUM_PACKAGES = int(os.environ.get("NUM_PACKAGES", 0))
+DUPLICATE_RATIO = float(os.environ.get("DUPLICATE_RATIO", 0.2))
+NUM_PARTITIONS = int(os.environ.get("NUM_PARTITIONS", 4))
+POLL_SIZE = int(os.environ.get("POLL_SIZE", 500))
+SEED = int(os.environ.get("SEED", 0))
+ACCOUNT = os.environ.get("BENCHMARK_ACCOUNT", "benchmark")
+
+TOPIC = "platform.inventory.host-ingress"
+
+
+class InMemoryConsumer:
+    # Stands in for the KafkaConsumer: hands over the messages in polls of up to POLL_SIZE messages per partition.
+    def __init__(self, values, number_of_partitions, poll_size):
+        self._partitions = [TopicPartition(TOPIC, partition) for partition in range(number_of_partitions)]
+        self._messages = defaultdict(list)
+        for index, value in enumerate(values):
+            topic_partition = self._partitions[index % number_of_partitions]
+            offset = len(self._messages[topic_partition])
+            self._messages[topic_partition].append(
+                SimpleNamespace(
+                    topic=TOPIC, partition=topic_partition.partition, offset=offset, key=None, value=value, headers=[]
+                )
+            )
+        self._positions = {topic_partition: 0 for topic_partition in self._partitions}
+        self._paused = set()
+        self._poll_size = poll_size
+
+    @property
+    def exhausted(self):
+        return all(self._positions[tp] >= len(self._messages[tp]) for tp in self._partitions)
+
+    def poll(self, timeout_ms=0):
+        msgs = {}
+        for topic_partition in self._partitions:
+            if topic_partition in self._paused:
+                continue
+            start = self._positions[topic_partition]
+            end = start + self._poll_size
+            messages = self._messages[topic_partition][start:end]
+            if messages:
+                msgs[topic_partition] = messages
+                self._positions[topic_partition] = start + len(messages)
+        return msgs
+
+    def assignment(self):
+        return set(self._partitions)
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def commit(self, offsets=None):
+        pass
+
+
+class InMemoryEventProducer:
+    # Stands in for the EventProducer: every event is acknowledged immediately.
+    in_flight = 0
+
+    def __init__(self):
+        self.events = 0
+
+    def write_event(self, event, key, headers, *, wait=False):
+        self.events += 1
+
+
+class InMemoryPayloadTrackerProducer:
+    # Stands in for the payload tracker KafkaProducer.
+    def __init__(self):
+        self.messages = 0
+
+    def send(self, topic, value):
+        self.messages += 1
+
+
+def build_messages(rng):
+    # Builds NUM_MESSAGES add_host messages, DUPLICATE_RATIO of them re-report a host reported before
+    identity = {**payloads.IDENTITY, "account_number": ACCOUNT}
+    b64_identity = b64encode(json.dumps({"identity": identity}).encode("utf-8")).decode("ascii")
+    rpms = payloads.rpm_list()
+    installed_packages = [f"{index}-{rpms[index % len(rpms)]}" for index in range(NUM_PACKAGES)]
+
+    def random_uuid():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    hosts = []
+    messages = []
+    for _ in range(NUM_MESSAGES):
+        if hosts and rng.random() < DUPLICATE_RATIO:
+            host = rng.choice(hosts)
+        else:
+            host = {**payloads.build_host_payload(), "account": ACCOUNT, "provider_id": random_uuid()}
+            host["display_name"] = f"{host['provider_id'][:6]}.foo.redhat.com"
+            host["insights_id"] = random_uuid()
+            if installed_packages:
+                host["system_profile"] = {**host["system_profile"], "installed_packages": installed_packages}
+            hosts.append(host)
+
+        platform_metadata = {"request_id": random_uuid(), "b64_identity": b64_identity}
+        messages.append(json.dumps({"operation": "add_host", "platform_metadata": platform_metadata, "data": host}))
+    return messages, len(hosts)
+
+
+class Recorder:
+    # Wraps the message handler and records the latency and the stage timings of every message.
+    def __init__(self, handler):
+        self._handler = handler
+        self.latencies = []
+        self.stage_timings = defaultdict(float)
+        self.failures = 0
+
+    def __call__(self, message, event_producer):
+        start = perf_counter()
+        try:
+            self._handler(message, event_producer)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.latencies.append(perf_counter() - start)
+            for stage, seconds in getattr(threadctx, "stage_timings", {}).items():
+                self.stage_timings[stage] += seconds
+
+
+def main():
+    application = create_app(RuntimeEnvironment.COMMAND)
+    config = application.config["INVENTORY_CONFIG"]
+    payload_tracker_producer = InMemoryPayloadTrackerProducer()
+    init_payload_tracker(config, producer=payload_tracker_producer)
+
+    messages, unique_hosts = build_messages(random.Random(SEED))
+    print("Messages: ", NUM_MESSAGES)
+    print("Unique hosts: ", unique_hosts)
+    print("Installed packages: ", NUM_PACKAGES)
+    print("Partitions: ", NUM_PARTITIONS)
+    print("Batch mode: ", config.mq_batch_mode)
+    print("Workers: ", config.mq_worker_count)
+
+    with application.app_context():
+        db.create_all()
+        db.session.query(Host).filter(Host.account == ACCOUNT).delete(synchronize_session=False)
+        db.session.commit()
+
+    consumer = InMemoryConsumer(messages, NUM_PARTITIONS, POLL_SIZE)
+    event_producer = InMemoryEventProducer()
+    recorder = Recorder(handle_message)
+
+    start = perf_counter()
+    event_loop(consumer, application, event_producer, recorder, lambda: consumer.exhausted)
+    seconds = perf_counter() - start
+
+    with application.app_context():
+        stored_hosts = db.session.query(Host).filter(Host.account == ACCOUNT).count()
+
+    percentiles = quantiles(recorder.latencies, n=100)
+    handler_seconds = sum(recorder.latencies)
+    print(
+        f"Stored hosts: {stored_hosts}, events: {event_producer.events}, "
+        f"payload tracker messages: {payload_tracker_producer.messages}, failures: {recorder.failures}"
+    )
+    print(f"Throughput: {NUM_MESSAGES / seconds:.1f} msgs/s ({seconds:.3f} s)")
+    print(f"Latency: p50 {percentiles[49] * 1000:.3f} ms, p99 {percentiles[98] * 1000:.3f} ms")
+    for stage, stage_seconds in sorted(recorder.stage_timings.items(), key=lambda item: -item[1]):
+        print(
+            f"  {stage}: {stage_seconds / NUM_MESSAGES * 1000:.3f} ms/msg, "
+            f"{stage_seconds / handler_seconds * 100:.1f} % of the handler time"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
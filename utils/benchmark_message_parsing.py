@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+from timeit import timeit
+
+import payloads
+
+from app.queue.queue import _validate_json_object_for_utf8
+from app.queue.queue import OperationSchema
+from app.queue.queue import parse_operation_message
+
+NUM_PACKAGES = int(os.environ.get("NUM_PACKAGES", 3000))
+ITERATIONS = int(os.environ.get("ITERATIONS", 200))
+
+
+def build_payload():
+    # Builds a MQ message with a system profile containing NUM_PACKAGES installed packages
+    rpms = payloads.rpm_list()
+    message = json.loads(payloads.build_mq_payload())
+    message["data"]["system_profile"]["installed_packages"] = [
+        f"{index}-{rpms[index % len(rpms)]}" for index in range(NUM_PACKAGES)
+    ]
+    return json.dumps(message)
+
+
+def legacy_parse_operation_message(message):
+    # The parsing path used before: decode, walk the whole object, load the envelope with marshmallow
+    parsed_message = json.loads(message)
+    _validate_json_object_for_utf8(parsed_message)
+    return OperationSchema().load(parsed_message)
+
+
+def main():
+    message = build_payload()
+    print("Message size (bytes): ", len(message))
+    print("Iterations: ", ITERATIONS)
+
+    assert legacy_parse_operation_message(message) == parse_operation_message(message)
+
+    for name, parse in (("legacy", legacy_parse_operation_message), ("fast", parse_operation_message)):
+        seconds = timeit(lambda: parse(message), number=ITERATIONS)
+        print(f"{name}: {seconds / ITERATIONS * 1000:.3f} ms/message, {ITERATIONS / seconds:.1f} messages/s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,70 @@
+import logging
+import os
+import tracemalloc
+from copy import deepcopy
+from timeit import timeit
+
+import payloads
+from marshmallow import post_load
+from marshmallow import pre_load
+
+from app.models import HostSchema
+
+NUM_PACKAGES = int(os.environ.get("NUM_PACKAGES", 10000))
+ITERATIONS = int(os.environ.get("ITERATIONS", 20))
+
+
+class LegacyHostSchema(HostSchema):
+    # The normalization used before: the system profile is deep-copied before both the coercion and the filtering
+    @staticmethod
+    def _normalize_system_profile(normalize, data):
+        if "system_profile" not in data:
+            return data
+
+        system_profile = deepcopy(data["system_profile"])
+        normalize(system_profile)
+        return {**data, "system_profile": system_profile}
+
+    @pre_load
+    def coerce_system_profile_types(self, data, **kwargs):
+        return self._normalize_system_profile(self.system_profile_normalizer.coerce_types, data)
+
+    @post_load
+    def filter_system_profile_keys(self, data, **kwargs):
+        return self._normalize_system_profile(self.system_profile_normalizer.filter_keys, data)
+
+
+def build_host():
+    # Builds a host with a system profile containing NUM_PACKAGES installed packages
+    rpms = payloads.rpm_list()
+    host = payloads.build_host_payload()
+    host["system_profile"]["installed_packages"] = [
+        f"{index}-{rpms[index % len(rpms)]}" for index in range(NUM_PACKAGES)
+    ]
+    return host
+
+
+def measure_peak_memory(schema, host):
+    tracemalloc.start()
+    schema.load(host)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    host = build_host()
+    print("Installed packages: ", NUM_PACKAGES)
+    print("Iterations: ", ITERATIONS)
+
+    assert LegacyHostSchema().load(host) == HostSchema().load(host)
+
+    for name, schema in (("legacy", LegacyHostSchema()), ("copy-free", HostSchema())):
+        peak = measure_peak_memory(schema, host)
+        seconds = timeit(lambda: schema.load(host), number=ITERATIONS)
+        print(f"{name}: peak {peak / 1024:.1f} KiB, {seconds / ITERATIONS * 1000:.3f} ms/host")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
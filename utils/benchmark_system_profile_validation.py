@@ -0,0 +1,39 @@
+import logging
+import os
+from timeit import timeit
+
+import payloads
+from jsonschema import validate as jsonschema_validate
+
+from app.models import SystemProfileNormalizer
+
+NUM_PACKAGES = int(os.environ.get("NUM_PACKAGES", 1000))
+ITERATIONS = int(os.environ.get("ITERATIONS", 200))
+
+
+def build_system_profile():
+    # Builds a system profile containing NUM_PACKAGES installed packages
+    rpms = payloads.rpm_list()
+    system_profile = payloads.create_system_profile()
+    system_profile["installed_packages"] = [f"{index}-{rpms[index % len(rpms)]}" for index in range(NUM_PACKAGES)]
+    return system_profile
+
+
+def main():
+    normalizer = SystemProfileNormalizer()
+    system_profile = build_system_profile()
+    print("Installed packages: ", NUM_PACKAGES)
+    print("Iterations: ", ITERATIONS)
+
+    for name, validate in (
+        # The validation used before: meta-schema check and a new validator on every call
+        ("jsonschema.validate", lambda: jsonschema_validate(system_profile, normalizer.schema)),
+        ("precompiled", lambda: normalizer.validate(system_profile)),
+    ):
+        seconds = timeit(validate, number=ITERATIONS)
+        print(f"{name}: {seconds / ITERATIONS * 1000:.3f} ms/validation, {ITERATIONS / seconds:.1f} validations/s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
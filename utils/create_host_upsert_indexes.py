@@ -0,0 +1,158 @@
+import argparse
+
+from sqlalchemy import func
+from sqlalchemy import text
+
+from app import create_app
+from app import UNKNOWN_REQUEST_ID_VALUE
+from app.environment import RuntimeEnvironment
+from app.instrumentation import log_host_delete_failed
+from app.instrumentation import log_host_delete_succeeded
+from app.logging import get_logger
+from app.logging import threadctx
+from app.models import db
+from app.models import Host
+from app.queue.event_producer import EventProducer
+from lib.host_delete import delete_hosts
+from lib.host_repository import ELEVATED_CANONICAL_FACT_FIELDS
+
+logger = get_logger("utils")
+
+DEFAULT_CHUNK_SIZE = 1000
+CONTROL_RULE = "DEDUPLICATION"
+INDEX_NAME = "hosts_account_{canonical_fact}_uindex"
+# Released hosts, culled ones that gave their elevated canonical facts up to a new host, are left out.
+CREATE_INDEX = """
+    CREATE UNIQUE INDEX {concurrently} {index_name} ON hosts (account, (canonical_facts ->> '{canonical_fact}'))
+    WHERE NOT elevated_facts_released
+"""
+DROP_INDEX = "DROP INDEX {concurrently} IF EXISTS {index_name}"
+# None if the index does not exist, false if a concurrent build of it failed.
+INDEX_VALID = text(
+    """
+    SELECT indisvalid FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+    WHERE pg_class.relname = :index_name
+    """
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Builds the unique indexes on the elevated canonical facts needed by INVENTORY_HOST_UPSERT. Of the hosts "
+            "sharing an elevated canonical fact, all but the most recently modified one are deleted first, with "
+            "their delete events. Run it again if a duplicate written in the meantime fails an index build."
+        )
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"number of duplicate hosts deleted at a time (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--drop", action="store_true", help="drop the indexes, after INVENTORY_HOST_UPSERT has been disabled"
+    )
+    return parser.parse_args()
+
+
+def _concurrently(concurrently):
+    return "CONCURRENTLY" if concurrently else ""
+
+
+def duplicate_hosts_query(session, canonical_fact):
+    """
+    The hosts sharing an elevated canonical fact value with a more recently modified host of the same account.
+    """
+    fact = Host.canonical_facts[canonical_fact].astext
+    ranked = (
+        session.query(
+            Host.id,
+            func.row_number()
+            .over(partition_by=(Host.account, fact), order_by=(Host.modified_on.desc(), Host.id.desc()))
+            .label("rank"),
+        )
+        .filter(fact.isnot(None) & Host.elevated_facts_released.is_(False))
+        .subquery()
+    )
+    return session.query(Host).filter(Host.id.in_(session.query(ranked.c.id).filter(ranked.c.rank > 1)))
+
+
+def delete_duplicate_hosts(session, event_producer, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Keeps only the most recently modified host of every group sharing an elevated canonical fact. Returns the number
+    of the deleted hosts.
+    """
+    deleted_hosts = 0
+    for canonical_fact in ELEVATED_CANONICAL_FACT_FIELDS:
+        query = duplicate_hosts_query(session, canonical_fact)
+        for host_id, deleted in delete_hosts(query, event_producer, chunk_size):
+            if deleted:
+                log_host_delete_succeeded(logger, host_id, CONTROL_RULE)
+                deleted_hosts += 1
+            else:
+                log_host_delete_failed(logger, host_id, CONTROL_RULE)
+    return deleted_hosts
+
+
+def create_unique_indexes(connection, concurrently=True):
+    """
+    Builds the missing unique indexes. An invalid index, left by a failed concurrent build, is rebuilt.
+    """
+    for canonical_fact in ELEVATED_CANONICAL_FACT_FIELDS:
+        index_name = INDEX_NAME.format(canonical_fact=canonical_fact)
+        valid = connection.execute(INDEX_VALID, index_name=index_name).scalar()
+        if valid:
+            continue
+
+        if valid is False:
+            connection.execute(
+                text(DROP_INDEX.format(concurrently=_concurrently(concurrently), index_name=index_name))
+            )
+        connection.execute(
+            text(
+                CREATE_INDEX.format(
+                    concurrently=_concurrently(concurrently), index_name=index_name, canonical_fact=canonical_fact
+                )
+            )
+        )
+        logger.info("Created the unique index %s", index_name)
+
+
+def drop_unique_indexes(connection, concurrently=True):
+    for canonical_fact in ELEVATED_CANONICAL_FACT_FIELDS:
+        index_name = INDEX_NAME.format(canonical_fact=canonical_fact)
+        connection.execute(text(DROP_INDEX.format(concurrently=_concurrently(concurrently), index_name=index_name)))
+        logger.info("Dropped the unique index %s", index_name)
+
+
+def main():
+    args = parse_args()
+
+    flask_app = create_app(RuntimeEnvironment.COMMAND)
+    with flask_app.app_context() as ctx:
+        threadctx.request_id = UNKNOWN_REQUEST_ID_VALUE
+        ctx.push()
+
+    # A concurrent index build can't run in a transaction.
+    connection = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        if args.drop:
+            drop_unique_indexes(connection)
+            return
+
+        event_producer = EventProducer(flask_app.config["INVENTORY_CONFIG"])
+        try:
+            deleted_hosts = delete_duplicate_hosts(db.session, event_producer, args.chunk_size)
+        finally:
+            event_producer.close()
+        logger.info("Deleted %d duplicate hosts", deleted_hosts)
+
+        create_unique_indexes(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+import argparse
+import logging
+from collections import Counter
+from functools import partial
+
+from kafka import KafkaConsumer
+from kafka import TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+from app import create_app
+from app.environment import RuntimeEnvironment
+from app.queue.event_producer import DeadLetterProducer
+from app.queue.event_producer import EventProducer
+from app.queue.queue import add_host
+from app.queue.queue import CONSUMER_POLL_TIMEOUT_MS
+from app.queue.queue import event_loop
+from app.queue.queue import handle_message
+from app.queue.queue import update_system_profile
+
+logger = logging.getLogger("replay_dead_letters")
+
+REPLAY_CONSUMER_GROUP = "inventory-dead-letter-replay"
+
+
+class ReplayConsumer:
+    """
+    Hands over to the event loop only the dead letters that came from the given source topic and, optionally, that
+    were caused by the given exception. The offsets are committed only once all the source topics have been replayed.
+    """
+
+    def __init__(self, consumer, source_topic, exception=None):
+        self._consumer = consumer
+        self._source_topic = source_topic.encode("utf-8")
+        self._exception = exception.encode("utf-8") if exception else None
+
+    def __getattr__(self, name):
+        return getattr(self._consumer, name)
+
+    def poll(self, *args, **kwargs):
+        msgs = {}
+        for topic_partition, messages in self._consumer.poll(*args, **kwargs).items():
+            messages = [message for message in messages if self._matches(message)]
+            if messages:
+                msgs[topic_partition] = messages
+        return msgs
+
+    def commit(self, *args, **kwargs):
+        pass
+
+    def _matches(self, message):
+        headers = dict(message.headers)
+        if headers.get("source_topic") != self._source_topic:
+            return False
+        return self._exception is None or headers.get("exception") == self._exception
+
+
+def _log_unknown_source_topics(consumer, partitions, end_offsets, known_topics):
+    # Dead letters from a topic without a handler are not replayed, they stay in the dead letter topic.
+    unknown = Counter()
+    while any(consumer.position(partition) < end_offsets[partition] for partition in partitions):
+        for messages in consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS).values():
+            for message in messages:
+                source_topic = dict(message.headers).get("source_topic", b"").decode("utf-8")
+                if source_topic not in known_topics:
+                    unknown[source_topic] += 1
+    for source_topic, count in unknown.items():
+        logger.warning("Not replaying %d dead letters from the unknown source topic %r", count, source_topic)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Re-drives the messages from the dead letter topic through the ingress message handler."
+    )
+    parser.add_argument(
+        "-p", "--parallelism", type=int, default=1, help="number of messages processed concurrently (default: 1)"
+    )
+    parser.add_argument(
+        "-e", "--exception", help="replay only the messages that failed with this exception, e.g. builtins.ValueError"
+    )
+    parser.add_argument(
+        "-g", "--group-id", default=REPLAY_CONSUMER_GROUP, help=f"consumer group (default: {REPLAY_CONSUMER_GROUP})"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    application = create_app(RuntimeEnvironment.SERVICE)
+    config = application.config["INVENTORY_CONFIG"]
+    if not config.dead_letter_topic:
+        raise SystemExit("KAFKA_DEAD_LETTER_TOPIC is not set.")
+
+    # The worker pool dispatches by host, so replays of the same host keep their order.
+    config.mq_worker_count = args.parallelism
+    config.mq_worker_dispatch_key = "host"
+
+    # The host ingress dead letters are replayed first, the system profile updates may depend on them.
+    topic_to_handler = {config.host_ingress_topic: add_host, config.system_profile_topic: update_system_profile}
+
+    consumer = KafkaConsumer(
+        group_id=args.group_id,
+        bootstrap_servers=config.bootstrap_servers,
+        api_version=(0, 10, 1),
+        value_deserializer=lambda m: m.decode(),
+        **{**config.kafka_consumer, "enable_auto_commit": False, "auto_offset_reset": "earliest"},
+    )
+    partitions = [
+        TopicPartition(config.dead_letter_topic, partition)
+        for partition in consumer.partitions_for_topic(config.dead_letter_topic) or ()
+    ]
+    consumer.assign(partitions)
+
+    # Messages failing again are dead-lettered after these offsets, so they are not replayed in a loop.
+    start_offsets = {partition: consumer.position(partition) for partition in partitions}
+    end_offsets = consumer.end_offsets(partitions)
+    logger.info("Replaying dead letters from %s up to %s", start_offsets, end_offsets)
+
+    def rewind():
+        for partition, offset in start_offsets.items():
+            consumer.seek(partition, offset)
+
+    def replayed():
+        return all(consumer.position(partition) >= end_offset for partition, end_offset in end_offsets.items())
+
+    event_producer = EventProducer(config)
+    dead_letter_producer = DeadLetterProducer(config)
+    try:
+        _log_unknown_source_topics(consumer, partitions, end_offsets, topic_to_handler)
+
+        # Every source topic is replayed in its own pass over the dead letters, with its own message handler.
+        for source_topic, message_operation in topic_to_handler.items():
+            rewind()
+            logger.info("Replaying dead letters from %s", source_topic)
+            message_handler = partial(handle_message, message_operation=message_operation)
+            replay_consumer = ReplayConsumer(consumer, source_topic, args.exception)
+            event_loop(replay_consumer, application, event_producer, message_handler, replayed, dead_letter_producer)
+
+        consumer.commit({partition: OffsetAndMetadata(offset, None) for partition, offset in end_offsets.items()})
+    finally:
+        dead_letter_producer.close()
+        event_producer.close()
+        consumer.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,90 @@
+import argparse
+
+from sqlalchemy import text
+
+from app import create_app
+from app import UNKNOWN_REQUEST_ID_VALUE
+from app.environment import RuntimeEnvironment
+from app.logging import get_logger
+from app.logging import threadctx
+from app.models import db
+
+logger = get_logger("utils")
+
+DEFAULT_CHUNK_SIZE = 1000
+FIRST_HOST_ID = "00000000-0000-0000-0000-000000000000"
+
+# Brings the lookup table rows of a chunk of hosts ordered by id in line with their canonical facts, a row for every
+# item of a list fact. The hosts of the chunk are locked, so a concurrent update of their facts waits for the chunk.
+# Returns the last host id of the chunk, the next chunk starts after it, and the number of its hosts.
+SYNC_CHUNK = text(
+    """
+    WITH chunk AS (
+        SELECT id, account, canonical_facts FROM hosts WHERE id > :last_id ORDER BY id LIMIT :chunk_size FOR UPDATE
+    ), facts AS (
+        SELECT chunk.id AS host_id, chunk.account, fact.key AS fact_name, fact.value #>> '{}' AS fact_value
+        FROM chunk, jsonb_each(chunk.canonical_facts) AS fact
+        WHERE jsonb_typeof(fact.value) = 'string'
+        UNION
+        SELECT chunk.id, chunk.account, fact.key, jsonb_array_elements_text(fact.value)
+        FROM chunk, jsonb_each(chunk.canonical_facts) AS fact
+        WHERE jsonb_typeof(fact.value) = 'array'
+    ), deleted AS (
+        DELETE FROM host_canonical_facts
+        WHERE host_id IN (SELECT id FROM chunk)
+        AND (host_id, fact_name, fact_value) NOT IN (SELECT host_id, fact_name, fact_value FROM facts)
+    ), inserted AS (
+        INSERT INTO host_canonical_facts (host_id, account, fact_name, fact_value)
+        SELECT host_id, account, fact_name, fact_value FROM facts
+        ON CONFLICT DO NOTHING
+    )
+    SELECT (SELECT id FROM chunk ORDER BY id DESC LIMIT 1), (SELECT count(*) FROM chunk)
+    """
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Catches the host canonical facts lookup table up with the canonical facts of the hosts."
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"number of hosts synced in a transaction (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    return parser.parse_args()
+
+
+def sync_host_canonical_facts(session, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Re-syncs the lookup table rows of all the hosts, including those written by a version not maintaining the table.
+    Every chunk of hosts is committed on its own. Returns the number of the synced hosts.
+    """
+    last_id = FIRST_HOST_ID
+    hosts = 0
+    while True:
+        last_id, chunk_hosts = session.execute(SYNC_CHUNK, {"last_id": last_id, "chunk_size": chunk_size}).fetchone()
+        session.commit()
+        if last_id is None:
+            return hosts
+
+        hosts += chunk_hosts
+        logger.info("Synced the canonical facts of %d hosts", hosts)
+
+
+def main():
+    args = parse_args()
+
+    flask_app = create_app(RuntimeEnvironment.COMMAND)
+    with flask_app.app_context() as ctx:
+        threadctx.request_id = UNKNOWN_REQUEST_ID_VALUE
+        ctx.push()
+
+    hosts = sync_host_canonical_facts(db.session, args.chunk_size)
+    logger.info("The canonical facts lookup table is in sync with all the %d hosts", hosts)
+
+
+if __name__ == "__main__":
+    main()